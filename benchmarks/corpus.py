@@ -0,0 +1,190 @@
+"""Generate a synthetic corpus of indexer inputs for benchmarking."""
+
+import json
+from pathlib import Path
+import random
+from typing import Tuple
+
+import numpy as np
+
+from src.index.embedding_models import get_embedding_models
+from src.utils import (
+    get_embedding_container_path,
+    get_embedding_path,
+    write_embedding_container,
+)
+
+# Block types are drawn with these weights, so some are removed by the filter
+BLOCK_TYPE_WEIGHTS = {
+    "Text": 0.7,
+    "Title": 0.1,
+    "List": 0.1,
+    "Table": 0.05,
+    "Figure": 0.05,
+}
+PAGE_DIMENSIONS = (612.0, 792.0)
+BLOCKS_PER_PAGE = 20
+WORDS = (
+    "climate adaptation mitigation emissions policy energy transport forestry "
+    "agriculture water resilience finance carbon renewable strategy national law "
+    "framework sector target reduction greenhouse gas biodiversity"
+).split()
+
+
+def _text(rng: random.Random, min_words: int = 8, max_words: int = 60) -> str:
+    return " ".join(rng.choices(WORDS, k=rng.randint(min_words, max_words)))
+
+
+def _block_type(rng: random.Random) -> str:
+    return rng.choices(
+        list(BLOCK_TYPE_WEIGHTS), weights=list(BLOCK_TYPE_WEIGHTS.values())
+    )[0]
+
+
+def _pdf_text_block(rng: random.Random, index: int) -> dict:
+    page_number = index // BLOCKS_PER_PAGE
+    x0 = rng.uniform(50, 300)
+    y0 = rng.uniform(50, 700)
+    x1 = x0 + rng.uniform(50, 250)
+    y1 = y0 + rng.uniform(10, 80)
+    return {
+        "text": [_text(rng)],
+        "text_block_id": f"p_{page_number}_b_{index % BLOCKS_PER_PAGE}",
+        "language": "en",
+        "type": _block_type(rng),
+        "type_confidence": rng.uniform(0.5, 1.0),
+        "coords": [[x0, y0], [x1, y0], [x1, y1], [x0, y1]],
+        "page_number": page_number,
+    }
+
+
+def _html_text_block(rng: random.Random, index: int) -> dict:
+    return {
+        "text": [_text(rng)],
+        "text_block_id": f"b_{index}",
+        "language": "en",
+        "type": _block_type(rng),
+        "type_confidence": 1.0,
+    }
+
+
+def generate_parser_output(
+    rng: random.Random, document_id: str, text_block_count: int, html: bool
+) -> dict:
+    """A parser output for one document, in the form written by the parser."""
+    if html:
+        html_data = {
+            "detected_title": _text(rng, 3, 10),
+            "detected_date": None,
+            "has_valid_text": True,
+            "text_blocks": [_html_text_block(rng, i) for i in range(text_block_count)],
+        }
+        pdf_data = None
+    else:
+        html_data = None
+        page_count = max(1, -(-text_block_count // BLOCKS_PER_PAGE))
+        pdf_data = {
+            "page_metadata": [
+                {"page_number": i, "dimensions": list(PAGE_DIMENSIONS)}
+                for i in range(page_count)
+            ],
+            "md5sum": "0" * 32,
+            "text_blocks": [_pdf_text_block(rng, i) for i in range(text_block_count)],
+        }
+
+    name = _text(rng, 3, 10)
+    description = _text(rng, 20, 80)
+    return {
+        "document_id": document_id,
+        "document_metadata": {
+            "name": name,
+            "description": description,
+            "import_id": document_id,
+            "slug": document_id.lower().replace(".", "-"),
+            "family_import_id": document_id.replace(".document.", ".family."),
+            "family_slug": "",
+            "publication_ts": "2020-12-01T00:00:00Z",
+            "date": "01/12/2020",
+            "source_url": "https://example.org/document.pdf",
+            "download_url": "",
+            "type": "Strategy",
+            "source": "BENCH",
+            "category": "Executive",
+            "geography": "GBR",
+            "languages": ["English"],
+            "metadata": {},
+        },
+        "document_name": name,
+        "document_description": description,
+        "document_source_url": None,
+        "document_cdn_object": None,
+        "document_content_type": "text/html" if html else "application/pdf",
+        "document_md5_sum": None,
+        "document_slug": "",
+        "languages": ["en"],
+        "translated": False,
+        "html_data": html_data,
+        "pdf_data": pdf_data,
+        "pipeline_metadata": {},
+    }
+
+
+def generate_corpus(
+    output_dir: Path,
+    document_count: int,
+    text_blocks_per_document: Tuple[int, int] = (50, 500),
+    html_fraction: float = 0.2,
+    seed: int = 0,
+    embedding_container: bool = False,
+) -> list[Path]:
+    """
+    Write parser output JSON and embeddings for each model for synthetic documents.
+
+    Each document has one embedding per text block, after one for the
+    description, as text2embeddings writes them.
+
+    :param output_dir: directory to write the corpus to
+    :param document_count: number of documents to generate
+    :param text_blocks_per_document: inclusive range of the number of text
+        blocks in each document
+    :param html_fraction: fraction of documents that are HTML rather than PDF
+    :param seed: seed for the random generators, the same seed generates the
+        same corpus
+    :param embedding_container: write each document's embeddings to a single
+        container rather than a file per model
+    :return: paths to the parser output JSON files
+    """
+    output_dir.mkdir(parents=True, exist_ok=True)
+    rng = random.Random(seed)
+    np_rng = np.random.default_rng(seed)
+
+    paths = []
+    for i in range(document_count):
+        document_id = f"BENCH.document.{i}.0"
+        text_block_count = rng.randint(*text_blocks_per_document)
+        parser_output = generate_parser_output(
+            rng, document_id, text_block_count, html=rng.random() < html_fraction
+        )
+
+        path = output_dir / f"{document_id}.json"
+        path.write_text(json.dumps(parser_output))
+        paths.append(path)
+
+        embeddings = {
+            model_slug: np_rng.standard_normal(
+                (text_block_count + 1, model.dimension), dtype=np.float32
+            )
+            for model_slug, model in get_embedding_models().items()
+        }
+        if embedding_container:
+            write_embedding_container(
+                get_embedding_container_path(output_dir, document_id), embeddings
+            )
+            continue
+        for model_slug, model_embeddings in embeddings.items():
+            np.save(
+                get_embedding_path(output_dir, document_id, model_slug),
+                model_embeddings,
+            )
+
+    return paths
@@ -0,0 +1,251 @@
+"""
+An in-process stand-in for the Vespa HTTP endpoints used by the indexer.
+
+Implements document puts and deletes on /document/v1, and the existing passage
+lookup on /search/, with injected latency, throttling and failures, so feeding
+can be tuned reproducibly without a Vespa cluster or network.
+"""
+
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import sys
+import threading
+import time
+from typing import NamedTuple, Optional, Tuple
+from urllib.parse import unquote, urlparse
+
+DOCUMENT_PATH_PREFIX = "/document/v1/"
+SEARCH_PATH = "/search/"
+
+
+class FakeVespaSettings(NamedTuple):
+    """How the fake Vespa responds"""
+
+    # Seconds added to every request, plus exponentially distributed jitter with
+    # the given mean
+    latency: float = 0.0
+    latency_jitter: float = 0.0
+    # Fraction of requests rejected with one of the throttle status codes
+    throttle_rate: float = 0.0
+    throttle_status_codes: Tuple[int, ...] = (429, 503)
+    # Fraction of requests that fail with the failure status code
+    failure_rate: float = 0.0
+    failure_status: int = 400
+    # Requests beyond this many in flight are rejected with a 429, as Vespa does
+    # when overloaded
+    max_in_flight: Optional[int] = None
+    seed: Optional[int] = None
+
+
+def _percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients hang up on requests they time out, which isn't an error here
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class FakeVespa:
+    """
+    A threaded HTTP server standing in for Vespa.
+
+    Use as a context manager, and point the indexer at `url`.
+    """
+
+    def __init__(
+        self,
+        settings: FakeVespaSettings = FakeVespaSettings(),
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        self.settings = settings
+        # Fields of the documents fed, by schema and id
+        self.documents: dict[Tuple[str, str], dict] = {}
+        self._random = random.Random(settings.seed)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._request_counts: dict[str, int] = defaultdict(int)
+        self._status_counts: dict[Tuple[str, int], int] = defaultdict(int)
+        self._latencies: dict[str, list[float]] = defaultdict(list)
+
+        fake = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                fake._handle(self, "POST")
+
+            def do_DELETE(self):
+                fake._handle(self, "DELETE")
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = _Server((host, port), _Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self) -> "FakeVespa":
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def stats(self) -> dict:
+        """
+        Requests by endpoint, responses by endpoint and status, and server side
+        latency percentiles.
+        """
+        with self._lock:
+            return {
+                "requests": dict(sorted(self._request_counts.items())),
+                "responses": {
+                    f"{kind}:{status}": count
+                    for (kind, status), count in sorted(self._status_counts.items())
+                },
+                "latency_seconds": {
+                    kind: {
+                        "p50": _percentile(latencies, 0.5),
+                        "p95": _percentile(latencies, 0.95),
+                        "p99": _percentile(latencies, 0.99),
+                        "max": max(latencies),
+                    }
+                    for kind, latencies in sorted(self._latencies.items())
+                    if latencies
+                },
+            }
+
+    def _handle(self, handler: BaseHTTPRequestHandler, method: str) -> None:
+        start = time.monotonic()
+        path = urlparse(handler.path).path
+        length = int(handler.headers.get("Content-Length") or 0)
+        body = json.loads(handler.rfile.read(length)) if length else {}
+
+        if path == SEARCH_PATH and method == "POST":
+            kind = "search"
+        elif path.startswith(DOCUMENT_PATH_PREFIX):
+            kind = "delete" if method == "DELETE" else "put"
+        else:
+            self._respond(handler, "unknown", start, 404, {"message": "Not found"})
+            return
+
+        with self._lock:
+            self._request_counts[kind] += 1
+            self._in_flight += 1
+            overloaded = (
+                self.settings.max_in_flight is not None
+                and self._in_flight > self.settings.max_in_flight
+            )
+            throttled = self._random.random() < self.settings.throttle_rate
+            throttle_status = self._random.choice(self.settings.throttle_status_codes)
+            failed = self._random.random() < self.settings.failure_rate
+            jitter = (
+                self._random.expovariate(1 / self.settings.latency_jitter)
+                if self.settings.latency_jitter
+                else 0.0
+            )
+        try:
+            if overloaded:
+                self._respond(
+                    handler,
+                    kind,
+                    start,
+                    429,
+                    {"message": "Rejecting execution due to overload"},
+                )
+                return
+            if throttled:
+                self._respond(
+                    handler, kind, start, throttle_status, {"message": "Throttled"}
+                )
+                return
+
+            time.sleep(self.settings.latency + jitter)
+
+            if failed:
+                self._respond(
+                    handler,
+                    kind,
+                    start,
+                    self.settings.failure_status,
+                    {"message": "Injected failure"},
+                )
+            elif kind == "search":
+                self._respond(handler, kind, start, 200, self._search(body))
+            else:
+                self._respond(handler, kind, start, 200, self._document(path, body))
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def _document(self, path: str, body: dict) -> dict:
+        # /document/v1/{namespace}/{schema}/docid/{id}
+        namespace, schema, _, document_id = unquote(
+            path[len(DOCUMENT_PATH_PREFIX) :]
+        ).split("/", 3)
+        with self._lock:
+            if "fields" in body:
+                self.documents[(schema, document_id)] = body["fields"]
+            else:
+                self.documents.pop((schema, document_id), None)
+        return {"pathId": path, "id": f"id:{namespace}:{schema}::{document_id}"}
+
+    def _search(self, body: dict) -> dict:
+        """Answer the indexer's lookup of the passages of a family document."""
+        family_document_ref = body.get("family_doc_id")
+        offset = int(body.get("offset", 0))
+        hits = int(body.get("hits", 10))
+        namespace = family_document_ref.split(":")[1] if family_document_ref else ""
+
+        with self._lock:
+            matches = sorted(
+                document_id
+                for (schema, document_id), fields in self.documents.items()
+                if schema == "document_passage"
+                and fields.get("family_document_ref") == family_document_ref
+            )
+        return {
+            "root": {
+                "fields": {"totalCount": len(matches)},
+                "children": [
+                    {"id": f"id:{namespace}:document_passage::{document_id}"}
+                    for document_id in matches[offset : offset + hits]
+                ],
+            }
+        }
+
+    def _respond(
+        self,
+        handler: BaseHTTPRequestHandler,
+        kind: str,
+        start: float,
+        status: int,
+        body: dict,
+    ) -> None:
+        payload = json.dumps(body).encode()
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(payload)))
+        handler.end_headers()
+        handler.wfile.write(payload)
+        with self._lock:
+            self._status_counts[(kind, status)] += 1
+            self._latencies[kind].append(time.monotonic() - start)
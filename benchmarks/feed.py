@@ -0,0 +1,208 @@
+"""
+Benchmark feeding end to end, with populate_vespa against a fake Vespa.
+
+The fake's latency, throttling and failures are configurable, as is any
+setting in src.config, so connections, batching and flow control can be tuned
+reproducibly without a Vespa cluster.
+
+    python -m benchmarks.feed --latency 0.02 --throttle-rate 0.01 \\
+        --config VESPA_FEED_MODE=stream --config VESPA_CONNECTIONS=50
+"""
+
+from datetime import datetime, timezone
+import json
+from pathlib import Path
+import tempfile
+import time
+from typing import Any, Optional
+from unittest.mock import patch
+
+import click
+
+from benchmarks.corpus import generate_corpus
+from benchmarks.fake_vespa import FakeVespa, FakeVespaSettings
+from src import config
+from src.index.vespa_ import populate_vespa
+from src.metrics import metrics
+
+
+def parse_config_overrides(overrides: tuple[str, ...]) -> dict[str, Any]:
+    """Parse NAME=VALUE settings, converted to the type of the current setting."""
+    parsed = {}
+    for override in overrides:
+        name, _, value = override.partition("=")
+        if not hasattr(config, name):
+            raise click.BadParameter(f"Unknown setting: {name}")
+        current = getattr(config, name)
+        if isinstance(current, bool):
+            parsed[name] = value.lower() == "true"
+        elif isinstance(current, list):
+            parsed[name] = value.split(",")
+        elif isinstance(current, dict):
+            parsed[name] = dict(item.split("=", 1) for item in value.split(","))
+        else:
+            parsed[name] = type(current)(value)
+    return parsed
+
+
+def _summarise(duration: float, fake_vespa: FakeVespa, dead_letter: Path) -> dict:
+    report = metrics.report(duration)
+    return {
+        "duration_seconds": duration,
+        "documents_per_second": report["documents_per_second"],
+        "passages_per_second": report["passages_per_second"],
+        "failed_operations": (
+            len(dead_letter.read_text().splitlines()) if dead_letter.exists() else 0
+        ),
+        "feed_latency_seconds": {
+            stage: {
+                quantile: summary[f"{quantile}_seconds"]
+                for quantile in ["p50", "p95", "p99"]
+            }
+            for stage, summary in report["stages"].items()
+            if stage.startswith("feed") or stage == "existing_ids_query"
+        },
+        "counters": report["counters"],
+        "server": fake_vespa.stats(),
+    }
+
+
+@click.command()
+@click.option("--documents", type=int, default=50, help="Documents in the corpus.")
+@click.option(
+    "--text-blocks",
+    type=(int, int),
+    default=(50, 500),
+    help="Minimum and maximum text blocks in each document.",
+)
+@click.option(
+    "--html-fraction",
+    type=float,
+    default=0.2,
+    help="Fraction of documents that are HTML rather than PDF.",
+)
+@click.option("--seed", type=int, default=0, help="Seed for the corpus and faults.")
+@click.option(
+    "--latency", type=float, default=0.0, help="Seconds added to every request."
+)
+@click.option(
+    "--latency-jitter",
+    type=float,
+    default=0.0,
+    help="Mean of exponentially distributed seconds added to every request.",
+)
+@click.option(
+    "--throttle-rate",
+    type=float,
+    default=0.0,
+    help="Fraction of requests rejected with a 429 or 503.",
+)
+@click.option(
+    "--failure-rate",
+    type=float,
+    default=0.0,
+    help="Fraction of requests that fail with the failure status.",
+)
+@click.option(
+    "--failure-status", type=int, default=400, help="Status of injected failures."
+)
+@click.option(
+    "--server-max-in-flight",
+    type=int,
+    required=False,
+    help="Requests in flight beyond which the fake rejects requests with a 429.",
+)
+@click.option(
+    "--config",
+    "config_overrides",
+    multiple=True,
+    help="A setting from src.config to override, as NAME=VALUE.",
+)
+@click.option(
+    "--results",
+    "results_path",
+    type=click.Path(path_type=Path),
+    required=False,
+    help="JSON lines file to append the results to.",
+)
+def run_feed_benchmark(
+    documents: int,
+    text_blocks: tuple[int, int],
+    html_fraction: float,
+    seed: int,
+    latency: float,
+    latency_jitter: float,
+    throttle_rate: float,
+    failure_rate: float,
+    failure_status: int,
+    server_max_in_flight: Optional[int],
+    config_overrides: tuple[str, ...],
+    results_path: Optional[Path],
+) -> None:
+    overrides = parse_config_overrides(config_overrides)
+    settings = FakeVespaSettings(
+        latency=latency,
+        latency_jitter=latency_jitter,
+        throttle_rate=throttle_rate,
+        failure_rate=failure_rate,
+        failure_status=failure_status,
+        max_in_flight=server_max_in_flight,
+        seed=seed,
+    )
+
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        corpus_dir = Path(temporary_dir) / "corpus"
+        dead_letter = Path(temporary_dir) / "dead_letter.jsonl"
+        click.echo(f"Generating corpus of {documents} documents")
+        paths = generate_corpus(corpus_dir, documents, text_blocks, html_fraction, seed)
+
+        with FakeVespa(settings) as fake_vespa, patch.multiple(
+            config,
+            VESPA_INSTANCE_URL=fake_vespa.url,
+            DEVELOPMENT_MODE=True,
+            **overrides,
+        ):
+            start = time.perf_counter()
+            populate_vespa(
+                paths=paths,
+                embedding_dir_as_path=corpus_dir,
+                dead_letter_path=dead_letter,
+            )
+            duration = time.perf_counter() - start
+
+        summary = _summarise(duration, fake_vespa, dead_letter)
+
+    click.echo(
+        f"{summary['documents_per_second']:.1f} docs/s, "
+        f"{summary['passages_per_second']:.1f} passages/s over {duration:.2f}s, "
+        f"{summary['failed_operations']} failed operations"
+    )
+    for stage, quantiles in summary["feed_latency_seconds"].items():
+        click.echo(
+            f"{stage:60} "
+            + " ".join(
+                f"{q}={seconds * 1000:.1f}ms" for q, seconds in quantiles.items()
+            )
+        )
+    click.echo(f"Server responses: {summary['server']['responses']}")
+
+    if results_path is not None:
+        record = {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "corpus": {
+                "documents": documents,
+                "text_blocks": list(text_blocks),
+                "html_fraction": html_fraction,
+                "seed": seed,
+            },
+            "fake_vespa": settings._asdict(),
+            "config": overrides,
+            "results": summary,
+        }
+        with results_path.open("a") as results_file:
+            results_file.write(json.dumps(record) + "\n")
+        click.echo(f"Appended results to {results_path}")
+
+
+if __name__ == "__main__":
+    run_feed_benchmark()
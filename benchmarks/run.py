@@ -0,0 +1,478 @@
+"""
+Benchmark document preparation offline, against a synthetic corpus.
+
+Nothing is fed to Vespa, and lookups of existing passages are mocked, so the
+results measure the throughput of reading inputs and building documents.
+Each run is appended to a results file and compared with the last run over
+the same corpus, with the same repeats and config, to catch regressions in
+preparation throughput.
+
+    python -m benchmarks.run --documents 50 --text-blocks 50 500
+"""
+
+from datetime import datetime, timezone
+import json
+from pathlib import Path
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, NamedTuple, Optional
+from unittest.mock import MagicMock, patch
+
+import click
+from cpr_data_access.parser_models import ParserOutput
+
+from benchmarks.corpus import generate_corpus
+from src import config
+from src.index.embedding_models import get_embedding_models
+from src.index.vespa_ import (
+    DOCUMENT_PASSAGE_SCHEMA,
+    build_vespa_document_passage,
+    build_vespa_document_passage_fields,
+    encode_embeddings,
+    get_document_generator,
+)
+from src.utils import (
+    build_text_block_windows,
+    compile_block_types,
+    filter_on_block_type,
+    get_embedding_path,
+    get_text_from_text_block,
+    read_document_inputs,
+    read_embeddings,
+    read_npy_file,
+    resolve_embedding_layout,
+)
+
+DEFAULT_RESULTS_PATH = Path(__file__).parent / "results.jsonl"
+SEARCH_WEIGHTS_REF = "id:doc_search:search_weights::default_weights"
+
+
+class Corpus(NamedTuple):
+    directory: Path
+    paths: list[Path]
+
+
+class BenchmarkResult(NamedTuple):
+    seconds: float
+    items: int
+    unit: str
+
+    @property
+    def items_per_second(self) -> float:
+        return self.items / self.seconds if self.seconds else 0.0
+
+
+# Each benchmark sets up outside of the timing, and returns the function to time,
+# which returns the number of items processed and their unit. Set up is repeated
+# for each repeat, so a benchmark that changes its inputs, such as filtering
+# parsed documents in place, never runs over inputs changed by an earlier repeat
+Benchmark = Callable[[], tuple[int, str]]
+
+
+def bench_read_npy_file(corpus: Corpus) -> Benchmark:
+    embedding_paths = [
+        get_embedding_path(corpus.directory, path.stem, model_slug)
+        for path in corpus.paths
+        for model_slug in get_embedding_models()
+    ]
+    embedding_paths = [path for path in embedding_paths if path.exists()]
+
+    def _run() -> tuple[int, str]:
+        for embedding_path in embedding_paths:
+            # Reduce over the array so memory mapped files are read in full
+            read_npy_file(embedding_path).max()
+        return len(embedding_paths), "files"
+
+    return _run
+
+
+def bench_read_embeddings(corpus: Corpus) -> Benchmark:
+    model_slugs = list(get_embedding_models())
+    layout = resolve_embedding_layout(
+        corpus.directory, corpus.paths[0].stem, config.EMBEDDING_LAYOUT
+    )
+
+    def _run() -> tuple[int, str]:
+        for path in corpus.paths:
+            for embeddings in read_embeddings(
+                corpus.directory, path.stem, model_slugs, layout=layout
+            ).values():
+                embeddings.max()
+        return len(corpus.paths), "documents"
+
+    return _run
+
+
+def bench_filter_on_block_type(corpus: Corpus) -> Benchmark:
+    parser_outputs = [
+        ParserOutput.model_validate_json(path.read_text()) for path in corpus.paths
+    ]
+    blocks_to_filter = compile_block_types(config.BLOCKS_TO_FILTER)
+
+    def _run() -> tuple[int, str]:
+        for parser_output in parser_outputs:
+            filter_on_block_type(
+                input=parser_output, remove_block_types=blocks_to_filter
+            )
+        return len(parser_outputs), "documents"
+
+    return _run
+
+
+def bench_build_text_block_windows(corpus: Corpus) -> Benchmark:
+    block_texts = [
+        [
+            get_text_from_text_block(text_block)
+            for text_block in ParserOutput.model_validate_json(
+                path.read_text()
+            ).get_text_blocks()
+        ]
+        for path in corpus.paths
+    ]
+
+    def _run() -> tuple[int, str]:
+        count = 0
+        for texts in block_texts:
+            count += len(
+                build_text_block_windows(
+                    texts,
+                    neighbours=config.PASSAGE_WINDOW_NEIGHBOURS,
+                    max_chars=config.PASSAGE_WINDOW_MAX_CHARS,
+                )
+            )
+        return count, "passages"
+
+    return _run
+
+
+def _passage_inputs(corpus: Corpus) -> list:
+    """Text blocks, and embeddings by model slug, for each document."""
+    inputs = []
+    for path in corpus.paths:
+        document_inputs = read_document_inputs(
+            path, corpus.directory, list(get_embedding_models())
+        )
+        parser_output = ParserOutput.model_validate_json(
+            document_inputs.parser_output_json
+        )
+        inputs.append((parser_output.get_text_blocks(), document_inputs.embeddings))
+    return inputs
+
+
+def bench_build_vespa_document_passage(corpus: Corpus) -> Benchmark:
+    inputs = _passage_inputs(corpus)
+    models = get_embedding_models()
+
+    def _run() -> tuple[int, str]:
+        count = 0
+        for text_blocks, embeddings in inputs:
+            for i, text_block in enumerate(text_blocks, start=1):
+                build_vespa_document_passage(
+                    "BENCH.family",
+                    SEARCH_WEIGHTS_REF,
+                    text_block,
+                    "window",
+                    {
+                        model_slug: model_embeddings[i]
+                        for model_slug, model_embeddings in embeddings.items()
+                    },
+                    models=models,
+                ).model_dump()
+                count += 1
+        return count, "passages"
+
+    return _run
+
+
+def bench_build_vespa_document_passage_fields(corpus: Corpus) -> Benchmark:
+    inputs = _passage_inputs(corpus)
+    models = get_embedding_models()
+
+    def _run() -> tuple[int, str]:
+        count = 0
+        for text_blocks, embeddings in inputs:
+            encoded = {
+                model_slug: encode_embeddings(
+                    model_embeddings[1:], models[model_slug].cell_type
+                )
+                for model_slug, model_embeddings in embeddings.items()
+            }
+            for i, text_block in enumerate(text_blocks):
+                build_vespa_document_passage_fields(
+                    "BENCH.family",
+                    SEARCH_WEIGHTS_REF,
+                    text_block,
+                    "window",
+                    {
+                        model_slug: model_encoded[i]
+                        for model_slug, model_encoded in encoded.items()
+                    },
+                    models=models,
+                )
+                count += 1
+        return count, "passages"
+
+    return _run
+
+
+def bench_get_document_generator(corpus: Corpus) -> Benchmark:
+    def _run() -> tuple[int, str]:
+        count = 0
+        with patch("src.index.vespa_.get_existing_passage_ids", return_value=[]):
+            for schema, _, _ in get_document_generator(
+                vespa=MagicMock(),
+                paths=corpus.paths,
+                embedding_dir_as_path=corpus.directory,
+            ):
+                if schema == DOCUMENT_PASSAGE_SCHEMA:
+                    count += 1
+        return count, "passages"
+
+    return _run
+
+
+BENCHMARKS: dict[str, Callable[[Corpus], Benchmark]] = {
+    "read_npy_file": bench_read_npy_file,
+    "read_embeddings": bench_read_embeddings,
+    "filter_on_block_type": bench_filter_on_block_type,
+    "build_text_block_windows": bench_build_text_block_windows,
+    "build_vespa_document_passage": bench_build_vespa_document_passage,
+    "build_vespa_document_passage_fields": bench_build_vespa_document_passage_fields,
+    "get_document_generator": bench_get_document_generator,
+}
+
+
+def run_benchmark(name: str, corpus: Corpus, repeat: int) -> BenchmarkResult:
+    """Run a benchmark, keeping the fastest of the repeats."""
+    best: Optional[BenchmarkResult] = None
+    for _ in range(max(repeat, 1)):
+        run = BENCHMARKS[name](corpus)
+        start = time.perf_counter()
+        items, unit = run()
+        result = BenchmarkResult(time.perf_counter() - start, items, unit)
+        if best is None or result.seconds < best.seconds:
+            best = result
+    assert best is not None
+    return best
+
+
+def _git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _run_config() -> dict:
+    """The config that throughput depends on, as stored with the results."""
+    return {
+        "PASSAGE_BUILDER_MODE": config.PASSAGE_BUILDER_MODE,
+        "PASSAGE_WINDOW_NEIGHBOURS": config.PASSAGE_WINDOW_NEIGHBOURS,
+        "PASSAGE_WINDOW_MAX_CHARS": config.PASSAGE_WINDOW_MAX_CHARS,
+        "PASSAGE_DEDUPLICATION": config.PASSAGE_DEDUPLICATION,
+        "PREPARATION_WORKERS": config.PREPARATION_WORKERS,
+        "PREFETCH_DEPTH": config.PREFETCH_DEPTH,
+        "EMBEDDING_LAYOUT": config.EMBEDDING_LAYOUT,
+        "VESPA_EMBEDDING_ENCODING": config.VESPA_EMBEDDING_ENCODING,
+        "VESPA_EMBEDDING_CELL_TYPES": config.VESPA_EMBEDDING_CELL_TYPES,
+        "EMBEDDING_MODELS": list(get_embedding_models()),
+    }
+
+
+def read_previous_run(
+    results_path: Path, corpus_settings: dict, repeat: int, run_config: dict
+) -> Optional[dict]:
+    """
+    The most recent stored run over the same corpus, repeats and config.
+
+    Throughput isn't comparable between runs that differ in any of them, so when
+    the most recent run over the same corpus differs in its repeats or config,
+    a warning names what differs and it isn't compared against.
+    """
+    if not results_path.exists():
+        return None
+    # Compare as stored, e.g. with tuples as lists
+    run_config = json.loads(json.dumps(run_config))
+    previous = None
+    latest = None
+    for line in results_path.read_text().splitlines():
+        if line.strip():
+            run = json.loads(line)
+            if run["corpus"] != corpus_settings:
+                continue
+            latest = run
+            if run.get("repeat") == repeat and run.get("config") == run_config:
+                previous = run
+
+    if latest is not None and latest is not previous:
+        differences = [
+            key
+            for key in sorted(set(run_config) | set(latest.get("config", {})))
+            if run_config.get(key) != latest.get("config", {}).get(key)
+        ]
+        if latest.get("repeat") != repeat:
+            differences.insert(0, "repeat")
+        click.echo(
+            f"Not comparing with the last run over this corpus, at "
+            f"{latest['revision']}, as it differs in: {', '.join(differences)}",
+            err=True,
+        )
+    return previous
+
+
+def compare_runs(
+    current: dict, previous: Optional[dict], tolerance: float
+) -> list[str]:
+    """
+    Print each benchmark's throughput against the previous run.
+
+    :return: the names of benchmarks that slowed by more than the tolerance
+    """
+    regressions = []
+    for name, result in current["results"].items():
+        line = (
+            f"{name:40} {result['items_per_second']:12.1f} "
+            f"{result['unit']}/s ({result['seconds']:.3f}s)"
+        )
+        previous_result = (previous or {}).get("results", {}).get(name)
+        if previous_result and previous_result["items_per_second"]:
+            change = result["items_per_second"] / previous_result["items_per_second"]
+            line += f" {change - 1:+.1%} vs {previous['revision']}"
+            if change < 1 - tolerance:
+                regressions.append(name)
+                line += " REGRESSION"
+        click.echo(line)
+    return regressions
+
+
+@click.command()
+@click.option("--documents", type=int, default=50, help="Documents in the corpus.")
+@click.option(
+    "--text-blocks",
+    type=(int, int),
+    default=(50, 500),
+    help="Minimum and maximum text blocks in each document.",
+)
+@click.option(
+    "--html-fraction",
+    type=float,
+    default=0.2,
+    help="Fraction of documents that are HTML rather than PDF.",
+)
+@click.option("--seed", type=int, default=0, help="Seed for the corpus.")
+@click.option(
+    "--embedding-container",
+    is_flag=True,
+    help="Write each document's embeddings to one container, not a file per model.",
+)
+@click.option(
+    "--corpus-dir",
+    type=click.Path(path_type=Path),
+    required=False,
+    help="Directory to write the corpus to, a temporary directory by default.",
+)
+@click.option(
+    "--benchmark",
+    "-b",
+    "benchmark_names",
+    type=click.Choice(list(BENCHMARKS)),
+    multiple=True,
+    help="Benchmarks to run, all of them by default.",
+)
+@click.option("--repeat", type=int, default=3, help="Repeats of each benchmark.")
+@click.option(
+    "--results",
+    "results_path",
+    type=click.Path(path_type=Path),
+    default=DEFAULT_RESULTS_PATH,
+    help="JSON lines file that results are appended to and compared against.",
+)
+@click.option(
+    "--tolerance",
+    type=float,
+    default=0.1,
+    help="Fractional drop in throughput reported as a regression.",
+)
+@click.option(
+    "--fail-on-regression",
+    is_flag=True,
+    help="Exit with an error when any benchmark regresses.",
+)
+def run_benchmarks(
+    documents: int,
+    text_blocks: tuple[int, int],
+    html_fraction: float,
+    seed: int,
+    embedding_container: bool,
+    corpus_dir: Optional[Path],
+    benchmark_names: tuple[str, ...],
+    repeat: int,
+    results_path: Path,
+    tolerance: float,
+    fail_on_regression: bool,
+) -> None:
+    corpus_settings = {
+        "documents": documents,
+        "text_blocks": list(text_blocks),
+        "html_fraction": html_fraction,
+        "seed": seed,
+    }
+    if embedding_container:
+        corpus_settings["embedding_container"] = True
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        directory = corpus_dir or Path(temporary_dir)
+        click.echo(f"Generating corpus of {documents} documents in {directory}")
+        corpus = Corpus(
+            directory=directory,
+            paths=generate_corpus(
+                directory,
+                documents,
+                text_blocks,
+                html_fraction,
+                seed,
+                embedding_container,
+            ),
+        )
+
+        results = {}
+        for name in benchmark_names or BENCHMARKS:
+            result = run_benchmark(name, corpus, repeat)
+            results[name] = {
+                "seconds": result.seconds,
+                "items": result.items,
+                "unit": result.unit,
+                "items_per_second": result.items_per_second,
+            }
+
+    current = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "revision": _git_revision(),
+        "corpus": corpus_settings,
+        "repeat": repeat,
+        "config": _run_config(),
+        "results": results,
+    }
+    regressions = compare_runs(
+        current,
+        read_previous_run(results_path, corpus_settings, repeat, current["config"]),
+        tolerance,
+    )
+
+    with results_path.open("a") as results_file:
+        results_file.write(json.dumps(current) + "\n")
+    click.echo(f"Appended results to {results_path}")
+
+    if regressions and fail_on_regression:
+        click.echo(f"Regressed: {', '.join(regressions)}", err=True)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    run_benchmarks()
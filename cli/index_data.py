@@ -3,12 +3,17 @@ import sys
 import time
 import logging
 import logging.config
-from typing import Optional
+from pathlib import Path
+from typing import Optional, Union
 
 import click
+from cloudpathlib import S3Path
 
-from src.index.vespa_ import populate_vespa
-from src.utils import build_indexer_input_path, get_index_paths
+from src import config
+from src.index.vespa_ import export_vespa_feed, populate_vespa
+from src.manifest import MANIFEST_FILE_NAME, shard_file_name
+from src.metrics import metrics
+from src.utils import build_indexer_input_path, iter_index_paths
 
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 DEFAULT_LOGGING = {
@@ -35,6 +40,26 @@ logging.config.dictConfig(DEFAULT_LOGGING)
 os.environ["CLOUPATHLIB_FILE_CACHE_MODE"] = "close_file"
 
 
+def _as_path(location: str) -> Union[Path, S3Path]:
+    """A local or S3 path for a file location given on the command line."""
+    if location.startswith("s3://"):
+        return S3Path(location)
+    return Path(location)
+
+
+def _log_shard(shard_index: int, shard_count: int) -> None:
+    """Label every log record, and metric, with this worker's shard."""
+
+    def _add_shard(record: logging.LogRecord) -> bool:
+        record.shard_index = shard_index
+        record.shard_count = shard_count
+        return True
+
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(_add_shard)
+    metrics.set_run_labels(shard=str(shard_index))
+
+
 @click.command()
 @click.argument("indexer_input_dir")
 @click.option(
@@ -55,6 +80,27 @@ os.environ["CLOUPATHLIB_FILE_CACHE_MODE"] = "close_file"
     required=False,
     help="Optionally limit the number of documents to index.",
 )
+@click.option(
+    "--shard-index",
+    type=int,
+    default=config.INDEXER_SHARD_INDEX,
+    show_default=True,
+    help=(
+        "Index only the documents in this shard, from 0. Set with "
+        "INDEXER_SHARD_INDEX in the environment."
+    ),
+)
+@click.option(
+    "--shard-count",
+    type=int,
+    default=config.INDEXER_SHARD_COUNT,
+    show_default=True,
+    help=(
+        "Number of shards to split documents into by a hash of their ID, for "
+        "workers to index in parallel. Set with INDEXER_SHARD_COUNT in the "
+        "environment."
+    ),
+)
 @click.option(
     "--index-type",
     "-i",
@@ -63,12 +109,111 @@ os.environ["CLOUPATHLIB_FILE_CACHE_MODE"] = "close_file"
     required=False,
     help="Which search database type to populate.",
 )
+@click.option(
+    "--incremental",
+    is_flag=True,
+    required=False,
+    help="Skip documents whose inputs are unchanged since they were last indexed.",
+)
+@click.option(
+    "--manifest",
+    required=False,
+    help=(
+        "Location of the manifest of indexed inputs used by --incremental, "
+        f"defaults to {MANIFEST_FILE_NAME} in the input directory, with the "
+        "shard in the name when sharding."
+    ),
+)
+@click.option(
+    "--passage-state",
+    required=False,
+    help=(
+        "Location of a state file of passage digests, locally or on S3. When "
+        "given, only passages that are new or have changed since the last run "
+        "are fed."
+    ),
+)
+@click.option(
+    "--checkpoint",
+    required=False,
+    help=(
+        "Location to write progress to as batches are acknowledged, locally or on "
+        "S3. Each shard needs its own. When not given, no progress is written."
+    ),
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    required=False,
+    help=(
+        "Skip documents completed by an interrupted run, read from the --checkpoint "
+        "it wrote. Fails if there is no checkpoint to resume from."
+    ),
+)
+@click.option(
+    "--dead-letter",
+    required=False,
+    help=(
+        "Location to write feed operations that failed to, as JSON lines, locally "
+        "or on S3. When given, the run succeeds despite failed operations."
+    ),
+)
+@click.option(
+    "--metrics-json",
+    required=False,
+    help="Location to write a JSON summary of throughput and stage timings to.",
+)
+@click.option(
+    "--metrics-prometheus",
+    required=False,
+    help=(
+        "Location to write throughput and stage timings to as a Prometheus "
+        "textfile, e.g. in the node exporter's textfile collector directory."
+    ),
+)
+@click.option(
+    "--output-feed",
+    required=False,
+    help=(
+        "Directory, locally or on S3, to write the feed operations to as Vespa "
+        "JSON lines feed files, instead of feeding them to Vespa. Each shard "
+        "writes to its own subdirectory."
+    ),
+)
+@click.option(
+    "--compress-feed",
+    is_flag=True,
+    required=False,
+    help="Gzip the feed files written with --output-feed.",
+)
+@click.option(
+    "--offline",
+    is_flag=True,
+    required=False,
+    help=(
+        "With --output-feed, don't look up passages already in Vespa, so no "
+        "removals of stray passages are written."
+    ),
+)
 def run_as_cli(
     indexer_input_dir: str,
     s3: bool,
     files_to_index: Optional[str],
     limit: Optional[int],
+    shard_index: int,
+    shard_count: int,
     index_type: str,
+    incremental: bool,
+    manifest: Optional[str],
+    passage_state: Optional[str],
+    checkpoint: Optional[str],
+    resume: bool,
+    dead_letter: Optional[str],
+    metrics_json: Optional[str],
+    metrics_prometheus: Optional[str],
+    output_feed: Optional[str],
+    compress_feed: bool,
+    offline: bool,
 ) -> None:
     if index_type.lower() == "opensearch":
         click.echo(f"Index type: {index_type}, is no longer used", err=True)
@@ -76,14 +221,75 @@ def run_as_cli(
     elif index_type.lower() == "vespa":
         _LOGGER.warning("Vespa indexing still experimental")
 
+        if shard_count < 1 or not 0 <= shard_index < shard_count:
+            raise click.BadParameter(
+                f"must be from 0 to {shard_count - 1} for {shard_count} shards",
+                param_hint="--shard-index",
+            )
+        if shard_count > 1:
+            _log_shard(shard_index, shard_count)
+
         indexer_input_path = build_indexer_input_path(indexer_input_dir, s3)
-        paths = get_index_paths(indexer_input_path, files_to_index, limit)
+        paths = iter_index_paths(
+            indexer_input_path, files_to_index, limit, shard_index, shard_count
+        )
+
+        if output_feed:
+            if incremental or passage_state or checkpoint or resume or dead_letter:
+                raise click.UsageError(
+                    "--output-feed can't be used with options that track what has "
+                    "been fed"
+                )
+            output_dir = _as_path(output_feed)
+            if shard_count > 1:
+                output_dir = output_dir / f"shard-{shard_index}-of-{shard_count}"
+            start = time.time()
+            feed_paths = export_vespa_feed(
+                paths=paths,
+                embedding_dir_as_path=indexer_input_path,
+                output_dir=output_dir,
+                compress=compress_feed,
+                offline=offline,
+            )
+            duration = time.time() - start
+            _LOGGER.info(
+                f"Wrote {len(feed_paths)} feed files to {output_dir} after: "
+                f"{duration}s"
+            )
+            sys.exit(0)
+        if offline:
+            raise click.UsageError("--offline can only be used with --output-feed")
+
+        manifest_path = None
+        if incremental:
+            manifest_path = (
+                _as_path(manifest)
+                if manifest
+                else indexer_input_path
+                / shard_file_name(MANIFEST_FILE_NAME, shard_index, shard_count)
+            )
+
+        passage_state_path = None
+        if passage_state:
+            passage_state_path = _as_path(passage_state)
+
+        if resume and not checkpoint:
+            raise click.UsageError("--resume needs the --checkpoint to resume from")
+        checkpoint_path = _as_path(checkpoint) if checkpoint else None
 
         start = time.time()
         populate_vespa(
             paths=paths,
             embedding_dir_as_path=indexer_input_path,
-            sleep_between_batches=10,
+            manifest_path=manifest_path,
+            passage_state_path=passage_state_path,
+            checkpoint_path=checkpoint_path,
+            resume=resume,
+            dead_letter_path=_as_path(dead_letter) if dead_letter else None,
+            metrics_json_path=_as_path(metrics_json) if metrics_json else None,
+            metrics_prometheus_path=(
+                _as_path(metrics_prometheus) if metrics_prometheus else None
+            ),
         )
         duration = time.time() - start
         _LOGGER.info(f"Vespa indexing completed after: {duration}s")
@@ -13,14 +13,141 @@ class ConfigError(Exception):
     pass
 
 
+def _parse_model_cell_types(name: str, value: str) -> dict[str, str]:
+    """Parse a comma separated list of model slugs and cell types, as slug=type."""
+    cell_types: dict[str, str] = {}
+    for entry in value.split(","):
+        if not entry.strip():
+            continue
+        model_slug, separator, cell_type = (
+            part.strip() for part in entry.partition("=")
+        )
+        if not separator or not model_slug or not cell_type:
+            raise ConfigError(
+                f"Invalid entry configured with environment variable '{name}': "
+                f"{entry.strip()}, should be a model slug and cell type, as slug=type"
+            )
+        if model_slug in cell_types:
+            raise ConfigError(
+                "Model configured more than once with environment variable "
+                f"'{name}': {model_slug}"
+            )
+        cell_types[model_slug] = cell_type.lower()
+    return cell_types
+
+
 # General config
 BLOCKS_TO_FILTER = os.getenv("BLOCKS_TO_FILTER", "Table,Figure").split(",")
+# Documents are split into this many shards by a hash of their ID, and this worker
+# indexes the shard with this index, from 0
+INDEXER_SHARD_INDEX: int = int(os.getenv("INDEXER_SHARD_INDEX", "0"))
+INDEXER_SHARD_COUNT: int = int(os.getenv("INDEXER_SHARD_COUNT", "1"))
+# Number of processes used to prepare documents for indexing, 1 prepares in-process
+PREPARATION_WORKERS: int = int(os.getenv("PREPARATION_WORKERS", "1"))
+# Maximum prepared documents held per worker waiting to be fed
+PREPARATION_QUEUE_PER_WORKER: int = int(os.getenv("PREPARATION_QUEUE_PER_WORKER", "2"))
+# Either "strict", to validate every passage with pydantic, or "fast", to validate
+# each document's embeddings once and build passages as plain dicts
+PASSAGE_BUILDER_MODE: str = os.getenv("PASSAGE_BUILDER_MODE", "strict").lower()
+# Each passage's window holds the text of up to this many blocks either side of it
+PASSAGE_WINDOW_NEIGHBOURS: int = int(os.getenv("PASSAGE_WINDOW_NEIGHBOURS", "1"))
+# Neighbours that would take a window over this many characters are left out, 0
+# for no limit
+PASSAGE_WINDOW_MAX_CHARS: int = int(os.getenv("PASSAGE_WINDOW_MAX_CHARS", "0"))
+# Passages repeating an earlier passage of their document are left out. Either
+# "off", "exact" for the same text, ignoring case and whitespace, or "near" to
+# also leave out passages with embeddings this similar to an earlier passage's
+PASSAGE_DEDUPLICATION: str = os.getenv("PASSAGE_DEDUPLICATION", "off").lower()
+PASSAGE_NEAR_DUPLICATE_THRESHOLD: float = float(
+    os.getenv("PASSAGE_NEAR_DUPLICATE_THRESHOLD", "0.98")
+)
+# Model whose embeddings are compared to find near duplicate passages
+PASSAGE_NEAR_DUPLICATE_MODEL: str = os.getenv(
+    "PASSAGE_NEAR_DUPLICATE_MODEL", "baai-bge-small-en-v1-5"
+)
+# Number of documents to read ahead of preparation, 0 disables prefetching
+PREFETCH_DEPTH: int = int(os.getenv("PREFETCH_DEPTH", "4"))
+# Stop reading ahead once this many bytes are buffered and waiting to be prepared
+PREFETCH_MAX_BYTES: int = int(os.getenv("PREFETCH_MAX_BYTES", str(256 * 1024 * 1024)))
 
 # Vespa config
+# Maximum connections, and operations in flight, when feeding
 VESPA_CONNECTIONS: int = int(os.getenv("VESPA_CONNECTIONS", "100"))
+# Feed operations in flight adapt between these, starting from the initial value
+VESPA_INITIAL_IN_FLIGHT: int = int(os.getenv("VESPA_INITIAL_IN_FLIGHT", "16"))
+VESPA_MIN_IN_FLIGHT: int = int(os.getenv("VESPA_MIN_IN_FLIGHT", "2"))
+# Feed operations slower than this (seconds) reduce the operations in flight
+VESPA_TARGET_LATENCY: float = float(os.getenv("VESPA_TARGET_LATENCY", "2.0"))
+# Attempts at each feed operation failing with a retryable error, and the base and
+# maximum backoff (seconds) between them
+VESPA_FEED_MAX_ATTEMPTS: int = int(os.getenv("VESPA_FEED_MAX_ATTEMPTS", "5"))
+VESPA_FEED_RETRY_BACKOFF: float = float(os.getenv("VESPA_FEED_RETRY_BACKOFF", "1.0"))
+VESPA_FEED_MAX_BACKOFF: float = float(os.getenv("VESPA_FEED_MAX_BACKOFF", "30.0"))
 VESPA_DOCUMENT_BATCH_SIZE: int = int(os.getenv("VESPA_BATCH_SIZE", "10000"))
+# Either "batch", to generate then feed batches in turn, or "stream", to feed
+# documents continuously while they are generated
+VESPA_FEED_MODE: str = os.getenv("VESPA_FEED_MODE", "batch").lower()
+# Either "sync", to feed from a thread per operation in flight over sessions opened
+# as needed, or "async", to feed, delete and query over one asyncio session for
+# the whole run
+VESPA_FEED_CLIENT: str = os.getenv("VESPA_FEED_CLIENT", "sync").lower()
+# Maximum feed operations in flight with the async feed client, which needs no
+# thread per operation so can keep more in flight than VESPA_CONNECTIONS
+VESPA_ASYNC_MAX_IN_FLIGHT: int = int(os.getenv("VESPA_ASYNC_MAX_IN_FLIGHT", "256"))
+# Seconds before a request made by the async feed client fails, each request is
+# made once per attempt
+VESPA_REQUEST_TIMEOUT: float = float(os.getenv("VESPA_REQUEST_TIMEOUT", "60.0"))
+# Maximum generated documents waiting to be fed when streaming
+VESPA_STREAM_QUEUE_SIZE: int = int(os.getenv("VESPA_STREAM_QUEUE_SIZE", "1000"))
+# Documents fed between checkpoints when streaming, each checkpoint waits for the
+# operations in flight to be acknowledged
+VESPA_STREAM_CHECKPOINT_INTERVAL: int = int(
+    os.getenv("VESPA_STREAM_CHECKPOINT_INTERVAL", "100")
+)
+# Feed operations written to each file when exporting feed files, files are only
+# split between documents so may run over
+VESPA_EXPORT_OPERATIONS_PER_FILE: int = int(
+    os.getenv("VESPA_EXPORT_OPERATIONS_PER_FILE", "100000")
+)
+# Number of documents to look up existing passages for ahead of feeding them
+VESPA_QUERY_LOOKAHEAD: int = int(os.getenv("VESPA_QUERY_LOOKAHEAD", "16"))
 VESPA_INSTANCE_URL: str = os.getenv("VESPA_INSTANCE_URL", "")
 VESPA_CERT_LOCATION: str = os.getenv("VESPA_CERT_LOCATION", "")
 VESPA_KEY_LOCATION: str = os.getenv("VESPA_KEY_LOCATION", "")
+# How embeddings are written in feed operations, either "list" of floats or "hex"
+VESPA_EMBEDDING_ENCODING: str = os.getenv("VESPA_EMBEDDING_ENCODING", "list").lower()
+# Embedding models in addition to, or replacing, the default four. A JSON list,
+# or the path of a JSON file, of objects with the model's "slug", the document
+# passage "field" it is fed to, its "dimension" and optionally its "cell_type"
+EMBEDDING_MODEL_REGISTRY: str = os.getenv("EMBEDDING_MODEL_REGISTRY", "")
+# Slugs of the models whose embeddings are read and fed, every registered model
+# by default
+EMBEDDING_MODELS: list[str] = [
+    model_slug.strip()
+    for model_slug in os.getenv("EMBEDDING_MODELS", "").split(",")
+    if model_slug.strip()
+]
+# Where each document's embeddings are read from first, decided once for the run
+# rather than looked for on every document: "container", a single npz file per
+# document holding every model's embeddings, "npy", a file per document and
+# model, or "auto", to use containers if the first document has one. Documents
+# laid out otherwise fall back to the other layout
+EMBEDDING_LAYOUT: str = os.getenv("EMBEDDING_LAYOUT", "auto").lower()
+# Model whose embedding of the family description is fed, when it is selected
+FAMILY_DESCRIPTION_EMBEDDING_MODEL: str = os.getenv(
+    "FAMILY_DESCRIPTION_EMBEDDING_MODEL", "msmarco-distilbert-dot-v5"
+)
+# Cell types to feed each model's passage embeddings as, matching the tensor cell
+# types the Vespa schema declares, e.g. "baai-bge-small-en-v1-5=bfloat16". Either
+# float, bfloat16 or int8, overriding the cell type in the model registry. Model
+# slugs and cell types are checked against the registry at the start of a run.
+VESPA_EMBEDDING_CELL_TYPES: dict[str, str] = _parse_model_cell_types(
+    "VESPA_EMBEDDING_CELL_TYPES", os.getenv("VESPA_EMBEDDING_CELL_TYPES", "")
+)
+# Embeddings fed as int8 are multiplied by this before rounding, queries against
+# them must be scaled the same way
+VESPA_EMBEDDING_INT8_SCALE: float = float(
+    os.getenv("VESPA_EMBEDDING_INT8_SCALE", "127.0")
+)
 VESPA_NAMESPACE_PREFIX: str = os.getenv("VESPA_NAMESPACE_PREFIX", "navigator")
 DEVELOPMENT_MODE: bool = os.getenv("DEVELOPMENT_MODE", "False").lower() == "true"
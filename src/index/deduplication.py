@@ -0,0 +1,62 @@
+import re
+from typing import Optional, Sequence
+
+import numpy as np
+
+# Modes of passage deduplication, from none to exact then near duplicate text
+DEDUPLICATION_MODES = ("off", "exact", "near")
+# Rows of passage embeddings compared with every other passage at once
+_SIMILARITY_CHUNK_SIZE = 512
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """Text with case and whitespace differences removed, to compare passages."""
+    return _WHITESPACE.sub(" ", text).strip().casefold()
+
+
+def find_duplicate_passages(
+    texts: Sequence[str],
+    embeddings: Optional[np.ndarray] = None,
+    threshold: float = 0.98,
+) -> np.ndarray:
+    """
+    Mark passages that repeat an earlier passage of the same document.
+
+    Passages are exact duplicates when their normalized text matches an earlier
+    passage's. With embeddings, in the same order as the texts, passages are
+    also near duplicates when the cosine similarity of their embedding to an
+    earlier passage's, that isn't itself a duplicate, is at least the
+    threshold. The first of each set of duplicates is kept.
+
+    :return: a boolean mask over the passages, true for duplicates
+    """
+    duplicates = np.zeros(len(texts), dtype=bool)
+    seen = set()
+    for i, text in enumerate(texts):
+        normalized = normalize_text(text)
+        if normalized in seen:
+            duplicates[i] = True
+        seen.add(normalized)
+
+    if embeddings is None or not len(embeddings):
+        return duplicates
+
+    # Passages without an embedding are only compared on their text
+    count = min(len(texts), len(embeddings))
+    vectors = embeddings[:count].astype(np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors = np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+    for start in range(0, count, _SIMILARITY_CHUNK_SIZE):
+        end = min(start + _SIMILARITY_CHUNK_SIZE, count)
+        # Similarity of each passage in the chunk to the passages before it
+        similar = vectors[start:end] @ vectors[:end].T >= threshold
+        for i in range(start, end):
+            if duplicates[i]:
+                continue
+            earlier = similar[i - start, :i] & ~duplicates[:i]
+            if earlier.any():
+                duplicates[i] = True
+    return duplicates
@@ -0,0 +1,115 @@
+import json
+from pathlib import Path
+from typing import Mapping, NamedTuple, Optional, Sequence
+
+from src import config
+from src.index.quantization import CELL_TYPES
+
+
+class EmbeddingModel(NamedTuple):
+    """An embedding model, and the document passage field it is fed to"""
+
+    slug: str
+    field: str
+    dimension: int
+    cell_type: str = "float"
+
+
+# The models the indexer feeds when no registry is configured
+DEFAULT_EMBEDDING_MODELS = (
+    EmbeddingModel("baai-bge-small-en-v1-5", "text_embedding_bge_small", 384),
+    EmbeddingModel("baai-bge-base-en-v1-5", "text_embedding_bge_base", 768),
+    EmbeddingModel(
+        "msmarco-distilbert-base-tas-b", "text_embedding_distilbert_base_tas_b", 768
+    ),
+    EmbeddingModel(
+        "msmarco-distilbert-dot-v5", "text_embedding_distilbert_dot_v5", 768
+    ),
+)
+
+
+def read_model_registry(registry: str = "") -> dict[str, EmbeddingModel]:
+    """
+    The embedding models known to the indexer, by slug.
+
+    :param registry: a JSON list of models, or the path of a JSON file holding
+        one, each with a "slug", "field", "dimension" and optionally
+        "cell_type". They are added to the default models, replacing any with
+        the same slug.
+    """
+    models = {model.slug: model for model in DEFAULT_EMBEDDING_MODELS}
+    if not registry.strip():
+        return models
+
+    if not registry.lstrip().startswith("["):
+        registry = Path(registry).read_text()
+    try:
+        entries = json.loads(registry)
+        for entry in entries:
+            model = EmbeddingModel(
+                slug=entry["slug"],
+                field=entry["field"],
+                dimension=int(entry["dimension"]),
+                cell_type=entry.get("cell_type", "float"),
+            )
+            models[model.slug] = model
+    except (json.JSONDecodeError, KeyError, TypeError, ValueError) as e:
+        raise config.ConfigError(
+            "Invalid embedding model registry configured with environment "
+            f"variable 'EMBEDDING_MODEL_REGISTRY': {e}"
+        ) from e
+    return models
+
+
+def get_embedding_models(
+    registry: Optional[str] = None,
+    selected: Optional[Sequence[str]] = None,
+    cell_types: Optional[Mapping[str, str]] = None,
+) -> dict[str, EmbeddingModel]:
+    """
+    The embedding models selected for the run, by slug, in registry order.
+
+    Only these models' embeddings are read and fed.
+
+    :param registry: see `read_model_registry`, from config by default
+    :param selected: slugs of the models to use, from config by default, and
+        every registered model when empty
+    :param cell_types: cell types that override the registry's, by slug, from
+        config by default
+    """
+    registry = config.EMBEDDING_MODEL_REGISTRY if registry is None else registry
+    selected = config.EMBEDDING_MODELS if selected is None else selected
+    cell_types = config.VESPA_EMBEDDING_CELL_TYPES if cell_types is None else cell_types
+
+    models = read_model_registry(registry)
+    for slug in list(selected) + list(cell_types):
+        if slug not in models:
+            raise config.ConfigError(
+                f"Unknown embedding model: {slug}, should be one of "
+                f"{', '.join(models)}"
+            )
+    # Every cell type override is checked, including those of unselected models
+    for slug, cell_type in cell_types.items():
+        if cell_type not in CELL_TYPES:
+            raise config.ConfigError(
+                f"Unknown cell type for embedding model {slug}: {cell_type}, "
+                f"should be one of {', '.join(CELL_TYPES)}"
+            )
+
+    models = {
+        slug: model._replace(cell_type=cell_types.get(slug, model.cell_type))
+        for slug, model in models.items()
+        if not selected or slug in selected
+    }
+    fields = [model.field for model in models.values()]
+    if len(set(fields)) != len(fields):
+        raise config.ConfigError(
+            f"Embedding models should each feed a different field, got: {fields}"
+        )
+    for model in models.values():
+        if model.cell_type not in CELL_TYPES:
+            raise config.ConfigError(
+                f"Unknown cell type for embedding model {model.slug}: "
+                f"{model.cell_type}, should be one of {', '.join(CELL_TYPES)}"
+            )
+    return models
@@ -0,0 +1,97 @@
+import json
+import logging
+from pathlib import Path
+import random
+import threading
+from typing import NamedTuple, Union
+
+from cloudpathlib import S3Path
+from vespa.io import VespaResponse
+
+_LOGGER = logging.getLogger(__name__)
+
+# Throttling, server errors, and 599 for errors without a response such as timeouts
+# and dropped connections, are worth retrying. Anything else will fail again.
+RETRYABLE_STATUS_CODES = frozenset({429, 500, 502, 503, 504, 599})
+
+
+def is_retryable(status_code: int) -> bool:
+    return status_code in RETRYABLE_STATUS_CODES
+
+
+def retry_backoff(attempt: int, base: float, maximum: float) -> float:
+    """
+    Time to wait before retrying after the given failed attempt, counting from 1.
+
+    Uses full jitter, a random wait up to the capped exponential backoff, so
+    operations throttled together don't retry together.
+    """
+    return random.uniform(0, min(maximum, base * 2 ** (attempt - 1)))
+
+
+class FeedFailure(NamedTuple):
+    """A feed operation that failed permanently, or ran out of retries"""
+
+    schema: str
+    id: str
+    operation_type: str
+    status_code: int
+    attempts: int
+    message: str
+
+
+class FeedFailures:
+    """
+    Collects the feed operations of a run that failed, so the run can carry on.
+
+    Failures can be written to a dead-letter file of JSON lines once the run is
+    complete.
+    """
+
+    def __init__(self):
+        self._failures: list[FeedFailure] = []
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._failures)
+
+    @property
+    def failures(self) -> list[FeedFailure]:
+        with self._lock:
+            return list(self._failures)
+
+    def add(self, schema: str, id: str, response: VespaResponse, attempts: int) -> None:
+        failure = FeedFailure(
+            schema=schema,
+            id=id,
+            operation_type=response.operation_type,
+            status_code=response.status_code,
+            attempts=attempts,
+            message=json.dumps(response.json),
+        )
+        _LOGGER.error(
+            f"Feed operation failed on document with id: {id}",
+            extra={"props": failure._asdict()},
+        )
+        with self._lock:
+            self._failures.append(failure)
+
+    def log_report(self) -> None:
+        """Log a summary of the failures by schema and status code."""
+        counts: dict[str, int] = {}
+        for failure in self.failures:
+            key = f"{failure.schema}:{failure.status_code}"
+            counts[key] = counts.get(key, 0) + 1
+        if counts:
+            _LOGGER.error(
+                f"{len(self)} feed operations failed", extra={"props": counts}
+            )
+        else:
+            _LOGGER.info("No feed operations failed")
+
+    def write_dead_letter(self, dead_letter_path: Union[Path, S3Path]) -> None:
+        """Write every failure as a line of JSON."""
+        dead_letter_path.write_text(
+            "".join(json.dumps(failure._asdict()) + "\n" for failure in self.failures)
+        )
+        _LOGGER.info(f"Wrote {len(self)} failed operations to {dead_letter_path}")
@@ -0,0 +1,103 @@
+import gzip
+import io
+import json
+import logging
+from pathlib import Path
+from typing import IO, Optional, Union
+
+from cloudpathlib import S3Path
+
+_LOGGER = logging.getLogger(__name__)
+
+FEED_FILE_PREFIX = "feed-"
+
+
+class FeedFileWriter:
+    """
+    Write feed operations to Vespa JSON lines feed files, as read by vespa-feed-client.
+
+    Operations are split across numbered files of roughly equal size, optionally
+    gzipped. A new file is only started between documents, at `start_document`,
+    so a document's operations are always fed from one file, in order.
+    """
+
+    def __init__(
+        self,
+        output_dir: Union[Path, S3Path],
+        namespace: str,
+        operations_per_file: int,
+        compress: bool = False,
+    ):
+        self.output_dir = output_dir
+        self.namespace = namespace
+        self.operations_per_file = max(operations_per_file, 1)
+        self.compress = compress
+        self.paths: list[Union[Path, S3Path]] = []
+        self.operation_counts: dict[str, int] = {"put": 0, "remove": 0}
+        self._raw: Optional[IO[bytes]] = None
+        self._file: Optional[IO[str]] = None
+        self._file_operations = 0
+
+    def __enter__(self) -> "FeedFileWriter":
+        if isinstance(self.output_dir, Path):
+            self.output_dir.mkdir(parents=True, exist_ok=True)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._close()
+        _LOGGER.info(
+            f"Wrote {sum(self.operation_counts.values())} feed operations to "
+            f"{len(self.paths)} files in {self.output_dir}",
+            extra={"props": self.operation_counts},
+        )
+
+    def _close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+        if self._raw is not None:
+            self._raw.close()
+        self._file = None
+        self._raw = None
+
+    def _open_next(self) -> None:
+        self._close()
+        suffix = ".jsonl.gz" if self.compress else ".jsonl"
+        path = self.output_dir / f"{FEED_FILE_PREFIX}{len(self.paths):05d}{suffix}"
+        self._raw = path.open("wb")
+        self._file = io.TextIOWrapper(
+            gzip.GzipFile(fileobj=self._raw, mode="wb") if self.compress else self._raw,
+            encoding="utf-8",
+        )
+        self._file_operations = 0
+        self.paths.append(path)
+
+    def start_document(self) -> None:
+        """Mark a boundary between documents, where a new file may be started."""
+        if self._file is not None and self._file_operations >= self.operations_per_file:
+            self._close()
+
+    def _write(self, operation: dict) -> None:
+        if self._file is None:
+            self._open_next()
+        assert self._file is not None
+        self._file.write(json.dumps(operation) + "\n")
+        self._file_operations += 1
+
+    def put(self, schema: str, document_id: str, fields: dict) -> None:
+        self._write(
+            {"put": f"id:{self.namespace}:{schema}::{document_id}", "fields": fields}
+        )
+        self.operation_counts["put"] += 1
+
+    def remove(self, schema: str, document_id: str) -> None:
+        self._write({"remove": f"id:{self.namespace}:{schema}::{document_id}"})
+        self.operation_counts["remove"] += 1
+
+
+def read_feed_file(path: Union[Path, S3Path]) -> list[dict]:
+    """The operations in a feed file written by FeedFileWriter."""
+    with path.open("rb") as raw:
+        data = raw.read()
+    if path.name.endswith(".gz"):
+        data = gzip.decompress(data)
+    return [json.loads(line) for line in data.decode("utf-8").splitlines() if line]
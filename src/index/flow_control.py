@@ -0,0 +1,111 @@
+import logging
+import threading
+import time
+from typing import Optional
+
+from src import config
+
+_LOGGER = logging.getLogger(__name__)
+
+THROTTLED_STATUS_CODES = frozenset({429, 503})
+
+
+class AdaptiveFlowController:
+    """
+    Additive increase, multiplicative decrease control of in-flight feed operations.
+
+    The limit grows by one for each window of successful operations that complete
+    within the target latency, and is cut by the decrease factor when an
+    operation is throttled or is slower than the target. Cuts happen at most
+    once per cooldown so a burst of slow responses counts as one signal.
+    """
+
+    def __init__(
+        self,
+        initial: int,
+        minimum: int,
+        maximum: int,
+        target_latency: float,
+        decrease_factor: float = 0.5,
+        cooldown: float = 1.0,
+        max_pause: float = 60.0,
+    ):
+        self.minimum = max(minimum, 1)
+        self.maximum = max(maximum, self.minimum)
+        self.target_latency = target_latency
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+        self.max_pause = max_pause
+
+        self._limit = min(max(initial, self.minimum), self.maximum)
+        self._successes = 0
+        self._last_decrease = float("-inf")
+        self._throttled = 0
+        self._consecutive_throttled_pauses = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, maximum: Optional[int] = None) -> "AdaptiveFlowController":
+        """
+        :param maximum: the most operations ever in flight, the configured number
+            of connections by default
+        """
+        return cls(
+            initial=config.VESPA_INITIAL_IN_FLIGHT,
+            minimum=config.VESPA_MIN_IN_FLIGHT,
+            maximum=config.VESPA_CONNECTIONS if maximum is None else maximum,
+            target_latency=config.VESPA_TARGET_LATENCY,
+        )
+
+    @property
+    def limit(self) -> int:
+        """The number of operations currently allowed in flight."""
+        return self._limit
+
+    def record(self, latency: float, status_code: int) -> None:
+        """Adjust the limit from the outcome of a completed operation."""
+        throttled = status_code in THROTTLED_STATUS_CODES
+        with self._lock:
+            if throttled:
+                self._throttled += 1
+            if throttled or latency > self.target_latency:
+                now = time.monotonic()
+                if now - self._last_decrease >= self.cooldown:
+                    self._limit = max(
+                        self.minimum, int(self._limit * self.decrease_factor)
+                    )
+                    self._last_decrease = now
+                    self._successes = 0
+                    _LOGGER.info(
+                        f"Reduced in-flight feed operations to {self._limit}",
+                        extra={
+                            "props": {
+                                "latency": latency,
+                                "status_code": status_code,
+                            }
+                        },
+                    )
+                return
+
+            self._successes += 1
+            if self._successes >= self._limit and self._limit < self.maximum:
+                self._limit += 1
+                self._successes = 0
+
+    def pause(self) -> float:
+        """
+        Time to wait before feeding the next batch.
+
+        This is zero unless operations were throttled since the last pause, then
+        it doubles with each consecutive throttled batch up to the max pause.
+        """
+        with self._lock:
+            throttled, self._throttled = self._throttled, 0
+            if not throttled:
+                self._consecutive_throttled_pauses = 0
+                return 0.0
+            self._consecutive_throttled_pauses += 1
+            return min(
+                self.max_pause,
+                self.cooldown * 2 ** (self._consecutive_throttled_pauses - 1),
+            )
@@ -0,0 +1,131 @@
+import logging
+from typing import Mapping, NamedTuple
+
+import numpy as np
+
+from src.metrics import PipelineMetrics
+
+_LOGGER = logging.getLogger(__name__)
+
+# Cell types of Vespa dense tensor fields that embeddings can be fed as
+CELL_TYPES = ("float", "bfloat16", "int8")
+
+
+class QuantizationError(NamedTuple):
+    """How closely a matrix of quantized embeddings matches the original"""
+
+    vectors: int
+    # Sums over the vectors, of the cosine similarity of each quantized vector to
+    # its original and of the norm of the difference relative to the original's
+    cosine_similarity_sum: float
+    relative_error_sum: float
+
+
+def quantize(embeddings: np.ndarray, cell_type: str, int8_scale: float) -> np.ndarray:
+    """
+    Convert embeddings to the cells of a Vespa tensor field of the cell type.
+
+    bfloat16 cells are returned as their 16 bit patterns, rounded to nearest
+    even from float32. int8 cells are the embeddings multiplied by the scale,
+    rounded and clipped, so queries against them must be scaled the same way.
+    """
+    embeddings = embeddings.astype(np.float32, copy=False)
+    if cell_type == "float":
+        return embeddings
+    if cell_type == "bfloat16":
+        bits = embeddings.view(np.uint32)
+        rounding_bias = np.uint32(0x7FFF) + ((bits >> 16) & 1)
+        return ((bits + rounding_bias) >> 16).astype(np.uint16)
+    if cell_type == "int8":
+        return np.clip(np.rint(embeddings * int8_scale), -128, 127).astype(np.int8)
+    raise ValueError(f"Unknown cell type: {cell_type}")
+
+
+def dequantize(cells: np.ndarray, cell_type: str, int8_scale: float) -> np.ndarray:
+    """The float32 values represented by cells from `quantize`."""
+    if cell_type == "float":
+        return cells
+    if cell_type == "bfloat16":
+        return (cells.astype(np.uint32) << 16).view(np.float32)
+    if cell_type == "int8":
+        return cells.astype(np.float32) / int8_scale
+    raise ValueError(f"Unknown cell type: {cell_type}")
+
+
+def quantization_error(
+    embeddings: np.ndarray, dequantized: np.ndarray
+) -> QuantizationError:
+    """Compare dequantized embeddings to the originals, row by row."""
+    embeddings = embeddings.astype(np.float32, copy=False)
+    norms = np.linalg.norm(embeddings, axis=1)
+    dequantized_norms = np.linalg.norm(dequantized, axis=1)
+    dots = np.einsum("ij,ij->i", embeddings, dequantized)
+    error_norms = np.linalg.norm(embeddings - dequantized, axis=1)
+
+    # Zero vectors count as exactly reproduced
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cosine_similarities = np.where(
+            (norms > 0) & (dequantized_norms > 0),
+            dots / (norms * dequantized_norms),
+            1.0,
+        )
+        relative_errors = np.where(norms > 0, error_norms / norms, 0.0)
+    return QuantizationError(
+        vectors=len(embeddings),
+        cosine_similarity_sum=float(cosine_similarities.sum()),
+        relative_error_sum=float(relative_errors.sum()),
+    )
+
+
+def record_quantization_errors(
+    metrics: PipelineMetrics, errors: Mapping[str, QuantizationError]
+) -> None:
+    for model_slug, error in errors.items():
+        metrics.increment("quantized_embeddings", error.vectors, model=model_slug)
+        metrics.increment(
+            "quantization_cosine_similarity_sum",
+            error.cosine_similarity_sum,
+            model=model_slug,
+        )
+        metrics.increment(
+            "quantization_relative_error_sum",
+            error.relative_error_sum,
+            model=model_slug,
+        )
+
+
+def quantization_report(
+    metrics: PipelineMetrics, cell_types: Mapping[str, str]
+) -> dict[str, dict]:
+    """The mean quantization error of each quantized model over the run."""
+    report = {}
+    for model_slug, cell_type in sorted(cell_types.items()):
+        vectors = metrics.counter("quantized_embeddings", model=model_slug)
+        if not vectors:
+            continue
+        report[model_slug] = {
+            "cell_type": cell_type,
+            "vectors": int(vectors),
+            "mean_cosine_similarity": metrics.counter(
+                "quantization_cosine_similarity_sum", model=model_slug
+            )
+            / vectors,
+            "mean_relative_error": metrics.counter(
+                "quantization_relative_error_sum", model=model_slug
+            )
+            / vectors,
+        }
+    return report
+
+
+def log_quantization_report(
+    metrics: PipelineMetrics, cell_types: Mapping[str, str]
+) -> None:
+    for model_slug, summary in quantization_report(metrics, cell_types).items():
+        _LOGGER.info(
+            f"Quantized {summary['vectors']} {model_slug} embeddings to "
+            f"{summary['cell_type']}, mean cosine similarity "
+            f"{summary['mean_cosine_similarity']:.6f}, mean relative error "
+            f"{summary['mean_relative_error']:.6f}",
+            extra={"props": {"model": model_slug, **summary}},
+        )
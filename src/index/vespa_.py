@@ -1,36 +1,100 @@
-from collections import defaultdict
+import asyncio
+from collections import defaultdict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import (
+    AsyncExitStack,
+    ExitStack,
+    closing,
+    contextmanager,
+    nullcontext,
+)
+from functools import partial
+import hashlib
+import itertools
+import json
 import logging
+import multiprocessing
 from pathlib import Path
+from queue import Full, Queue
+import signal
+import threading
 from typing import (
+    AbstractSet,
     Annotated,
+    Any,
+    Callable,
+    Coroutine,
     Generator,
+    Iterable,
     Mapping,
+    NamedTuple,
     NewType,
     Optional,
     Sequence,
+    Sized,
     Tuple,
+    TypeVar,
     Union,
-    cast,
 )
 import time
 
+import aiohttp
 from cloudpathlib import S3Path
-from cpr_data_access.parser_models import ParserOutput, PDFTextBlock, VerticalFlipError
-from pydantic import BaseModel, Field
-from tenacity import (
-    retry,
-    wait_exponential,
-    stop_after_attempt,
+from cpr_data_access.parser_models import (
+    BlockType,
+    ParserOutput,
+    PDFTextBlock,
+    VerticalFlipError,
 )
-from vespa.application import Vespa
-from vespa.io import VespaResponse
+import numpy as np
+from pydantic import BaseModel, ConfigDict, Field
+from requests.adapters import HTTPAdapter
+from vespa.application import Vespa, VespaAsync, VespaSync
+from vespa.io import VespaQueryResponse, VespaResponse
 
 
 from src import config
-from src.utils import filter_on_block_type, read_npy_file, get_text_from_text_block
+from src.index.deduplication import DEDUPLICATION_MODES, find_duplicate_passages
+from src.index.embedding_models import EmbeddingModel, get_embedding_models
+from src.index.failures import FeedFailures, is_retryable, retry_backoff
+from src.index.feed_files import FeedFileWriter
+from src.index.flow_control import AdaptiveFlowController
+from src.index.quantization import (
+    QuantizationError,
+    dequantize,
+    log_quantization_report,
+    quantization_error,
+    quantize,
+    record_quantization_errors,
+)
+from src.metrics import metrics
+from src.manifest import (
+    IndexCheckpoint,
+    IndexManifest,
+    PER_DOCUMENT_LISTING_MAX,
+    PassageState,
+    get_document_fingerprint,
+    list_file_fingerprints,
+    read_checkpoint,
+    read_manifest,
+    read_passage_state,
+    write_checkpoint,
+    write_manifest,
+    write_passage_state,
+)
+from src.utils import (
+    EMBEDDING_LAYOUTS,
+    DocumentInputs,
+    build_text_block_windows,
+    compile_block_types,
+    filter_on_block_type,
+    get_text_from_text_block,
+    prefetch_document_inputs,
+)
 
 
 _LOGGER = logging.getLogger(__name__)
+T = TypeVar("T")
 SchemaName = NewType("SchemaName", str)
 DocumentID = NewType("DocumentID", str)
 Coord = tuple[float, float]
@@ -43,6 +107,10 @@ _SCHEMAS_TO_PROCESS = [
     FAMILY_DOCUMENT_SCHEMA,
     DOCUMENT_PASSAGE_SCHEMA,
 ]
+# Schemas of documents that are referenced by documents of other schemas
+_REFERENCED_SCHEMAS = frozenset({SEARCH_WEIGHTS_SCHEMA, FAMILY_DOCUMENT_SCHEMA})
+# Big-endian dtypes of each cell type in Vespa's hex encoded tensor short form
+_HEX_CELL_DTYPES = {"float": ">f4", "bfloat16": ">u2", "int8": "i1"}
 # TODO: no need to parameterise now, but namespaces
 # may be useful for some data separation labels later
 _NAMESPACE = "doc_search"
@@ -68,8 +136,25 @@ class VespaSearchWeights(BaseModel):
     passage_weight: float
 
 
+class VespaHexTensor(BaseModel):
+    """Dense tensor cell values in Vespa's hex encoded short form"""
+
+    values: str
+
+
+# int8 cells are fed as a list of ints
+Embedding = Union[list[int], list[float], VespaHexTensor]
+
+
 class VespaDocumentPassage(BaseModel):
-    """Document passage representation for search"""
+    """
+    Document passage representation for search
+
+    Passages also have an embedding field for each selected embedding model,
+    named in the model registry, see `get_embedding_models`.
+    """
+
+    model_config = ConfigDict(extra="allow")
 
     search_weights_ref: str
     family_document_ref: str
@@ -79,10 +164,6 @@ class VespaDocumentPassage(BaseModel):
     text_block_type: str
     text_block_page: Optional[Annotated[int, Field(ge=0)]] = None
     text_block_coords: Optional[TextCoords] = None
-    text_embedding_bge_small: Annotated[list[float], 384]
-    text_embedding_bge_base: Annotated[list[float], 768]
-    text_embedding_distilbert_base_tas_b: Annotated[list[float], 768]
-    text_embedding_distilbert_dot_v5: Annotated[list[float], 768]
 
 
 class VespaFamilyDocument(BaseModel):
@@ -93,9 +174,10 @@ class VespaFamilyDocument(BaseModel):
     family_name_index: str
     family_description: str
     family_description_index: str
-    family_description_embedding: Annotated[
-        list[float], 768
-    ]  # TODO: not yet enforced by pydantic
+    # Left out of the fed fields when the description's model isn't selected
+    family_description_embedding: Optional[
+        Annotated[Embedding, 768]
+    ] = None  # TODO: not yet enforced by pydantic
     family_import_id: str
     family_slug: str
     family_publication_ts: str
@@ -112,18 +194,131 @@ class VespaFamilyDocument(BaseModel):
     document_source_url: Optional[str] = None
 
 
+def encode_embeddings(
+    embeddings: np.ndarray, cell_type: str = "float"
+) -> list[Union[list[float], dict]]:
+    """
+    Encode each row of an embeddings matrix for a Vespa tensor field.
+
+    Embeddings are quantized to the cell type of the field first, see
+    `quantize`.
+    """
+    return encode_cells(
+        quantize(embeddings, cell_type, config.VESPA_EMBEDDING_INT8_SCALE), cell_type
+    )
+
+
+def encode_cells(cells: np.ndarray, cell_type: str = "float") -> list:
+    """
+    Encode each row of a matrix of tensor cells from `quantize`.
+
+    Uses the configured encoding, either a list of values or the hex encoded
+    short form, which is written straight from the big-endian cell values and
+    is around a third of the size of the list once serialised for float cells,
+    and smaller again for bfloat16 and int8 cells.
+    """
+    if config.VESPA_EMBEDDING_ENCODING == "hex":
+        cell_dtype = np.dtype(_HEX_CELL_DTYPES[cell_type])
+        hex_values = cells.astype(cell_dtype, copy=False).tobytes().hex().upper()
+        row_length = cells.shape[1] * cell_dtype.itemsize * 2
+        return [
+            {"values": hex_values[start : start + row_length]}
+            for start in range(0, len(hex_values), row_length)
+        ]
+    if config.VESPA_EMBEDDING_ENCODING == "list":
+        if cell_type == "bfloat16":
+            return dequantize(
+                cells, cell_type, config.VESPA_EMBEDDING_INT8_SCALE
+            ).tolist()
+        return cells.tolist()
+    raise VespaConfigError(
+        "Unknown embedding encoding configured with environment variable "
+        f"'VESPA_EMBEDDING_ENCODING': {config.VESPA_EMBEDDING_ENCODING}"
+    )
+
+
+def encode_embedding(
+    embedding: np.ndarray, cell_type: str = "float"
+) -> Union[list[float], dict]:
+    """Encode a single embedding for a Vespa tensor field."""
+    return encode_embeddings(embedding[np.newaxis, :], cell_type)[0]
+
+
+def validate_embedding_models() -> dict[str, EmbeddingModel]:
+    """
+    Check the configured embedding models, and that those used for more than
+    passage embeddings are selected.
+
+    :return: the selected embedding models, by slug
+    """
+    models = get_embedding_models()
+    if (
+        config.PASSAGE_DEDUPLICATION == "near"
+        and config.PASSAGE_NEAR_DUPLICATE_MODEL not in models
+    ):
+        raise VespaConfigError(
+            "Near duplicate passages are found with a model that isn't selected, "
+            "configured with environment variable 'PASSAGE_NEAR_DUPLICATE_MODEL': "
+            f"{config.PASSAGE_NEAR_DUPLICATE_MODEL}"
+        )
+    if config.FAMILY_DESCRIPTION_EMBEDDING_MODEL not in models:
+        _LOGGER.warning(
+            "Family description embeddings won't be fed, their model isn't "
+            f"selected: {config.FAMILY_DESCRIPTION_EMBEDDING_MODEL}"
+        )
+    return models
+
+
+def validate_embeddings(
+    document_id: str,
+    embeddings_by_model_slug: Mapping[str, np.ndarray],
+    models: Optional[Mapping[str, EmbeddingModel]] = None,
+) -> None:
+    """
+    Check the embeddings for every model have the expected dimension and dtype.
+
+    This validates a whole document's embeddings at once, in place of validating
+    each passage's embeddings with pydantic.
+
+    :param models: the models to check embeddings for, the selected embedding
+        models by default
+    """
+    if models is None:
+        models = get_embedding_models()
+    for model_slug, model in models.items():
+        embeddings = embeddings_by_model_slug[model_slug]
+        if embeddings.ndim != 2 or embeddings.shape[1] != model.dimension:
+            raise VespaIndexError(
+                f"Embeddings for {document_id} from {model_slug} should have "
+                f"shape (n, {model.dimension}), got: {embeddings.shape}"
+            )
+        if not np.issubdtype(embeddings.dtype, np.floating):
+            raise VespaIndexError(
+                f"Embeddings for {document_id} from {model_slug} should be "
+                f"floating point, got: {embeddings.dtype}"
+            )
+
+
 def build_vespa_family_document(
     task,
     embeddings,
     search_weights_ref,
 ) -> VespaFamilyDocument:
+    """
+    Build a family document.
+
+    :param embeddings: embeddings of the document, of which the first is of its
+        description, or None to leave out the description embedding
+    """
     return VespaFamilyDocument(
         search_weights_ref=search_weights_ref,
         family_name=task.document_name,
         family_name_index=task.document_name,
         family_description=task.document_description,
         family_description_index=task.document_description,
-        family_description_embedding=embeddings[0].tolist(),
+        family_description_embedding=(
+            encode_embedding(embeddings[0]) if embeddings is not None else None
+        ),
         family_import_id=task.document_metadata.family_import_id,
         family_slug=task.document_metadata.family_slug,
         family_publication_ts=task.document_metadata.publication_ts.isoformat(),
@@ -146,16 +341,25 @@ def build_vespa_document_passage(
     search_weights_ref,
     text_block,
     text_block_window: str,
-    embedding_bge_small,
-    embedding_bge_base,
-    embedding_distilbert_tas_b,
-    embedding_distilbert_dot_v5,
+    embeddings: Mapping[str, np.ndarray],
+    text: Optional[str] = None,
+    models: Optional[Mapping[str, EmbeddingModel]] = None,
 ) -> VespaDocumentPassage:
+    """
+    Build and validate a document passage.
+
+    :param embeddings: the passage's embedding from each model, by model slug
+    :param text: the text of the text block, if already extracted
+    :param models: the models whose embeddings are fed, each quantized to the
+        model's cell type, the selected embedding models by default
+    """
+    if models is None:
+        models = get_embedding_models()
     fam_doc_ref = f"id:{_NAMESPACE}:family_document::{family_document_id}"
     return VespaDocumentPassage(
         family_document_ref=fam_doc_ref,
         search_weights_ref=search_weights_ref,
-        text_block=get_text_from_text_block(text_block),
+        text_block=text if text is not None else get_text_from_text_block(text_block),
         text_block_window=text_block_window,
         text_block_id=text_block.text_block_id,
         text_block_type=str(text_block.type),
@@ -165,37 +369,88 @@ def build_vespa_document_passage(
         text_block_coords=(
             text_block.coords if isinstance(text_block, PDFTextBlock) else None
         ),
-        text_embedding_bge_small=embedding_bge_small.tolist(),
-        text_embedding_bge_base=embedding_bge_base.tolist(),
-        text_embedding_distilbert_base_tas_b=embedding_distilbert_tas_b.tolist(),
-        text_embedding_distilbert_dot_v5=embedding_distilbert_dot_v5.tolist(),
+        **{
+            model.field: encode_embedding(embeddings[model_slug], model.cell_type)
+            for model_slug, model in models.items()
+        },
     )
 
 
+def build_vespa_document_passage_fields(
+    family_document_id,
+    search_weights_ref,
+    text_block,
+    text_block_window: str,
+    embeddings: Mapping[str, Any],
+    text: Optional[str] = None,
+    models: Optional[Mapping[str, EmbeddingModel]] = None,
+) -> dict:
+    """
+    Build the fields for a document passage without validating them.
+
+    Produces the same fields as `build_vespa_document_passage(...).model_dump()`,
+    but expects embeddings already encoded with `encode_embeddings`, which have
+    been checked for a whole document with `validate_embeddings`.
+
+    :param models: the models whose embeddings are fed, the selected embedding
+        models by default
+    """
+    if models is None:
+        models = get_embedding_models()
+    is_pdf_block = isinstance(text_block, PDFTextBlock)
+    fields = {
+        "search_weights_ref": search_weights_ref,
+        "family_document_ref": (
+            f"id:{_NAMESPACE}:family_document::{family_document_id}"
+        ),
+        "text_block": (
+            text if text is not None else get_text_from_text_block(text_block)
+        ),
+        "text_block_window": text_block_window,
+        "text_block_id": text_block.text_block_id,
+        "text_block_type": str(text_block.type),
+        "text_block_page": text_block.page_number if is_pdf_block else None,
+        "text_block_coords": (
+            [(float(x), float(y)) for x, y in text_block.coords]
+            if is_pdf_block
+            else None
+        ),
+    }
+    for model_slug, model in models.items():
+        fields[model.field] = embeddings[model_slug]
+    return fields
+
+
 def get_existing_passage_ids(
-    vespa: Vespa, family_doc_id: DocumentID, offset: int = 0
+    vespa: Union[Vespa, VespaSync, "AsyncVespaFeeder"],
+    family_doc_id: DocumentID,
+    offset: int = 0,
 ) -> list[str]:
     """
     Retrieves all text blocks associated with a document
 
     In vespa terminology this means all document_passages for a given family_document
+
+    Passing an open `VespaSync` session, or an `AsyncVespaFeeder`, reuses its
+    pooled connections.
     """
     vespa_family_doc_id = f"id:{_NAMESPACE}:family_document::{family_doc_id}"
     max_hits = 5000
 
     existing_ids = []
-    response = vespa.query(
-        body={
-            "yql": """
+    with metrics.time("existing_ids_query"):
+        response = vespa.query(
+            body={
+                "yql": """
                 select documentid from sources document_passage
                 where family_document_ref contains phrase(@family_doc_id)
             """,
-            "family_doc_id": vespa_family_doc_id,
-            "hits": max_hits,
-            "offset": offset,
-            "queryProfile": "default",
-        },
-    )
+                "family_doc_id": vespa_family_doc_id,
+                "hits": max_hits,
+                "offset": offset,
+                "queryProfile": "default",
+            },
+        )
     for hit in response.hits:
         passage_id = hit["id"].split("::")[-1]
         existing_ids.append(passage_id)
@@ -214,28 +469,449 @@ def determine_stray_ids(
     return list(set(existing_doc_passage_ids) - set(new_passage_ids))
 
 
-def remove_ids(vespa: Vespa, stray_ids: list[str]):
+def remove_ids(vespa: Union[Vespa, "VespaFeeder"], stray_ids: list[str]):
+    """
+    Delete passages from Vespa.
+
+    Through a `VespaFeeder`, the deletes are submitted to be fed alongside the
+    rest of the run's operations rather than waited for, and are limited,
+    retried and recorded as failed like any other operation. Otherwise they are
+    fed on a new session, raising a VespaIndexError if any fail.
+    """
     _LOGGER.critical(f"Removing stray ids following doc changes: {stray_ids}")
-    for stray_id in stray_ids:
-        vespa.delete_data(
-            schema=DOCUMENT_PASSAGE_SCHEMA, data_id=stray_id, namespace=_NAMESPACE
+    metrics.increment("passages_deleted", len(stray_ids))
+    if isinstance(vespa, VespaFeeder):
+        for stray_id in stray_ids:
+            vespa.submit(DOCUMENT_PASSAGE_SCHEMA, {"id": stray_id}, "delete")
+        return
+    controller = AdaptiveFlowController.from_config()
+    with feed_session(vespa, controller.maximum) as session:
+        feed_documents(
+            session,
+            DOCUMENT_PASSAGE_SCHEMA,
+            [{"id": stray_id} for stray_id in stray_ids],
+            controller,
+            operation_type="delete",
+        )
+
+
+class PreparedDocument(NamedTuple):
+    """A family document and its passages, ready to be fed into Vespa."""
+
+    family_document_id: DocumentID
+    family_document: dict
+    passages: list[Tuple[DocumentID, dict]]
+    passage_digests: Optional[dict[DocumentID, str]] = None
+    # Time taken by each stage of preparation, recorded by the consuming process
+    stage_seconds: Optional[dict[str, float]] = None
+    # Number of passages left out as duplicates of others in the document
+    suppressed_passages: int = 0
+    # Number of text blocks filtered out, by block type
+    removed_blocks: Optional[dict[str, int]] = None
+    # Error of the passage embeddings quantized for each model, by model slug
+    quantization_errors: Optional[dict[str, QuantizationError]] = None
+
+
+def passage_digest(fields: dict) -> str:
+    """A stable hash of a document passage's fields, to detect changed passages."""
+    serialised = json.dumps(fields, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(serialised.encode()).hexdigest()
+
+
+def prepare_document(
+    inputs: DocumentInputs,
+    search_weights_ref: str,
+    compute_digests: bool = False,
+    blocks_to_filter: Optional[AbstractSet[BlockType]] = None,
+    models: Optional[Mapping[str, EmbeddingModel]] = None,
+) -> PreparedDocument:
+    """
+    Build the Vespa family document and document passages for a single input file.
+
+    This does no I/O so that it can run in a worker process.
+
+    :param inputs: the parser output and embeddings read for the document
+    :param search_weights_ref: Vespa reference to the search weights document
+    :param compute_digests: whether to also hash the fields of every passage
+    :param blocks_to_filter: block types to remove, compiled from
+        `config.BLOCKS_TO_FILTER` by default
+    :param models: the models whose embeddings are fed, the selected embedding
+        models by default
+    :return PreparedDocument: the family document and its passages
+    """
+    if models is None:
+        models = get_embedding_models()
+    stage_seconds = {}
+    start = time.perf_counter()
+
+    def _stage(name: str):
+        nonlocal start
+        now = time.perf_counter()
+        stage_seconds[name] = now - start
+        start = now
+
+    task = ParserOutput.model_validate_json(inputs.parser_output_json)
+    _stage("validate_json")
+
+    if blocks_to_filter is None:
+        blocks_to_filter = compile_block_types(config.BLOCKS_TO_FILTER)
+    task, removed_blocks = filter_on_block_type(
+        input=task, remove_block_types=blocks_to_filter
+    )
+    _stage("filter_blocks")
+
+    embeddings_by_model_slug = inputs.embeddings
+
+    family_document_id = DocumentID(task.document_metadata.import_id)
+    # NOTE we don't use the document description embedding for RAG, so here we'll just use the model that we already use in product
+    family_document = build_vespa_family_document(
+        task,
+        (
+            embeddings_by_model_slug[config.FAMILY_DESCRIPTION_EMBEDDING_MODEL]
+            if config.FAMILY_DESCRIPTION_EMBEDDING_MODEL in models
+            else None
+        ),
+        search_weights_ref,
+    )
+
+    try:
+        text_blocks = task.vertically_flip_text_block_coords().get_text_blocks()
+    except VerticalFlipError:
+        _LOGGER.exception(
+            f"Error flipping text blocks for {task.document_id}, coordinates "
+            "will be incorrect for displayed passages"
+        )
+        text_blocks = task.get_text_blocks()
+    _stage("flip_coords")
+
+    block_texts = [get_text_from_text_block(text_block) for text_block in text_blocks]
+    text_block_windows = build_text_block_windows(
+        block_texts,
+        neighbours=config.PASSAGE_WINDOW_NEIGHBOURS,
+        max_chars=config.PASSAGE_WINDOW_MAX_CHARS,
+    )
+    _stage("build_windows")
+
+    # The whole document's embeddings are validated up front for either builder,
+    # as passages don't declare their embedding fields for pydantic to check
+    validate_embeddings(task.document_id, embeddings_by_model_slug, models)
+
+    # Near duplicates are found with the embeddings of the configured model
+    duplicates = None
+    if config.PASSAGE_DEDUPLICATION in ("exact", "near"):
+        duplicates = find_duplicate_passages(
+            block_texts,
+            embeddings=(
+                embeddings_by_model_slug[config.PASSAGE_NEAR_DUPLICATE_MODEL][
+                    1 : len(text_blocks) + 1
+                ]
+                if config.PASSAGE_DEDUPLICATION == "near"
+                else None
+            ),
+            threshold=config.PASSAGE_NEAR_DUPLICATE_THRESHOLD,
+        )
+        _stage("deduplicate_passages")
+    elif config.PASSAGE_DEDUPLICATION != "off":
+        raise VespaConfigError(
+            "Unknown passage deduplication configured with environment variable "
+            f"'PASSAGE_DEDUPLICATION': {config.PASSAGE_DEDUPLICATION}, should be "
+            f"one of {', '.join(DEDUPLICATION_MODES)}"
+        )
+
+    passages = []
+
+    # Quantize each model's passage embeddings in one go, keeping the cells to
+    # encode in fast mode. Note that the first embedding item is the doc
+    # description, the rest are text blocks
+    quantized_cells = {}
+    quantization_errors = {}
+    for model_slug, model in models.items():
+        if model.cell_type == "float":
+            continue
+        embeddings = embeddings_by_model_slug[model_slug][1 : len(text_blocks) + 1]
+        cells = quantize(embeddings, model.cell_type, config.VESPA_EMBEDDING_INT8_SCALE)
+        quantized_cells[model_slug] = cells
+        quantization_errors[model_slug] = quantization_error(
+            embeddings,
+            dequantize(cells, model.cell_type, config.VESPA_EMBEDDING_INT8_SCALE),
+        )
+    if quantized_cells:
+        _stage("quantize_embeddings")
+
+    fast_builder = config.PASSAGE_BUILDER_MODE == "fast"
+    if fast_builder:
+        passage_embeddings = {
+            model_slug: (
+                encode_cells(quantized_cells[model_slug], model.cell_type)
+                if model_slug in quantized_cells
+                else encode_embeddings(
+                    embeddings_by_model_slug[model_slug][1 : len(text_blocks) + 1]
+                )
+            )
+            for model_slug, model in models.items()
+        }
+    elif config.PASSAGE_BUILDER_MODE == "strict":
+        passage_embeddings = {
+            model_slug: embeddings_by_model_slug[model_slug][1:, :]
+            for model_slug in models
+        }
+    else:
+        raise VespaConfigError(
+            "Unknown passage builder mode configured with environment variable "
+            f"'PASSAGE_BUILDER_MODE': {config.PASSAGE_BUILDER_MODE}"
+        )
+
+    # Only text blocks with an embedding from every model become passages
+    passage_count = min(
+        [len(text_blocks)]
+        + [len(embeddings) for embeddings in passage_embeddings.values()]
+    )
+    for document_passage_idx, text_block in enumerate(text_blocks[:passage_count]):
+        if duplicates is not None and duplicates[document_passage_idx]:
+            continue
+        document_psg_id = DocumentID(f"{task.document_id}.{document_passage_idx}")
+        embeddings = {
+            model_slug: model_embeddings[document_passage_idx]
+            for model_slug, model_embeddings in passage_embeddings.items()
+        }
+
+        if fast_builder:
+            document_passage = build_vespa_document_passage_fields(
+                family_document_id,
+                search_weights_ref,
+                text_block,
+                text_block_windows[document_passage_idx],
+                embeddings,
+                text=block_texts[document_passage_idx],
+                models=models,
+            )
+        else:
+            document_passage = build_vespa_document_passage(
+                family_document_id,
+                search_weights_ref,
+                text_block,
+                text_block_windows[document_passage_idx],
+                embeddings,
+                text=block_texts[document_passage_idx],
+                models=models,
+            ).model_dump()
+        passages.append((document_psg_id, document_passage))
+    family_document_fields = family_document.model_dump()
+    if family_document.family_description_embedding is None:
+        del family_document_fields["family_description_embedding"]
+    _stage("build_passages")
+
+    passage_digests = None
+    if compute_digests:
+        passage_digests = {
+            document_psg_id: passage_digest(document_passage)
+            for document_psg_id, document_passage in passages
+        }
+        _stage("digest_passages")
+
+    return PreparedDocument(
+        family_document_id=family_document_id,
+        family_document=family_document_fields,
+        passages=passages,
+        passage_digests=passage_digests,
+        stage_seconds=stage_seconds,
+        suppressed_passages=int(duplicates.sum()) if duplicates is not None else 0,
+        removed_blocks=removed_blocks,
+        quantization_errors=quantization_errors or None,
+    )
+
+
+def _record_prepared(prepared: PreparedDocument) -> PreparedDocument:
+    for stage, seconds in (prepared.stage_seconds or {}).items():
+        metrics.observe(stage, seconds)
+    metrics.increment("documents_prepared")
+    metrics.increment("passages_prepared", len(prepared.passages))
+    if prepared.suppressed_passages:
+        metrics.increment("passages_suppressed", prepared.suppressed_passages)
+    if prepared.removed_blocks:
+        for block_type, count in prepared.removed_blocks.items():
+            metrics.increment("blocks_filtered", count, block_type=block_type)
+        _LOGGER.info(
+            f"Filtered {sum(prepared.removed_blocks.values())} blocks from "
+            f"{prepared.family_document_id}",
+            extra={
+                "props": {
+                    "document_id": prepared.family_document_id,
+                    "removed_blocks": prepared.removed_blocks,
+                }
+            },
         )
+    if prepared.quantization_errors:
+        record_quantization_errors(metrics, prepared.quantization_errors)
+    return prepared
+
+
+def _config_settings() -> dict[str, Any]:
+    return {name: value for name, value in vars(config).items() if name.isupper()}
+
+
+def _configure_worker(settings: Mapping[str, Any]) -> None:
+    for name, value in settings.items():
+        setattr(config, name, value)
+
+
+def prepare_documents(
+    document_inputs: Iterable[DocumentInputs],
+    search_weights_ref: str,
+    compute_digests: bool = False,
+    blocks_to_filter: Optional[AbstractSet[BlockType]] = None,
+    models: Optional[Mapping[str, EmbeddingModel]] = None,
+) -> Generator[PreparedDocument, None, None]:
+    """
+    Prepare documents in input order, optionally across a pool of processes.
+
+    With more than one configured worker, documents are submitted to a process
+    pool ahead of being consumed. The number of documents submitted but not yet
+    consumed is bounded so memory use doesn't grow with the size of the input.
+
+    :param document_inputs: the parser output and embeddings for each document
+    :param search_weights_ref: Vespa reference to the search weights document
+    :param compute_digests: whether to also hash the fields of every passage
+    :param blocks_to_filter: block types to remove, compiled from
+        `config.BLOCKS_TO_FILTER` by default
+    :param models: the models whose embeddings are fed, the selected embedding
+        models by default
+    :yield Generator[PreparedDocument, None, None]: prepared documents, in the
+        same order as their inputs.
+    """
+    if blocks_to_filter is None:
+        blocks_to_filter = compile_block_types(config.BLOCKS_TO_FILTER)
+    if models is None:
+        models = get_embedding_models()
+    workers = config.PREPARATION_WORKERS
+    if workers <= 1:
+        for inputs in document_inputs:
+            yield _record_prepared(
+                prepare_document(
+                    inputs,
+                    search_weights_ref,
+                    compute_digests,
+                    blocks_to_filter,
+                    models,
+                )
+            )
+        return
+
+    max_pending = workers * max(config.PREPARATION_QUEUE_PER_WORKER, 1)
+    _LOGGER.info(
+        f"Preparing documents with {workers} worker processes",
+        extra={"props": {"workers": workers, "max_pending": max_pending}},
+    )
+    # Workers are spawned rather than forked, as forking a process running other
+    # threads, such as the feeder's, can copy locks held by them into the child.
+    # Spawned workers import config afresh, so are given the settings in use here
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_configure_worker,
+        initargs=(_config_settings(),),
+    ) as executor:
+        pending: deque[Future] = deque()
+        for inputs in document_inputs:
+            pending.append(
+                executor.submit(
+                    prepare_document,
+                    inputs,
+                    search_weights_ref,
+                    compute_digests,
+                    blocks_to_filter,
+                    models,
+                )
+            )
+            if len(pending) >= max_pending:
+                yield _record_prepared(pending.popleft().result())
+        while pending:
+            yield _record_prepared(pending.popleft().result())
+
+
+def prefetch_existing_passage_ids(
+    vespa: Union[Vespa, "AsyncVespaFeeder"],
+    prepared_documents: Iterable[PreparedDocument],
+    lookahead: int,
+) -> Generator[Tuple[PreparedDocument, list[str]], None, None]:
+    """
+    Pair prepared documents with the ids of their passages already in Vespa.
+
+    Queries for the next `lookahead` documents run concurrently on a thread pool
+    sharing one pooled session, so the generator doesn't wait on each query in
+    turn.
+
+    :param vespa: the Vespa instance to query, or a feeder whose session is used
+    :param prepared_documents: the documents to look up existing passages for
+    :param lookahead: the maximum number of documents queried ahead of being
+        consumed, 0 queries for each document only when it is needed
+    :yield Generator[Tuple[PreparedDocument, list[str]], None, None]: each
+        document, in order, with its existing passage ids.
+    """
+    if lookahead < 1:
+        for prepared in prepared_documents:
+            yield prepared, get_existing_passage_ids(vespa, prepared.family_document_id)
+        return
+
+    session_context = (
+        nullcontext(vespa)
+        if isinstance(vespa, AsyncVespaFeeder)
+        else vespa.syncio(connections=lookahead)
+    )
+    with session_context as session, ThreadPoolExecutor(
+        max_workers=lookahead
+    ) as executor:
+        pending: deque[Tuple[PreparedDocument, Future]] = deque()
+        for prepared in prepared_documents:
+            pending.append(
+                (
+                    prepared,
+                    executor.submit(
+                        get_existing_passage_ids,
+                        session,
+                        prepared.family_document_id,
+                    ),
+                )
+            )
+            if len(pending) >= lookahead:
+                prepared, future = pending.popleft()
+                yield prepared, future.result()
+        while pending:
+            prepared, future = pending.popleft()
+            yield prepared, future.result()
 
 
 def get_document_generator(
-    vespa: Vespa,
-    paths: Sequence[Union[S3Path, Path]],
+    vespa: Optional[Union[Vespa, "AsyncVespaFeeder"]],
+    paths: Iterable[Union[S3Path, Path]],
     embedding_dir_as_path: Union[Path, S3Path],
+    passage_state: Optional[PassageState] = None,
+    remove_stray_ids: Optional[Callable[[list[str]], None]] = None,
+    models: Optional[Mapping[str, EmbeddingModel]] = None,
 ) -> Generator[Tuple[SchemaName, DocumentID, dict], None, None]:
     """
     Get generator for documents to index.
 
     Documents to index are those containing text passages and their embeddings.
+    Each family document is yielded before its passages.
+
+    Without a Vespa instance, existing passages aren't looked up, so every
+    passage is treated as new and no stray passages are removed. Given an
+    `AsyncVespaFeeder`, lookups and removals go through its session.
+
+    With a passage state, passages already in Vespa whose fields hash to the
+    digest recorded in the state are not yielded, and the state is updated with
+    the digests of every passage generated.
 
     :param namespace: the Vespa namespace into which these documents should be placed
     :param tasks: list of tasks from the embeddings generator
     :param embedding_dir_as_path: directory containing embeddings .npy files.
         These are named with IDs corresponding to the IDs in the tasks.
+    :param passage_state: digests of passages from previous runs
+    :param remove_stray_ids: called with the ids of passages in Vespa that are no
+        longer generated for their document, removes them from Vespa by default
+    :param models: the models whose embeddings are read and fed, the selected
+        embedding models by default
     :yield Generator[Tuple[SchemaName, DocumentID, dict], None, None]: generator of
         Vespa documents along with their schema and ID.
     """
@@ -248,124 +924,125 @@ def get_document_generator(
     )
     yield SEARCH_WEIGHTS_SCHEMA, search_weights_id, search_weights.model_dump()
 
+    blocks_to_filter = compile_block_types(config.BLOCKS_TO_FILTER)
     _LOGGER.info(
         "Filtering unwanted text block types.",
-        extra={"props": {"BLOCKS_TO_FILTER": config.BLOCKS_TO_FILTER}},
+        extra={
+            "props": {
+                "BLOCKS_TO_FILTER": sorted(
+                    block_type.value for block_type in blocks_to_filter
+                )
+            }
+        },
+    )
+
+    if models is None:
+        models = get_embedding_models()
+    _LOGGER.info(
+        "Feeding embeddings of the selected models.",
+        extra={
+            "props": {
+                "EMBEDDING_MODELS": {
+                    model_slug: model.field for model_slug, model in models.items()
+                }
+            }
+        },
     )
 
     search_weights_ref = f"id:{_NAMESPACE}:search_weights::{search_weights_id}"
     physical_document_count = 0
-    for path in paths:
-        task = ParserOutput.model_validate_json(path.read_text())
-
-        task = filter_on_block_type(
-            input=task, remove_block_types=config.BLOCKS_TO_FILTER
+    if config.EMBEDDING_LAYOUT not in EMBEDDING_LAYOUTS:
+        raise VespaConfigError(
+            "Unknown embedding layout configured with environment variable "
+            f"'EMBEDDING_LAYOUT': {config.EMBEDDING_LAYOUT}, should be one of "
+            f"{', '.join(EMBEDDING_LAYOUTS)}"
         )
-
-        embeddings_by_model_slug = dict()
-
-        for model_slug in [
-            "baai-bge-small-en-v1-5",
-            "baai-bge-base-en-v1-5",
-            "msmarco-distilbert-base-tas-b",
-            "msmarco-distilbert-dot-v5",
-        ]:
-            task_array_file_path = cast(
-                Path, embedding_dir_as_path / f"{task.document_id}__{model_slug}.npy"
-            )
-            embeddings_by_model_slug[model_slug] = read_npy_file(task_array_file_path)
-
-        family_document_id = DocumentID(task.document_metadata.import_id)
-        # NOTE we don't use the document description embedding for RAG, so here we'll just use the model that we already use in product
-        family_document = build_vespa_family_document(
-            task,
-            embeddings_by_model_slug["msmarco-distilbert-dot-v5"],
-            search_weights_ref,
+    document_inputs = prefetch_document_inputs(
+        paths,
+        embedding_dir_as_path,
+        model_slugs=list(models),
+        depth=config.PREFETCH_DEPTH,
+        max_bytes=config.PREFETCH_MAX_BYTES,
+        layout=config.EMBEDDING_LAYOUT,
+    )
+    prepared_inputs = prepare_documents(
+        document_inputs,
+        search_weights_ref,
+        compute_digests=passage_state is not None,
+        blocks_to_filter=blocks_to_filter,
+        models=models,
+    )
+    prepared_documents: Iterable[Tuple[PreparedDocument, list[str]]]
+    if vespa is None:
+        prepared_documents = ((document, []) for document in prepared_inputs)
+    else:
+        prepared_documents = prefetch_existing_passage_ids(
+            vespa, prepared_inputs, lookahead=config.VESPA_QUERY_LOOKAHEAD
         )
+    if remove_stray_ids is None and vespa is not None:
+        remove_stray_ids = partial(remove_ids, vespa)
+    for prepared, existing_doc_passage_ids in prepared_documents:
+        family_document_id = prepared.family_document_id
 
-        yield FAMILY_DOCUMENT_SCHEMA, family_document_id, family_document.model_dump()
+        yield FAMILY_DOCUMENT_SCHEMA, family_document_id, prepared.family_document
         physical_document_count += 1
         if (physical_document_count % 50) == 0:
             _LOGGER.info(
-                f"Document generator processing {physical_document_count} "
-                "physical documents"
-            )
-
-        try:
-            text_blocks = task.vertically_flip_text_block_coords().get_text_blocks()
-        except VerticalFlipError:
-            _LOGGER.exception(
-                f"Error flipping text blocks for {task.document_id}, coordinates "
-                "will be incorrect for displayed passages"
+                f"Document generator processing {physical_document_count}"
+                + (f" of {len(paths)}" if isinstance(paths, Sized) else "")
+                + " physical documents"
             )
-            text_blocks = task.get_text_blocks()
 
-        existing_doc_passage_ids = get_existing_passage_ids(vespa, family_document_id)
+        previous_digests = {}
+        if passage_state is not None:
+            previous_digests = passage_state.documents.get(family_document_id, {})
+        existing_passage_id_set = set(existing_doc_passage_ids)
 
         new_passage_ids = []
-
-        embeddings_baai_small = embeddings_by_model_slug["baai-bge-small-en-v1-5"]
-        embeddings_baai_base = embeddings_by_model_slug["baai-bge-base-en-v1-5"]
-        embeddings_distilbert_tas_b = embeddings_by_model_slug[
-            "msmarco-distilbert-base-tas-b"
-        ]
-        embeddings_distilbert_dot_v5 = embeddings_by_model_slug[
-            "msmarco-distilbert-dot-v5"
-        ]
-
-        # Note that the first embedding item is the doc description
-        # The rest are text blocks
-        for document_passage_idx, (
-            text_block,
-            embedding_baai_small,
-            embedding_baai_base,
-            embedding_distilbert_tas_b,
-            embedding_distilbert_dot_v5,
-        ) in enumerate(
-            zip(
-                text_blocks,
-                embeddings_baai_small[1:, :],
-                embeddings_baai_base[1:, :],
-                embeddings_distilbert_tas_b[1:, :],
-                embeddings_distilbert_dot_v5[1:, :],
-            )
-        ):
-            document_psg_id = DocumentID(f"{task.document_id}.{document_passage_idx}")
+        unchanged_passage_count = 0
+        for document_psg_id, document_passage in prepared.passages:
             new_passage_ids.append(document_psg_id)
-
-            if document_passage_idx == 0:
-                idxs_in_window = [document_passage_idx, document_passage_idx + 1]
-            elif document_passage_idx == len(text_blocks) - 1:
-                idxs_in_window = [document_passage_idx - 1, document_passage_idx]
-            else:
-                idxs_in_window = [
-                    document_passage_idx - 1,
-                    document_passage_idx,
-                    document_passage_idx + 1,
-                ]
-
-            text_block_window = "\n".join(
-                get_text_from_text_block(text_blocks[i]) for i in idxs_in_window
-            )
-
-            document_passage = build_vespa_document_passage(
-                family_document_id,
-                search_weights_ref,
-                text_block,
-                text_block_window,
-                embedding_bge_small=embedding_baai_small,
-                embedding_bge_base=embedding_baai_base,
-                embedding_distilbert_tas_b=embedding_distilbert_tas_b,
-                embedding_distilbert_dot_v5=embedding_distilbert_dot_v5,
-            )
-            yield DOCUMENT_PASSAGE_SCHEMA, document_psg_id, document_passage.model_dump()
+            if (
+                prepared.passage_digests is not None
+                and document_psg_id in existing_passage_id_set
+                and previous_digests.get(document_psg_id)
+                == prepared.passage_digests[document_psg_id]
+            ):
+                unchanged_passage_count += 1
+                continue
+            yield DOCUMENT_PASSAGE_SCHEMA, document_psg_id, document_passage
+
+        if passage_state is not None and prepared.passage_digests is not None:
+            passage_state.documents[family_document_id] = prepared.passage_digests
+            metrics.increment("passages_unchanged", unchanged_passage_count)
+            if unchanged_passage_count:
+                _LOGGER.info(
+                    f"Skipped {unchanged_passage_count} unchanged passages "
+                    f"for {family_document_id}"
+                )
         # Cleanup stray docs
         stray_ids = determine_stray_ids(existing_doc_passage_ids, new_passage_ids)
-        if stray_ids:
-            remove_ids(vespa, stray_ids)
+        if stray_ids and remove_stray_ids is not None:
+            remove_stray_ids(stray_ids)
 
     _LOGGER.info(
-        f"Document generator processed {physical_document_count} physical documents"
+        f"Document generator processed {physical_document_count} physical documents",
+        extra={
+            "props": {
+                "passages_suppressed": int(metrics.counter("passages_suppressed"))
+            }
+        },
+    )
+    removed_blocks = {
+        block_type.value: int(
+            metrics.counter("blocks_filtered", block_type=block_type.value)
+        )
+        for block_type in sorted(blocks_to_filter, key=lambda b: b.value)
+    }
+    _LOGGER.info(
+        f"Filtered {sum(removed_blocks.values())} blocks from "
+        f"{physical_document_count} physical documents",
+        extra={"props": {"removed_blocks": removed_blocks}},
     )
 
 
@@ -427,6 +1104,24 @@ def _get_vespa_instance() -> Vespa:
     )
 
 
+@contextmanager
+def feed_session(vespa: Vespa, connections: int) -> Generator[VespaSync, None, None]:
+    """
+    Open a session for feeding, on which requests are never retried.
+
+    pyvespa's sessions retry throttled and failed requests themselves, which
+    would hide them from the flow controller and multiply the feeder's own
+    attempts, so failed operations are only retried by the feeder.
+    """
+    with vespa.syncio(connections=connections) as session:
+        adapter = HTTPAdapter(
+            max_retries=0, pool_connections=connections, pool_maxsize=connections
+        )
+        session.http_session.mount("https://", adapter)
+        session.http_session.mount("http://", adapter)
+        yield session
+
+
 def _handle_feed_error(response: VespaResponse, id: str) -> None:
     """Callback for vespa feed"""
     if not response.is_successful():
@@ -435,49 +1130,717 @@ def _handle_feed_error(response: VespaResponse, id: str) -> None:
         )
 
 
-@retry(wait=wait_exponential(multiplier=10), stop=stop_after_attempt(10))
-def _batch_ingest(vespa: Vespa, to_process: Mapping[SchemaName, list]):
-    for schema in _SCHEMAS_TO_PROCESS:
-        documents = to_process[schema]
-        if documents:
-            _LOGGER.info(f"Processing {schema}, with {len(documents)} documents")
-            vespa.feed_iterable(
-                iter=documents,
-                schema=str(schema),
-                namespace=_NAMESPACE,
-                callback=_handle_feed_error,
-                max_queue_size=(config.VESPA_DOCUMENT_BATCH_SIZE + 1),
-                max_connections=config.VESPA_CONNECTIONS,
+def _error_status_code(error: Optional[BaseException]) -> int:
+    """Find the HTTP status code behind an error raised by a pyvespa session."""
+    while error is not None:
+        response = getattr(error, "response", None)
+        if response is not None:
+            return response.status_code
+        # aiohttp errors from the asyncio session carry the status themselves
+        status = getattr(error, "status", None)
+        if isinstance(status, int):
+            return status
+        error = error.__cause__
+    return 599
+
+
+def _feed_operation(
+    session: VespaSync, schema: SchemaName, document: dict, operation_type: str
+) -> VespaResponse:
+    try:
+        if operation_type == "delete":
+            return session.delete_data(
+                schema=str(schema), data_id=document["id"], namespace=_NAMESPACE
             )
+        return session.feed_data_point(
+            schema=str(schema),
+            data_id=document["id"],
+            fields=document["fields"],
+            namespace=_NAMESPACE,
+        )
+    except Exception as e:
+        return VespaResponse(
+            json={"id": document["id"], "message": str(e)},
+            status_code=_error_status_code(e),
+            url="n/a",
+            operation_type=operation_type,
+        )
 
 
-def populate_vespa(
-    paths: Sequence[Union[Path, S3Path]],
-    embedding_dir_as_path: Union[Path, S3Path],
-    sleep_between_batches: float = 10,
-) -> None:
+def _request_timeout() -> aiohttp.ClientTimeout:
+    return aiohttp.ClientTimeout(total=config.VESPA_REQUEST_TIMEOUT)
+
+
+async def _feed_operation_async(
+    session: VespaAsync, schema: SchemaName, document: dict, operation_type: str
+) -> VespaResponse:
     """
-    Index documents into Vespa.
+    Make a single feed or delete request over an open asyncio session.
 
-    :param pdf_parser_output_dir: directory or S3 folder containing output JSON
-        files from the PDF parser.
-    :param embedding_dir: directory or S3 folder containing embeddings from the
-        text2embeddings CLI.
-    :param sleep_between_batches: time to sleep (seconds) between batches of documents.
+    The request is made on the session's aiohttp session, as pyvespa's methods
+    retry timeouts and connection errors themselves, which would multiply the
+    feeder's own attempts.
     """
-    vespa = _get_vespa_instance()
+    url = session.app.end_point + session.app.get_document_v1_path(
+        id=document["id"], schema=str(schema), namespace=_NAMESPACE
+    )
+    try:
+        if operation_type == "delete":
+            request = session.aiohttp_session.delete(url, timeout=_request_timeout())
+        else:
+            request = session.aiohttp_session.post(
+                url, json={"fields": document["fields"]}, timeout=_request_timeout()
+            )
+        async with request as response:
+            return VespaResponse(
+                json=await response.json(),
+                status_code=response.status,
+                url=str(response.url),
+                operation_type=operation_type,
+            )
+    except Exception as e:
+        return VespaResponse(
+            json={"id": document["id"], "message": str(e)},
+            status_code=_error_status_code(e),
+            url="n/a",
+            operation_type=operation_type,
+        )
 
-    document_generator = get_document_generator(
-        paths=paths,
-        embedding_dir_as_path=embedding_dir_as_path,
-        vespa=vespa,
+
+async def _query_async(session: VespaAsync, body: dict) -> VespaQueryResponse:
+    """Make a single query request over an open asyncio session."""
+    async with session.aiohttp_session.post(
+        session.app.search_end_point, json=body, timeout=_request_timeout()
+    ) as response:
+        return VespaQueryResponse(
+            json=await response.json(),
+            status_code=response.status,
+            url=str(response.url),
+        )
+
+
+def _record_outcome(
+    schema: SchemaName, operation_type: str, response: VespaResponse
+) -> None:
+    succeeded = response.is_successful()
+    metrics.increment(
+        "feed_operations",
+        schema=str(schema),
+        operation_type=operation_type,
+        outcome="succeeded" if succeeded else "failed",
     )
+    if succeeded and operation_type == "feed":
+        if schema == FAMILY_DOCUMENT_SCHEMA:
+            metrics.increment("documents_fed")
+        elif schema == DOCUMENT_PASSAGE_SCHEMA:
+            metrics.increment("passages_fed")
+
+
+class VespaFeeder:
+    """
+    Feeds operations of any schema as they are submitted, from a thread pool.
+
+    No more operations are in flight than the flow controller's current limit,
+    and the latency and status of each is reported to it. Passages are only
+    submitted once every search weights and family document submitted before
+    them has completed, so documents are always written before the passages
+    that reference them.
+    """
+
+    def __init__(
+        self,
+        session: VespaSync,
+        controller: AdaptiveFlowController,
+        callback: Callable[[VespaResponse, str], None] = _handle_feed_error,
+        failures: Optional[FeedFailures] = None,
+    ):
+        """
+        :param session: an open session, sized for the controller's maximum
+        :param controller: the flow controller shared by operations in the run
+        :param callback: called with the response and id of each operation, the
+            first error it raises is raised by the feeder
+        :param failures: if given, operations that fail are recorded here rather
+            than passed to the callback
+        """
+        self.session = session
+        self.controller = controller
+        self.callback = callback
+        self.failures = failures
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._referenced_in_flight = 0
+        self._errors: list[Exception] = []
+
+    def __enter__(self) -> "VespaFeeder":
+        self._executor = ThreadPoolExecutor(max_workers=self.controller.maximum)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._executor.shutdown(wait=True)
+        if exc_type is None:
+            self._raise_errors()
+
+    def _raise_errors(self):
+        if self._errors:
+            raise self._errors[0]
+
+    def _complete(self, schema: SchemaName, document: dict, operation_type: str):
+        try:
+            response, attempts = self._attempt(schema, document, operation_type)
+            self._handle_response(schema, document, operation_type, response, attempts)
+        except Exception as e:
+            self._errors.append(e)
+        finally:
+            self._release(schema)
+
+    def _handle_response(
+        self,
+        schema: SchemaName,
+        document: dict,
+        operation_type: str,
+        response: VespaResponse,
+        attempts: int,
+    ) -> None:
+        _record_outcome(schema, operation_type, response)
+        if self.failures is not None and not response.is_successful():
+            self.failures.add(schema, document["id"], response, attempts)
+        else:
+            self.callback(response, document["id"])
+
+    def _release(self, schema: SchemaName) -> None:
+        with self._condition:
+            self._in_flight -= 1
+            if schema in _REFERENCED_SCHEMAS:
+                self._referenced_in_flight -= 1
+            self._condition.notify_all()
+
+    def _retry_delay(
+        self,
+        schema: SchemaName,
+        operation_type: str,
+        response: VespaResponse,
+        latency: float,
+        attempt: int,
+    ) -> Optional[float]:
+        """
+        Record an attempt, and return how long to back off before retrying it.
+
+        :return: None when the operation succeeded or shouldn't be retried
+        """
+        self.controller.record(latency, response.status_code)
+        metrics.observe(
+            "feed", latency, schema=str(schema), operation_type=operation_type
+        )
+        if (
+            response.is_successful()
+            or not is_retryable(response.status_code)
+            or attempt >= config.VESPA_FEED_MAX_ATTEMPTS
+        ):
+            return None
+        metrics.increment("feed_retries", schema=str(schema))
+        return retry_backoff(
+            attempt, config.VESPA_FEED_RETRY_BACKOFF, config.VESPA_FEED_MAX_BACKOFF
+        )
+
+    def _attempt(
+        self, schema: SchemaName, document: dict, operation_type: str
+    ) -> Tuple[VespaResponse, int]:
+        """
+        Feed an operation, retrying retryable failures with jittered backoff.
+
+        :return: the last response, and the number of attempts made
+
+        The operation keeps its place in flight while it backs off, which slows
+        the feed while Vespa is throttling.
+        """
+        attempt = 1
+        while True:
+            start = time.monotonic()
+            response = _feed_operation(self.session, schema, document, operation_type)
+            delay = self._retry_delay(
+                schema, operation_type, response, time.monotonic() - start, attempt
+            )
+            if delay is None:
+                return response, attempt
+            time.sleep(delay)
+            attempt += 1
+
+    def submit(
+        self, schema: SchemaName, document: dict, operation_type: str = "feed"
+    ) -> None:
+        """
+        Submit an operation, blocking until it can be put in flight.
+
+        :param schema: the schema of the document
+        :param document: a dict with the "id" and, unless deleting, the "fields"
+        :param operation_type: either "feed" or "delete"
+        """
+        with self._condition:
+            if schema not in _REFERENCED_SCHEMAS:
+                self._condition.wait_for(lambda: self._referenced_in_flight == 0)
+                self._raise_errors()
+            self._condition.wait_for(lambda: self._in_flight < self.controller.limit)
+            self._in_flight += 1
+            if schema in _REFERENCED_SCHEMAS:
+                self._referenced_in_flight += 1
+        self._dispatch(schema, document, operation_type)
+
+    def _dispatch(self, schema: SchemaName, document: dict, operation_type: str):
+        self._executor.submit(self._complete, schema, document, operation_type)
+
+    def flush(self) -> None:
+        """Wait for every submitted operation to complete."""
+        with self._condition:
+            self._condition.wait_for(lambda: self._in_flight == 0)
+        self._raise_errors()
+
+
+class AsyncVespaFeeder(VespaFeeder):
+    """
+    Feeds operations, and runs queries, over one asyncio session for a whole run.
+
+    Operations can be submitted from any thread, and run on an event loop in a
+    background thread rather than a thread each, so many more can be in flight
+    from one process. Every operation and query shares the session's pool of
+    persistent connections. Operations in flight are limited, retried and
+    ordered as by VespaFeeder.
+    """
+
+    def __init__(
+        self,
+        vespa: Vespa,
+        controller: AdaptiveFlowController,
+        callback: Callable[[VespaResponse, str], None] = _handle_feed_error,
+        failures: Optional[FeedFailures] = None,
+        query_connections: int = 0,
+    ):
+        """
+        :param vespa: the Vespa instance to feed and query
+        :param controller: the flow controller shared by operations in the run,
+            its maximum is the most operations ever in flight
+        :param callback: called with the response and id of each operation, the
+            first error it raises is raised by the feeder
+        :param failures: if given, operations that fail are recorded here rather
+            than passed to the callback
+        :param query_connections: connections to add to the pool for queries
+            made while feeding
+        """
+        super().__init__(
+            vespa.asyncio(connections=controller.maximum + query_connections),
+            controller,
+            callback,
+            failures,
+        )
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._session_stack = AsyncExitStack()
+
+    def _run(self, coroutine: Coroutine[Any, Any, T]) -> T:
+        """Run a coroutine on the event loop, waiting for its result."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def __enter__(self) -> "AsyncVespaFeeder":
+        self._thread.start()
+        # The session is opened and closed on the loop that it's used from
+        self._run(self._session_stack.enter_async_context(self.session))
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            with self._condition:
+                self._condition.wait_for(lambda: self._in_flight == 0)
+            self._run(self._session_stack.aclose())
+        finally:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+        if exc_type is None:
+            self._raise_errors()
+
+    async def _complete_async(
+        self, schema: SchemaName, document: dict, operation_type: str
+    ):
+        try:
+            response, attempts = await self._attempt_async(
+                schema, document, operation_type
+            )
+            self._handle_response(schema, document, operation_type, response, attempts)
+        except Exception as e:
+            self._errors.append(e)
+        finally:
+            self._release(schema)
+
+    async def _attempt_async(
+        self, schema: SchemaName, document: dict, operation_type: str
+    ) -> Tuple[VespaResponse, int]:
+        attempt = 1
+        while True:
+            start = time.monotonic()
+            response = await _feed_operation_async(
+                self.session, schema, document, operation_type
+            )
+            delay = self._retry_delay(
+                schema, operation_type, response, time.monotonic() - start, attempt
+            )
+            if delay is None:
+                return response, attempt
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def _dispatch(self, schema: SchemaName, document: dict, operation_type: str):
+        asyncio.run_coroutine_threadsafe(
+            self._complete_async(schema, document, operation_type), self._loop
+        )
+
+    def query(self, body: dict) -> VespaQueryResponse:
+        """Run a query over the feeder's session, waiting for its response."""
+        return self._run(_query_async(self.session, body))
+
+
+def feed_documents(
+    session: VespaSync,
+    schema: SchemaName,
+    documents: Iterable[dict],
+    controller: AdaptiveFlowController,
+    operation_type: str = "feed",
+    callback: Callable[[VespaResponse, str], None] = _handle_feed_error,
+    failures: Optional[FeedFailures] = None,
+) -> None:
+    """
+    Feed documents of a single schema with an adaptive number of operations in flight.
+
+    :param session: an open session, sized for the controller's maximum
+    :param schema: the schema of the documents
+    :param documents: dicts with the "id" and, unless deleting, the "fields"
+    :param controller: the flow controller shared by operations in the run
+    :param operation_type: either "feed" or "delete"
+    :param callback: called with the response and id of each operation, the
+        first error it raises is raised once all operations are complete
+    :param failures: if given, operations that fail are recorded here rather
+        than passed to the callback
+    """
+    with VespaFeeder(session, controller, callback, failures) as feeder:
+        for document in documents:
+            feeder.submit(schema, document, operation_type)
+
+
+class _BackgroundError(NamedTuple):
+    error: BaseException
+
+
+def iterate_in_background(
+    iterable: Iterable[T], max_queued: int
+) -> Generator[T, None, None]:
+    """
+    Consume an iterable on a background thread, through a bounded queue.
+
+    The iterable keeps producing while the consumer is busy, until `max_queued`
+    items are waiting. Errors raised by the iterable are re-raised here.
+
+    Once this generator is closed, the background thread has stopped and closed
+    the iterable, so nothing the iterable does runs after it's closed. The item
+    being produced when it's closed is finished first.
+    """
+    queue: Queue = Queue(maxsize=max(max_queued, 1))
+    stop = threading.Event()
+    finished = object()
+    iterator = iter(iterable)
+
+    def _put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=1)
+                return
+            except Full:
+                continue
+
+    def _produce():
+        try:
+            for item in iterator:
+                _put(item)
+                if stop.is_set():
+                    return
+            _put(finished)
+        except BaseException as e:
+            _put(_BackgroundError(e))
+        finally:
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+
+    thread = threading.Thread(target=_produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = queue.get()
+            if item is finished:
+                return
+            if isinstance(item, _BackgroundError):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def get_failed_document_ids(failures: FeedFailures) -> set[DocumentID]:
+    """The documents with a family document or passage operation that failed."""
+    failed = set()
+    for failure in failures.failures:
+        if failure.schema == FAMILY_DOCUMENT_SCHEMA:
+            failed.add(DocumentID(failure.id))
+        elif failure.schema == DOCUMENT_PASSAGE_SCHEMA:
+            failed.add(DocumentID(failure.id.rsplit(".", 1)[0]))
+    return failed
+
+
+class CheckpointRecorder:
+    """
+    Record documents as complete once all of their operations are acknowledged.
+
+    Operations are observed in the order they are fed. A document's operations,
+    including deletes of its stray passages, have all been generated once the
+    next family document is observed, so the document being fed when a
+    checkpoint is written is left to be indexed again on resume.
+
+    Documents are recorded by their document ID, the stem of their parser
+    output's path, so they can be skipped on resume without being read. This
+    can differ from the ID their family document is fed with.
+    """
+
+    def __init__(
+        self,
+        checkpoint_path: Union[Path, S3Path],
+        paths: Sequence[Union[Path, S3Path]] = (),
+        checkpoint: Optional[IndexCheckpoint] = None,
+        failures: Optional[FeedFailures] = None,
+    ):
+        """
+        :param checkpoint_path: where the checkpoint is written
+        :param paths: the paths in the run, in order, when known up front.
+            Otherwise they are recorded as they are listed, with `track`.
+        :param checkpoint: progress from an earlier run being resumed
+        :param failures: failed operations of the run, documents with a failed
+            operation are never completed
+        """
+        self.checkpoint_path = checkpoint_path
+        self.failures = failures
+        self._document_ids = [path.stem for path in paths]
+        self._completed = set(checkpoint.completed_document_ids if checkpoint else [])
+        self._generated: list[DocumentID] = []
+        self._current: Optional[DocumentID] = None
+        # Document IDs by the ID their family document is fed with
+        self._document_ids_by_feed_id: dict[DocumentID, DocumentID] = {}
+
+    @property
+    def checkpoint(self) -> IndexCheckpoint:
+        position = next(
+            (
+                i
+                for i, document_id in enumerate(self._document_ids)
+                if document_id not in self._completed
+            ),
+            len(self._document_ids),
+        )
+        return IndexCheckpoint(
+            position=position, completed_document_ids=sorted(self._completed)
+        )
 
+    def track(
+        self, paths: Iterable[Union[Path, S3Path]]
+    ) -> Generator[Union[Path, S3Path], None, None]:
+        """Record the order of paths in the run as they are listed."""
+        for path in paths:
+            self._document_ids.append(path.stem)
+            yield path
+
+    @property
+    def pending(self) -> int:
+        """The number of documents generated but not yet acknowledged."""
+        return len(self._generated)
+
+    def observe(
+        self, schema: SchemaName, doc_id: DocumentID, fields: Optional[dict] = None
+    ) -> None:
+        """Observe an operation, with the fields it's fed, as it is fed."""
+        if schema == FAMILY_DOCUMENT_SCHEMA:
+            if self._current is not None:
+                self._generated.append(self._current)
+            self._current = DocumentID((fields or {}).get("document_import_id", doc_id))
+            self._document_ids_by_feed_id[doc_id] = self._current
+
+    def acknowledged(self, finished: bool = False) -> None:
+        """
+        Complete documents whose operations have all been acknowledged and write
+        the checkpoint.
+
+        :param finished: whether every operation observed has been acknowledged
+            and no more are to come, completing the current document too
+        """
+        if finished and self._current is not None:
+            self._generated.append(self._current)
+            self._current = None
+        failed = {
+            self._document_ids_by_feed_id.get(document_id, document_id)
+            for document_id in (
+                get_failed_document_ids(self.failures) if self.failures else set()
+            )
+        }
+        self._completed.update(
+            document_id for document_id in self._generated if document_id not in failed
+        )
+        self._generated.clear()
+        write_checkpoint(self.checkpoint_path, self.checkpoint)
+
+
+@contextmanager
+def _stop_on_sigterm() -> Generator[threading.Event, None, None]:
+    """
+    Set the yielded event instead of exiting when SIGTERM is received.
+
+    Handlers can only be installed from the main thread, elsewhere the event is
+    never set.
+    """
+    stop = threading.Event()
+    if threading.current_thread() is not threading.main_thread():
+        yield stop
+        return
+
+    def _handle_sigterm(signum, frame):
+        _LOGGER.warning("Received SIGTERM, draining in-flight feed operations")
+        stop.set()
+
+    previous_handler = signal.signal(signal.SIGTERM, _handle_sigterm)
+    try:
+        yield stop
+    finally:
+        signal.signal(signal.SIGTERM, previous_handler)
+
+
+def _stream_ingest(
+    vespa: Vespa,
+    document_generator: Iterable[Tuple[SchemaName, DocumentID, dict]],
+    controller: AdaptiveFlowController,
+    checkpoint: Optional[CheckpointRecorder] = None,
+    stop: Optional[threading.Event] = None,
+    failures: Optional[FeedFailures] = None,
+    feeder: Optional[VespaFeeder] = None,
+) -> None:
+    """
+    Feed documents continuously as they are generated.
+
+    The generator runs ahead on a background thread, bounded by the stream
+    queue size, while operations are fed by a single long-lived feeder. Every
+    checkpoint interval the feeder waits for operations in flight to be
+    acknowledged so the checkpoint can be written.
+
+    :param feeder: an open feeder to feed with, by default one is opened on a
+        new session for the run
+    """
+    stopped = False
+    with ExitStack() as stack:
+        if feeder is None:
+            session = stack.enter_context(feed_session(vespa, controller.maximum))
+            feeder = stack.enter_context(
+                VespaFeeder(session, controller, failures=failures)
+            )
+        operations = iterate_in_background(
+            document_generator, config.VESPA_STREAM_QUEUE_SIZE
+        )
+        # Closed before the feeder, as the generator submits deletes of stray
+        # passages to it from the background thread
+        with closing(operations):
+            for schema, doc_id, fields in operations:
+                if stop is not None and stop.is_set():
+                    stopped = True
+                    break
+                if checkpoint is not None:
+                    if (
+                        schema == FAMILY_DOCUMENT_SCHEMA
+                        and checkpoint.pending
+                        >= config.VESPA_STREAM_CHECKPOINT_INTERVAL
+                    ):
+                        feeder.flush()
+                        checkpoint.acknowledged()
+                    checkpoint.observe(schema, doc_id, fields)
+                if not fields:
+                    _LOGGER.critical(
+                        f"No fields for {doc_id}, of schema {schema}: {fields}"
+                    )
+                    continue
+                feeder.submit(schema, {"id": doc_id, "fields": fields})
+
+        feeder.flush()
+        if checkpoint is not None:
+            checkpoint.acknowledged(finished=not stopped)
+
+
+def _batch_ingest(
+    vespa: Vespa,
+    to_process: Mapping[SchemaName, list],
+    controller: Optional[AdaptiveFlowController] = None,
+    failures: Optional[FeedFailures] = None,
+    feeder: Optional[VespaFeeder] = None,
+):
+    """
+    Feed a batch of documents, a schema at a time.
+
+    :param feeder: an open feeder to feed with, by default a session is opened
+        for the batch
+    """
+    controller = controller or AdaptiveFlowController.from_config()
+    if feeder is not None:
+        for schema in _SCHEMAS_TO_PROCESS:
+            documents = to_process[schema]
+            if documents:
+                _LOGGER.info(
+                    f"Processing {schema}, with {len(documents)} documents",
+                    extra={"props": {"in_flight_limit": controller.limit}},
+                )
+                for document in documents:
+                    feeder.submit(schema, document)
+        feeder.flush()
+        return
+
+    with feed_session(vespa, controller.maximum) as session:
+        for schema in _SCHEMAS_TO_PROCESS:
+            documents = to_process[schema]
+            if documents:
+                _LOGGER.info(
+                    f"Processing {schema}, with {len(documents)} documents",
+                    extra={"props": {"in_flight_limit": controller.limit}},
+                )
+                feed_documents(
+                    session, schema, documents, controller, failures=failures
+                )
+
+
+def _batch_ingest_all(
+    vespa: Vespa,
+    document_generator: Iterable[Tuple[SchemaName, DocumentID, dict]],
+    controller: AdaptiveFlowController,
+    sleep_between_batches: Optional[float] = None,
+    checkpoint: Optional[CheckpointRecorder] = None,
+    stop: Optional[threading.Event] = None,
+    failures: Optional[FeedFailures] = None,
+    feeder: Optional[VespaFeeder] = None,
+) -> None:
+    """
+    Feed documents in batches, pausing generation while each batch is fed.
+
+    The checkpoint is written after each batch is acknowledged. When stopped,
+    the batch being generated is dropped to be indexed again on resume.
+    """
     # Process documents into Vespa in sized groups (bulk ingest operates on documents
     # of a single schema)
     to_process: dict[SchemaName, list] = defaultdict(list)
 
     for schema, doc_id, fields in document_generator:
+        if stop is not None and stop.is_set():
+            _LOGGER.warning("Stopping before feeding the current batch")
+            return
+        if checkpoint is not None:
+            checkpoint.observe(schema, doc_id, fields)
         if not fields:
             _LOGGER.critical(f"No fields for {doc_id}, of schema {schema}: {fields}")
             continue
@@ -489,10 +1852,325 @@ def populate_vespa(
         )
 
         if len(to_process[DOCUMENT_PASSAGE_SCHEMA]) >= config.VESPA_DOCUMENT_BATCH_SIZE:
-            _batch_ingest(vespa, to_process)
+            _batch_ingest(vespa, to_process, controller, failures, feeder)
             to_process.clear()
+            if checkpoint is not None:
+                checkpoint.acknowledged()
 
-            time.sleep(sleep_between_batches)
+            pause = (
+                controller.pause()
+                if sleep_between_batches is None
+                else sleep_between_batches
+            )
+            if pause:
+                _LOGGER.info(f"Pausing for {pause}s between batches")
+                time.sleep(pause)
 
     _LOGGER.info("Final ingest batch")
-    _batch_ingest(vespa, to_process)
+    _batch_ingest(vespa, to_process, controller, failures, feeder)
+    if checkpoint is not None:
+        checkpoint.acknowledged(finished=True)
+
+
+def filter_unchanged_paths(
+    paths: Iterable[Union[Path, S3Path]],
+    embedding_dir_as_path: Union[Path, S3Path],
+    manifest: IndexManifest,
+    fingerprints: dict[str, str],
+    model_slugs: Optional[Sequence[str]] = None,
+) -> Generator[Union[Path, S3Path], None, None]:
+    """
+    Remove paths for documents whose inputs are unchanged since the manifest.
+
+    Paths are filtered as they are listed. When there are few enough, such as
+    those given to index, only their own files are fingerprinted. Otherwise
+    the input directory is fingerprinted from one listing, while the paths
+    carry on being listed.
+
+    :param fingerprints: the fingerprints of the documents to index are added
+        here as they are yielded
+    :param model_slugs: the models whose embeddings are inputs, the selected
+        embedding models by default
+    :yield Generator[Union[Path, S3Path], None, None]: the paths to index
+    """
+    if model_slugs is None:
+        model_slugs = list(get_embedding_models())
+    remaining = iter(paths)
+    first_paths = list(itertools.islice(remaining, PER_DOCUMENT_LISTING_MAX + 1))
+    if len(first_paths) <= PER_DOCUMENT_LISTING_MAX:
+        file_fingerprints = list_file_fingerprints(
+            embedding_dir_as_path, {path.stem for path in first_paths}
+        )
+    else:
+        file_fingerprints = list_file_fingerprints(embedding_dir_as_path)
+
+    path_count = 0
+    indexed_count = 0
+    for path in itertools.chain(first_paths, remaining):
+        path_count += 1
+        fingerprint = get_document_fingerprint(
+            path.stem, file_fingerprints, model_slugs
+        )
+        if fingerprint is not None and manifest.documents.get(path.stem) == fingerprint:
+            continue
+        if fingerprint is not None:
+            fingerprints[path.stem] = fingerprint
+        indexed_count += 1
+        yield path
+
+    _LOGGER.info(
+        f"Skipped {path_count - indexed_count} unchanged documents, "
+        f"{indexed_count} to index"
+    )
+
+
+def populate_vespa(
+    paths: Iterable[Union[Path, S3Path]],
+    embedding_dir_as_path: Union[Path, S3Path],
+    sleep_between_batches: Optional[float] = None,
+    manifest_path: Optional[Union[Path, S3Path]] = None,
+    passage_state_path: Optional[Union[Path, S3Path]] = None,
+    checkpoint_path: Optional[Union[Path, S3Path]] = None,
+    resume: bool = False,
+    dead_letter_path: Optional[Union[Path, S3Path]] = None,
+    metrics_json_path: Optional[Union[Path, S3Path]] = None,
+    metrics_prometheus_path: Optional[Union[Path, S3Path]] = None,
+) -> None:
+    """
+    Index documents into Vespa.
+
+    On SIGTERM, operations in flight are drained and the checkpoint written
+    before a VespaIndexError is raised.
+
+    Feed operations that fail are retried individually, and the run carries on
+    past operations that still fail. Their documents are left out of the
+    manifest, passage state and checkpoint so they are indexed again next run.
+
+    :param pdf_parser_output_dir: directory or S3 folder containing output JSON
+        files from the PDF parser.
+    :param embedding_dir: directory or S3 folder containing embeddings from the
+        text2embeddings CLI.
+    :param sleep_between_batches: time to sleep (seconds) between batches of
+        documents. By default this adapts, pausing only when Vespa throttles.
+    :param manifest_path: if given, documents with inputs unchanged since they
+        were recorded in this manifest are skipped, and the manifest is updated
+        once indexing completes.
+    :param passage_state_path: if given, only passages that are new or have
+        changed since they were recorded in this state are fed, and the state is
+        updated once indexing completes.
+    :param checkpoint_path: if given, progress is written here as batches are
+        acknowledged, and removed once indexing completes.
+    :param resume: skip documents completed in the checkpoint, from an
+        interrupted run over the same paths. A VespaIndexError is raised if
+        there is no checkpoint to resume from.
+    :param dead_letter_path: if given, failed feed operations are written here
+        as JSON lines. Otherwise a VespaIndexError is raised at the end of a run
+        with failed operations.
+    :param metrics_json_path: if given, a summary of throughput and the time
+        taken by each stage is written here as JSON.
+    :param metrics_prometheus_path: if given, the same metrics are written here
+        as a Prometheus textfile.
+    """
+    if resume and (checkpoint_path is None or not checkpoint_path.exists()):
+        raise VespaIndexError(
+            f"No checkpoint found to resume from at {checkpoint_path}, the "
+            "interrupted run may have written it elsewhere or already completed"
+        )
+    models = validate_embedding_models()
+    cell_types = {model_slug: model.cell_type for model_slug, model in models.items()}
+    metrics.reset()
+    vespa = _get_vespa_instance()
+    failures = FeedFailures()
+
+    checkpoint = None
+    if checkpoint_path is not None:
+        previous_checkpoint = read_checkpoint(checkpoint_path) if resume else None
+        checkpoint = CheckpointRecorder(
+            checkpoint_path, checkpoint=previous_checkpoint, failures=failures
+        )
+        paths = checkpoint.track(paths)
+        if previous_checkpoint is not None:
+            completed = set(previous_checkpoint.completed_document_ids)
+            paths = (path for path in paths if path.stem not in completed)
+            _LOGGER.info(
+                f"Resuming from position {previous_checkpoint.position}, skipping "
+                f"{len(completed)} completed documents"
+            )
+
+    if manifest_path is not None:
+        manifest = read_manifest(manifest_path)
+        fingerprints: dict[str, str] = {}
+        paths = filter_unchanged_paths(
+            paths, embedding_dir_as_path, manifest, fingerprints, list(models)
+        )
+
+    passage_state = None
+    if passage_state_path is not None:
+        passage_state = read_passage_state(passage_state_path)
+
+    try:
+        with _stop_on_sigterm() as stop, ExitStack() as stack:
+            # Every operation of the run, including deletes of stray passages, is
+            # fed by one feeder so they share its flow control and failures
+            feeder: VespaFeeder
+            if config.VESPA_FEED_CLIENT == "async":
+                controller = AdaptiveFlowController.from_config(
+                    maximum=config.VESPA_ASYNC_MAX_IN_FLIGHT
+                )
+                feeder = stack.enter_context(
+                    AsyncVespaFeeder(
+                        vespa,
+                        controller,
+                        failures=failures,
+                        query_connections=config.VESPA_QUERY_LOOKAHEAD,
+                    )
+                )
+            elif config.VESPA_FEED_CLIENT == "sync":
+                controller = AdaptiveFlowController.from_config()
+                session = stack.enter_context(feed_session(vespa, controller.maximum))
+                feeder = stack.enter_context(
+                    VespaFeeder(session, controller, failures=failures)
+                )
+            else:
+                raise VespaConfigError(
+                    "Unknown feed client configured with environment variable "
+                    f"'VESPA_FEED_CLIENT': {config.VESPA_FEED_CLIENT}"
+                )
+
+            document_generator = get_document_generator(
+                paths=paths,
+                embedding_dir_as_path=embedding_dir_as_path,
+                vespa=feeder if isinstance(feeder, AsyncVespaFeeder) else vespa,
+                passage_state=passage_state,
+                remove_stray_ids=partial(remove_ids, feeder),
+                models=models,
+            )
+            if config.VESPA_FEED_MODE == "stream":
+                _stream_ingest(
+                    vespa,
+                    document_generator,
+                    controller,
+                    checkpoint,
+                    stop,
+                    failures,
+                    feeder,
+                )
+            elif config.VESPA_FEED_MODE == "batch":
+                _batch_ingest_all(
+                    vespa,
+                    document_generator,
+                    controller,
+                    sleep_between_batches,
+                    checkpoint,
+                    stop,
+                    failures,
+                    feeder,
+                )
+            else:
+                raise VespaConfigError(
+                    "Unknown feed mode configured with environment variable "
+                    f"'VESPA_FEED_MODE': {config.VESPA_FEED_MODE}"
+                )
+    finally:
+        failures.log_report()
+        if dead_letter_path is not None:
+            failures.write_dead_letter(dead_letter_path)
+        metrics.log_report()
+        log_quantization_report(metrics, cell_types)
+        if metrics_json_path is not None:
+            metrics.write_json(metrics_json_path)
+        if metrics_prometheus_path is not None:
+            metrics.write_prometheus(metrics_prometheus_path)
+
+    if stop.is_set():
+        raise VespaIndexError(
+            "Indexing interrupted by SIGTERM"
+            + (f", progress written to {checkpoint_path}" if checkpoint else "")
+        )
+
+    failed_document_ids = get_failed_document_ids(failures)
+    if manifest_path is not None:
+        manifest.documents.update(
+            (document_id, fingerprint)
+            for document_id, fingerprint in fingerprints.items()
+            if document_id not in failed_document_ids
+        )
+        write_manifest(manifest_path, manifest)
+    if passage_state_path is not None and passage_state is not None:
+        for document_id in failed_document_ids:
+            passage_state.documents.pop(document_id, None)
+        write_passage_state(passage_state_path, passage_state)
+
+    if failures:
+        # Keep the checkpoint so a resumed run only retries the failed documents
+        if dead_letter_path is None:
+            raise VespaIndexError(
+                f"{len(failures)} feed operations failed across "
+                f"{len(failed_document_ids)} documents"
+            )
+        return
+    if checkpoint_path is not None and checkpoint_path.exists():
+        checkpoint_path.unlink()
+
+
+def export_vespa_feed(
+    paths: Iterable[Union[Path, S3Path]],
+    embedding_dir_as_path: Union[Path, S3Path],
+    output_dir: Union[Path, S3Path],
+    compress: bool = False,
+    offline: bool = False,
+) -> list[Union[Path, S3Path]]:
+    """
+    Write the operations that would be fed to Vespa to JSON lines feed files.
+
+    The files can be fed with vespa-feed-client, to a rebuilt cluster without
+    preparing documents again, or inspected offline.
+
+    :param output_dir: directory or S3 folder to write the feed files to.
+    :param compress: gzip the feed files.
+    :param offline: don't look up passages already in Vespa, so no removals of
+        stray passages are written.
+    :return: paths of the feed files written, in order.
+    """
+    models = validate_embedding_models()
+    metrics.reset()
+    vespa = None if offline else _get_vespa_instance()
+
+    with FeedFileWriter(
+        output_dir,
+        _NAMESPACE,
+        config.VESPA_EXPORT_OPERATIONS_PER_FILE,
+        compress=compress,
+    ) as writer:
+
+        def _remove_stray_ids(stray_ids: list[str]) -> None:
+            for stray_id in stray_ids:
+                writer.remove(DOCUMENT_PASSAGE_SCHEMA, stray_id)
+
+        document_generator = get_document_generator(
+            vespa=vespa,
+            paths=paths,
+            embedding_dir_as_path=embedding_dir_as_path,
+            remove_stray_ids=_remove_stray_ids,
+            models=models,
+        )
+        for schema, doc_id, fields in document_generator:
+            if schema == FAMILY_DOCUMENT_SCHEMA:
+                writer.start_document()
+            if not fields:
+                _LOGGER.critical(
+                    f"No fields for {doc_id}, of schema {schema}: {fields}"
+                )
+                continue
+            writer.put(schema, doc_id, fields)
+            if schema == FAMILY_DOCUMENT_SCHEMA:
+                metrics.increment("documents_exported")
+            elif schema == DOCUMENT_PASSAGE_SCHEMA:
+                metrics.increment("passages_exported")
+
+    metrics.log_report()
+    log_quantization_report(
+        metrics,
+        {model_slug: model.cell_type for model_slug, model in models.items()},
+    )
+    return writer.paths
@@ -0,0 +1,203 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import hashlib
+import logging
+from pathlib import Path
+from typing import AbstractSet, Optional, Sequence, Union
+
+from cloudpathlib import S3Path
+from pydantic import BaseModel
+
+from src.utils import get_embedding_container_path, get_embedding_path
+
+_LOGGER = logging.getLogger(__name__)
+
+MANIFEST_FILE_NAME = ".indexer_manifest.json"
+
+# Up to this many documents are fingerprinted from listings of each document's
+# own files on S3, rather than from a listing of the whole input directory
+PER_DOCUMENT_LISTING_MAX = 100
+_LISTING_WORKERS = 16
+
+
+def shard_file_name(file_name: str, shard_index: int, shard_count: int) -> str:
+    """
+    The name of a state file for one shard of the documents.
+
+    Workers indexing different shards keep separate state files, so they don't
+    overwrite each other's.
+    """
+    if shard_count == 1:
+        return file_name
+    stem, _, suffix = file_name.rpartition(".")
+    return f"{stem}.shard-{shard_index}-of-{shard_count}.{suffix}"
+
+
+class IndexManifest(BaseModel):
+    """Fingerprints of the inputs for each document as it was last indexed"""
+
+    documents: dict[str, str] = {}
+
+
+class PassageState(BaseModel):
+    """Digests of the passages fed for each family document, by passage id"""
+
+    documents: dict[str, dict[str, str]] = {}
+
+
+class IndexCheckpoint(BaseModel):
+    """Progress through an indexing run that has not yet completed"""
+
+    # Number of paths, from the start, whose documents have all been indexed
+    position: int = 0
+    completed_document_ids: list[str] = []
+
+
+def read_manifest(manifest_path: Union[Path, S3Path]) -> IndexManifest:
+    """Read a manifest, or start an empty one if it doesn't exist yet."""
+    if not manifest_path.exists():
+        _LOGGER.info(f"No manifest found at {manifest_path}, indexing all documents")
+        return IndexManifest()
+    return IndexManifest.model_validate_json(manifest_path.read_text())
+
+
+def write_manifest(manifest_path: Union[Path, S3Path], manifest: IndexManifest):
+    manifest_path.write_text(manifest.model_dump_json())
+    _LOGGER.info(
+        f"Wrote manifest for {len(manifest.documents)} documents to {manifest_path}"
+    )
+
+
+def read_passage_state(passage_state_path: Union[Path, S3Path]) -> PassageState:
+    """Read a passage state, or start an empty one if it doesn't exist yet."""
+    if not passage_state_path.exists():
+        _LOGGER.info(
+            f"No passage state found at {passage_state_path}, feeding all passages"
+        )
+        return PassageState()
+    return PassageState.model_validate_json(passage_state_path.read_text())
+
+
+def write_passage_state(
+    passage_state_path: Union[Path, S3Path], passage_state: PassageState
+):
+    passage_state_path.write_text(passage_state.model_dump_json())
+    _LOGGER.info(
+        f"Wrote passage state for {len(passage_state.documents)} documents "
+        f"to {passage_state_path}"
+    )
+
+
+def read_checkpoint(checkpoint_path: Union[Path, S3Path]) -> IndexCheckpoint:
+    """Read a checkpoint, or start from the beginning if it doesn't exist yet."""
+    if not checkpoint_path.exists():
+        _LOGGER.info(
+            f"No checkpoint found at {checkpoint_path}, starting from the beginning"
+        )
+        return IndexCheckpoint()
+    return IndexCheckpoint.model_validate_json(checkpoint_path.read_text())
+
+
+def write_checkpoint(checkpoint_path: Union[Path, S3Path], checkpoint: IndexCheckpoint):
+    checkpoint_path.write_text(checkpoint.model_dump_json())
+    _LOGGER.info(
+        f"Wrote checkpoint for {len(checkpoint.completed_document_ids)} completed "
+        f"documents to {checkpoint_path}",
+        extra={"props": {"position": checkpoint.position}},
+    )
+
+
+def _document_id_of(file_name: str) -> str:
+    """The document an input file belongs to, from the file's name."""
+    if "__" in file_name:
+        return file_name.partition("__")[0]
+    return file_name.rpartition(".")[0]
+
+
+def _list_s3_fingerprints(
+    indexer_input_path: S3Path, name_prefix: str = ""
+) -> dict[str, str]:
+    """Fingerprint the objects in the input directory whose names start with this."""
+    prefix = f"{indexer_input_path.key.rstrip('/')}/" if indexer_input_path.key else ""
+    paginator = indexer_input_path.client.client.get_paginator("list_objects_v2")
+    fingerprints = {}
+    for page in paginator.paginate(
+        Bucket=indexer_input_path.bucket, Prefix=prefix + name_prefix, Delimiter="/"
+    ):
+        for s3_object in page.get("Contents", []):
+            name = s3_object["Key"][len(prefix) :]
+            etag = s3_object["ETag"].strip('"')
+            fingerprints[name] = f"{etag}:{s3_object['Size']}"
+    return fingerprints
+
+
+def list_file_fingerprints(
+    indexer_input_path: Union[Path, S3Path],
+    document_ids: Optional[AbstractSet[str]] = None,
+) -> dict[str, str]:
+    """
+    Fingerprint the files in the input directory, keyed by file name.
+
+    S3 objects are fingerprinted by ETag and size, read from a single paginated
+    listing rather than a request per object. Local files are fingerprinted by
+    size and modification time.
+
+    :param document_ids: if given, only the files of these documents are
+        fingerprinted. On S3, up to `PER_DOCUMENT_LISTING_MAX` documents are
+        each listed by the prefix of their own files rather than listing the
+        whole directory.
+    """
+    fingerprints = {}
+    if isinstance(indexer_input_path, S3Path):
+        if document_ids is not None and len(document_ids) <= PER_DOCUMENT_LISTING_MAX:
+            with ThreadPoolExecutor(max_workers=_LISTING_WORKERS) as executor:
+                for listing in executor.map(
+                    partial(_list_s3_fingerprints, indexer_input_path),
+                    sorted(document_ids),
+                ):
+                    fingerprints.update(listing)
+        else:
+            fingerprints = _list_s3_fingerprints(indexer_input_path)
+        if document_ids is not None:
+            fingerprints = {
+                name: fingerprint
+                for name, fingerprint in fingerprints.items()
+                if _document_id_of(name) in document_ids
+            }
+    else:
+        for path in indexer_input_path.iterdir():
+            # Files are picked out by name, so only those wanted are stat'ed
+            wanted = document_ids is None or _document_id_of(path.name) in document_ids
+            if wanted and path.is_file():
+                stat = path.stat()
+                fingerprints[path.name] = f"{stat.st_size}:{stat.st_mtime_ns}"
+    return fingerprints
+
+
+def get_document_fingerprint(
+    document_id: str,
+    file_fingerprints: dict[str, str],
+    model_slugs: Sequence[str],
+) -> Optional[str]:
+    """
+    Combine the fingerprints of a document's JSON and embeddings files.
+
+    The embeddings are fingerprinted by the document's embeddings container
+    when there is one, otherwise by each model's file.
+
+    Returns None if any of the files are missing, so the document is never
+    treated as unchanged.
+    """
+    container_name = get_embedding_container_path(Path(), document_id).name
+    if container_name in file_fingerprints:
+        embedding_names = [container_name]
+    else:
+        embedding_names = [
+            get_embedding_path(Path(), document_id, model_slug).name
+            for model_slug in model_slugs
+        ]
+    names = [f"{document_id}.json"] + embedding_names
+    if any(name not in file_fingerprints for name in names):
+        return None
+    combined = "\n".join(f"{name}={file_fingerprints[name]}" for name in names)
+    return hashlib.sha256(combined.encode()).hexdigest()
@@ -0,0 +1,256 @@
+import bisect
+from contextlib import contextmanager
+import json
+import logging
+from pathlib import Path
+import threading
+import time
+from typing import Generator, Optional, Tuple, Union
+
+from cloudpathlib import S3Path
+
+_LOGGER = logging.getLogger(__name__)
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: dict[str, str]) -> Labels:
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels: Labels, **extra: str) -> str:
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in items) + "}"
+
+
+def _report_key(name: str, labels: Labels) -> str:
+    if not labels:
+        return name
+    return name + "{" + ",".join(f"{label}={value}" for label, value in labels) + "}"
+
+
+class Histogram:
+    """Counts of observed values falling under each latency bucket"""
+
+    def __init__(self):
+        self.bucket_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.bucket_counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimate a quantile as the upper bound of the bucket it falls in.
+
+        Values above the last bucket are estimated as the maximum observed.
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.bucket_counts):
+            cumulative += count
+            if cumulative >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self) -> dict[str, float]:
+        return {
+            "count": self.count,
+            "total_seconds": self.sum,
+            "mean_seconds": self.sum / self.count if self.count else 0.0,
+            "p50_seconds": self.quantile(0.5),
+            "p95_seconds": self.quantile(0.95),
+            "p99_seconds": self.quantile(0.99),
+            "max_seconds": self.max,
+        }
+
+
+class PipelineMetrics:
+    """
+    Counters and stage latency histograms for an indexing run.
+
+    Stages record the time taken on each call, labelled by stage name and any
+    extra labels such as the schema. Safe to record into from multiple threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Labels for every metric of the run, such as the worker's shard
+        self.run_labels: Labels = ()
+        self.reset()
+
+    def set_run_labels(self, **labels: str) -> None:
+        """Label every metric with these, kept when the metrics are reset."""
+        self.run_labels = _labels(labels)
+
+    def reset(self) -> None:
+        """Clear every metric, and start timing a new run."""
+        with self._lock:
+            self.started = time.monotonic()
+            self._counters: dict[Tuple[str, Labels], float] = {}
+            self._histograms: dict[Tuple[str, Labels], Histogram] = {}
+
+    def increment(self, name: str, amount: float = 1, **labels: str) -> None:
+        key = (name, _labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, stage: str, seconds: float, **labels: str) -> None:
+        key = (stage, _labels(labels))
+        with self._lock:
+            self._histograms.setdefault(key, Histogram()).observe(seconds)
+
+    @contextmanager
+    def time(self, stage: str, **labels: str) -> Generator[None, None, None]:
+        """Observe the time taken by the body of the with statement."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, **labels)
+
+    def counter(self, name: str, **labels: str) -> float:
+        """The total of a counter, over any labels not given."""
+        wanted = set(labels.items())
+        with self._lock:
+            return sum(
+                value
+                for (counter_name, counter_labels), value in self._counters.items()
+                if counter_name == name and wanted <= set(counter_labels)
+            )
+
+    def report(self, duration: Optional[float] = None) -> dict:
+        """
+        Summarise the run, with throughput over the run's duration.
+
+        Documents and passages count towards throughput once fed to Vespa, or
+        written to a feed file by an export.
+
+        :param duration: seconds the run took, by default the time since reset
+        """
+        if duration is None:
+            duration = time.monotonic() - self.started
+        with self._lock:
+            counters = {
+                _report_key(name, labels): value
+                for (name, labels), value in sorted(self._counters.items())
+            }
+            stages = {
+                _report_key(stage, labels): histogram.summary()
+                for (stage, labels), histogram in sorted(self._histograms.items())
+            }
+
+        def _per_second(total: float) -> float:
+            return total / duration if duration > 0 else 0.0
+
+        return {
+            "labels": dict(self.run_labels),
+            "duration_seconds": duration,
+            "documents_per_second": _per_second(
+                self.counter("documents_fed") + self.counter("documents_exported")
+            ),
+            "passages_per_second": _per_second(
+                self.counter("passages_fed") + self.counter("passages_exported")
+            ),
+            "bytes_per_second": _per_second(self.counter("bytes_read")),
+            "counters": counters,
+            "stages": stages,
+        }
+
+    def log_report(self, duration: Optional[float] = None) -> None:
+        report = self.report(duration)
+        _LOGGER.info(
+            f"Indexed {report['documents_per_second']:.2f} docs/s, "
+            f"{report['passages_per_second']:.2f} passages/s, "
+            f"{report['bytes_per_second']:.0f} bytes/s",
+            extra={"props": report},
+        )
+
+    def write_json(
+        self, json_path: Union[Path, S3Path], duration: Optional[float] = None
+    ) -> None:
+        json_path.write_text(json.dumps(self.report(duration), indent=2))
+        _LOGGER.info(f"Wrote metrics summary to {json_path}")
+
+    def to_prometheus(self, duration: Optional[float] = None) -> str:
+        """Render the metrics in the Prometheus text exposition format."""
+        report = self.report(duration)
+        lines = []
+        with self._lock:
+            counter_names = sorted({name for name, _ in self._counters})
+            for name in counter_names:
+                lines.append(f"# TYPE indexer_{name}_total counter")
+                for (counter_name, labels), value in sorted(self._counters.items()):
+                    if counter_name == name:
+                        lines.append(
+                            f"indexer_{name}_total"
+                            f"{_format_labels(self.run_labels + labels)} {value}"
+                        )
+
+            lines.append("# TYPE indexer_stage_seconds histogram")
+            for (stage, labels), histogram in sorted(self._histograms.items()):
+                labels = self.run_labels + (("stage", stage),) + labels
+                cumulative = 0
+                for bound, count in zip(
+                    LATENCY_BUCKETS + (float("inf"),), histogram.bucket_counts
+                ):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else str(bound)
+                    lines.append(
+                        "indexer_stage_seconds_bucket"
+                        f"{_format_labels(labels, le=le)} {cumulative}"
+                    )
+                lines.append(
+                    f"indexer_stage_seconds_sum{_format_labels(labels)} "
+                    f"{histogram.sum}"
+                )
+                lines.append(
+                    f"indexer_stage_seconds_count{_format_labels(labels)} "
+                    f"{histogram.count}"
+                )
+
+        for name in [
+            "duration_seconds",
+            "documents_per_second",
+            "passages_per_second",
+            "bytes_per_second",
+        ]:
+            lines.append(f"# TYPE indexer_{name} gauge")
+            lines.append(
+                f"indexer_{name}{_format_labels(self.run_labels)} {report[name]}"
+            )
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(
+        self, textfile_path: Union[Path, S3Path], duration: Optional[float] = None
+    ) -> None:
+        """
+        Write a Prometheus textfile.
+
+        Local files are written alongside then renamed, so the node exporter's
+        textfile collector never reads a partial file.
+        """
+        text = self.to_prometheus(duration)
+        if isinstance(textfile_path, S3Path):
+            textfile_path.write_text(text)
+        else:
+            temporary_path = textfile_path.with_name(f".{textfile_path.name}.tmp")
+            temporary_path.write_text(text)
+            temporary_path.replace(textfile_path)
+        _LOGGER.info(f"Wrote Prometheus metrics to {textfile_path}")
+
+
+# Metrics for the current indexing run, recorded into by every stage
+metrics = PipelineMetrics()
@@ -1,22 +1,101 @@
+import bisect
+from collections import deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+import hashlib
+import io
+import itertools
 from io import BytesIO
 import json
 import logging
 from pathlib import Path
-from typing import Any, Optional, Sequence, Tuple, Union, cast
+import struct
+import time
+from typing import (
+    AbstractSet,
+    Any,
+    Generator,
+    Iterable,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+    cast,
+)
+import zipfile
 
+from botocore.exceptions import ClientError
 import numpy as np
 
 from cloudpathlib import S3Path
 from cpr_data_access.parser_models import BlockType, ParserOutput, TextBlock
 
+from src.metrics import metrics
+
 _LOGGER = logging.getLogger(__name__)
 
+# Files checked for at once when indexing specific files
+_EXISTENCE_CHECK_WORKERS = 16
+
+# Ways a run's embeddings can be laid out, see `resolve_embedding_layout`
+EMBEDDING_LAYOUTS = ("auto", "container", "npy")
+
+# Bytes read from the end of an npz file for its zip directory, enough for the
+# directory of a container with hundreds of models' embeddings
+NPZ_DIRECTORY_BYTES = 64 * 1024
+
 
 def get_text_from_text_block(text_block: TextBlock) -> str:
     """Get the text from a TextBlock."""
     return "\n".join(text_block.text)
 
 
+def build_text_block_windows(
+    texts: Sequence[str], neighbours: int = 1, max_chars: int = 0
+) -> list[str]:
+    """
+    The text of each block with the text of its neighbours, joined by newlines.
+
+    Windows take up to `neighbours` blocks either side, nearest first and
+    alternating before and after. With a `max_chars` budget, neighbours that
+    would take the window over it are left out, though a window always includes
+    its own block.
+
+    The texts are joined once and each window is sliced out of the join using
+    the offsets of its blocks, so the cost of working out a window doesn't grow
+    with the length of its text.
+    """
+    joined = "\n".join(texts)
+    starts = []
+    ends = []
+    offset = 0
+    for text in texts:
+        starts.append(offset)
+        offset += len(text)
+        ends.append(offset)
+        offset += 1
+
+    windows = []
+    for i in range(len(texts)):
+        first = last = i
+        for _ in range(neighbours):
+            extended = False
+            if first > 0 and (
+                not max_chars or ends[last] - starts[first - 1] <= max_chars
+            ):
+                first -= 1
+                extended = True
+            if last < len(texts) - 1 and (
+                not max_chars or ends[last + 1] - starts[first] <= max_chars
+            ):
+                last += 1
+                extended = True
+            if not extended:
+                break
+        windows.append(joined[starts[first] : ends[last]])
+    return windows
+
+
 def build_indexer_input_path(indexer_input_dir: str, s3: bool) -> Union[S3Path, Path]:
     _LOGGER.info(
         f"Tasks will be retrieved from {'s3' if s3 else 'local'}: {indexer_input_dir}"
@@ -43,32 +122,112 @@ def parse_files_to_index(files_to_index):
         return []
 
 
-def get_index_paths(
-    indexer_input_path: str,
+def get_document_shard(document_id: str, shard_count: int) -> int:
+    """
+    The shard, out of shard_count, that a document belongs to.
+
+    Uses a stable hash of the document ID, so every worker agrees on the shard
+    regardless of process or listing order.
+    """
+    digest = hashlib.sha256(document_id.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % shard_count
+
+
+def _list_document_paths(
+    indexer_input_path: Union[Path, S3Path]
+) -> Generator[Union[Path, S3Path], None, None]:
+    """
+    Lazily list the parser output JSON in a directory, a page at a time on S3.
+
+    Hidden files, such as the indexer's own state files, are skipped.
+    """
+    for path in indexer_input_path.iterdir():
+        if path.suffix == ".json" and not path.name.startswith("."):
+            yield path
+
+
+def _find_document_paths(
+    indexer_input_path: Union[Path, S3Path], document_ids: Sequence[str]
+) -> Generator[Union[Path, S3Path], None, None]:
+    """Paths of the parser output JSON for the given documents that exist."""
+    paths = [indexer_input_path / f"{doc_id}.json" for doc_id in document_ids]
+    with ThreadPoolExecutor(max_workers=_EXISTENCE_CHECK_WORKERS) as executor:
+        for path, exists in zip(paths, executor.map(lambda p: p.exists(), paths)):
+            if exists:
+                yield path
+            else:
+                _LOGGER.warning(f"Missing file in the input directory for {path.stem}")
+
+
+def iter_index_paths(
+    indexer_input_path: Union[Path, S3Path],
     files_to_index: Optional[str] = None,
     limit: Optional[int] = None,
-) -> Tuple[Sequence[ParserOutput]]:
+    shard_index: int = 0,
+    shard_count: int = 1,
+) -> Generator[Union[Path, S3Path], None, None]:
+    """
+    Paths of the parser outputs to index, as they are found.
 
-    files_to_index = parse_files_to_index(files_to_index)
+    When files to index are given their paths are built from the IDs and
+    checked for, without listing the directory. Otherwise the directory is
+    listed lazily, so indexing can start before the listing finishes, and the
+    listing stops once the limit is reached.
 
-    paths = []
-    doc_ids = []
-    for i, path in enumerate(list(indexer_input_path.glob("*.json")), 1):
-        doc_id = path.stem
-        if files_to_index and (doc_id not in files_to_index):
-            continue
+    With more than one shard, only paths of documents in the given shard are
+    returned, so workers indexing each shard index disjoint sets of documents.
+    """
+    if shard_count < 1 or not 0 <= shard_index < shard_count:
+        raise ValueError(
+            f"Invalid shard {shard_index} of {shard_count}, the shard index must be "
+            "from 0 to one less than the shard count"
+        )
 
-        paths.append(path)
-        doc_ids.append(doc_id)
+    def _in_shard(doc_id: str) -> bool:
+        return (
+            shard_count == 1 or get_document_shard(doc_id, shard_count) == shard_index
+        )
+
+    files_to_index = parse_files_to_index(files_to_index)
+    if files_to_index:
+        paths = _find_document_paths(
+            indexer_input_path,
+            [doc_id for doc_id in files_to_index if _in_shard(doc_id)],
+        )
+    else:
+        paths = (
+            path
+            for path in _list_document_paths(indexer_input_path)
+            if _in_shard(path.stem)
+        )
 
-        if limit and i == limit:
+    count = 0
+    for path in paths:
+        yield path
+        count += 1
+        if limit and count >= limit:
             break
 
-    if missing_ids := set(files_to_index) - set(doc_ids):
-        _LOGGER.warning(
-            f"Missing files in the input directory for {', '.join(missing_ids)}"
+    if shard_count > 1:
+        _LOGGER.info(
+            f"Shard {shard_index} of {shard_count} has {count} documents",
+            extra={"props": {"shard_index": shard_index, "shard_count": shard_count}},
         )
-    return paths
+
+
+def get_index_paths(
+    indexer_input_path: Union[Path, S3Path],
+    files_to_index: Optional[str] = None,
+    limit: Optional[int] = None,
+    shard_index: int = 0,
+    shard_count: int = 1,
+) -> list[Union[Path, S3Path]]:
+    """Paths of the parser outputs to index, see iter_index_paths."""
+    return list(
+        iter_index_paths(
+            indexer_input_path, files_to_index, limit, shard_index, shard_count
+        )
+    )
 
 
 def replace_text_blocks(block: ParserOutput, new_text_blocks: list[TextBlock]):
@@ -81,54 +240,556 @@ def replace_text_blocks(block: ParserOutput, new_text_blocks: list[TextBlock]):
     return block
 
 
+def compile_block_types(names: Iterable[str]) -> frozenset[BlockType]:
+    """
+    The block types named, to filter text blocks on.
+
+    Names are matched against the title case of each block type. Names that
+    match no block type are warned about and ignored.
+    """
+    wanted = {name.strip() for name in names if name.strip()}
+    block_types = frozenset(
+        block_type for block_type in BlockType if block_type.value.title() in wanted
+    )
+    unknown = wanted - {block_type.value.title() for block_type in block_types}
+    if unknown:
+        _LOGGER.warning(
+            "Blocks to filter should be of a known block type, ignoring "
+            f"{', '.join(sorted(unknown))}.",
+            extra={"props": {"unknown_block_types": sorted(unknown)}},
+        )
+    return block_types
+
+
+class FilteredDocument(NamedTuple):
+    """A document with unwanted text blocks removed."""
+
+    parser_output: ParserOutput
+    # Number of blocks removed, by block type
+    removed_blocks: dict[str, int]
+
+
 def filter_blocks(
-    indexer_input: ParserOutput, remove_block_types: list[str]
-) -> list[TextBlock]:
-    """Filter the contained TextBlocks and return this as a list of TextBlocks."""
+    indexer_input: ParserOutput, remove_block_types: AbstractSet[BlockType]
+) -> Tuple[list[TextBlock], dict[str, int]]:
+    """
+    Filter the contained TextBlocks.
+
+    :return: the TextBlocks kept, and the number removed by block type
+    """
     filtered_blocks = []
+    removed_blocks: dict[str, int] = {}
     for block in indexer_input.get_text_blocks(including_invalid_html=True):
-        if block.type.title() not in remove_block_types:
+        if block.type not in remove_block_types:
             filtered_blocks.append(block)
         else:
-            _LOGGER.info(
-                f"Filtered {block.type} block from {indexer_input.document_id}.",
-                extra={
-                    "props": {
-                        "document_id": indexer_input.document_id,
-                        "block_type": block.type,
-                        "remove_block_types": remove_block_types,
-                    }
-                },
-            )
-    return filtered_blocks
+            block_type = block.type.value
+            removed_blocks[block_type] = removed_blocks.get(block_type, 0) + 1
+    return filtered_blocks, removed_blocks
 
 
 def filter_on_block_type(
-    input: ParserOutput, remove_block_types: list[str]
-) -> ParserOutput:
+    input: ParserOutput, remove_block_types: AbstractSet[BlockType]
+) -> FilteredDocument:
+    """
+    Remove unwanted TextBlocks from a document.
+
+    :param remove_block_types: block types to remove, from `compile_block_types`
+    """
+    filtered_blocks, removed_blocks = filter_blocks(
+        indexer_input=input, remove_block_types=remove_block_types
+    )
+    return FilteredDocument(
+        parser_output=replace_text_blocks(block=input, new_text_blocks=filtered_blocks),
+        removed_blocks=removed_blocks,
+    )
+
+
+def load_npy_buffer(buffer: bytes, offset: int = 0) -> np.ndarray:
+    """
+    Load an array from the bytes of an npy file without copying its data.
+
+    The returned array is a read-only view onto `buffer`.
+
+    :param offset: where the npy file starts in `buffer`
+    """
+    stream = BytesIO(buffer)
+    stream.seek(offset)
+    version = np.lib.format.read_magic(stream)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(stream)
+    elif version == (2, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(stream)
+    else:
+        return np.load(BytesIO(buffer[offset:]))
+
+    if dtype.hasobject:
+        return np.load(BytesIO(buffer[offset:]))
+
+    array = np.frombuffer(
+        buffer, dtype=dtype, count=int(np.prod(shape)), offset=stream.tell()
+    )
+    if fortran_order:
+        return array.reshape(shape[::-1]).transpose()
+    return array.reshape(shape)
+
+
+def read_npy_file(file_path: Union[Path, S3Path]) -> np.ndarray:
+    """
+    Read an npy file.
+
+    Local files are memory mapped, remote files are read once and loaded without
+    copying, in both cases the returned array is read-only.
+    """
+    if isinstance(file_path, Path):
+        return np.load(file_path, mmap_mode="r")
+    return load_npy_buffer(file_path.read_bytes())
+
+
+class DocumentInputs(NamedTuple):
+    """The raw files needed to index a single document."""
+
+    path: Union[S3Path, Path]
+    parser_output_json: str
+    embeddings: dict[str, np.ndarray]
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.parser_output_json) + sum(
+            embedding.nbytes for embedding in self.embeddings.values()
+        )
+
+
+def _load_npz_member(
+    archive: zipfile.ZipFile, info: zipfile.ZipInfo, buffer: bytes, offset: int = 0
+) -> np.ndarray:
+    """
+    Load an array in an npz file, from a buffer holding its bytes.
+
+    :param offset: where the buffer starts in the npz file
     """
-    Filter a sequence of IndexerInputs to remove unwanted TextBlocks.
+    if info.compress_type == zipfile.ZIP_STORED:
+        # The data follows the 30 byte local file header, then the file name
+        # and extra field, whose lengths end the header
+        header_offset = info.header_offset - offset
+        name_length, extra_length = struct.unpack_from(
+            "<HH", buffer, header_offset + 26
+        )
+        return load_npy_buffer(buffer, header_offset + 30 + name_length + extra_length)
+    with archive.open(info) as member:
+        return np.lib.format.read_array(member)
+
 
-    Unwanted text block types are the types declared in the remove block types array.
+def load_npz_buffer(
+    buffer: bytes, names: Optional[Iterable[str]] = None
+) -> dict[str, np.ndarray]:
     """
-    for _filter in remove_block_types:
+    Load the arrays in the bytes of an npz file, keyed by name.
+
+    Arrays stored uncompressed, as written by np.savez, are read-only views onto
+    `buffer`. Compressed arrays are decompressed into new arrays.
+
+    :param names: if given, only the arrays with these names are loaded
+    """
+    wanted = set(names) if names is not None else None
+    arrays = {}
+    with zipfile.ZipFile(BytesIO(buffer)) as archive:
+        for info in archive.infolist():
+            name = info.filename.removesuffix(".npy")
+            if wanted is None or name in wanted:
+                arrays[name] = _load_npz_member(archive, info, buffer)
+    return arrays
+
+
+def read_file_range(
+    file_path: Union[Path, S3Path], start: int, end: Optional[int] = None
+) -> Tuple[bytes, int]:
+    """
+    Read part of a file, in a single ranged request for S3.
+
+    :param start: where to start reading, or if negative how many bytes to read
+        from the end of the file
+    :param end: where to stop reading, by default the end of the file
+    :return Tuple[bytes, int]: the bytes read, and the size of the whole file
+    """
+    if isinstance(file_path, S3Path):
+        byte_range = (
+            f"bytes={start}"
+            if start < 0
+            else f"bytes={start}-{end - 1 if end is not None else ''}"
+        )
+        try:
+            response = file_path.client.client.get_object(
+                Bucket=file_path.bucket, Key=file_path.key, Range=byte_range
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                raise FileNotFoundError(str(file_path)) from e
+            raise
+        size = int(response["ContentRange"].rpartition("/")[2])
+        return response["Body"].read(), size
+
+    with open(file_path, "rb") as file:
+        size = file.seek(0, io.SEEK_END)
+        start = max(size + start, 0) if start < 0 else start
+        file.seek(start)
+        return file.read((size if end is None else min(end, size)) - start), size
+
+
+class _RangeReader(io.RawIOBase):
+    """
+    A file read in ranges, keeping the ranges read so they're only read once.
+
+    Ranges that will be needed can be read up front with `read_range`, in place
+    of the many small reads made by a reader of the file such as `zipfile`.
+    """
+
+    def __init__(self, file_path: Union[Path, S3Path], size: int):
+        self.file_path = file_path
+        self.size = size
+        self.position = 0
+        self.ranges: list[Tuple[int, bytes]] = []
+
+    def add_range(self, start: int, data: bytes) -> None:
+        self.ranges.append((start, data))
+
+    def read_range(self, start: int, end: int) -> bytes:
+        data, _ = read_file_range(self.file_path, start, end)
+        self.add_range(start, data)
+        return data
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = offset
+        return self.position
+
+    def readinto(self, buffer) -> int:
+        view = memoryview(buffer).cast("B")
+        end = min(self.position + len(view), self.size)
+        read = 0
+        while self.position < end:
+            start, data = next(
+                (
+                    (start, data)
+                    for start, data in self.ranges
+                    if start <= self.position < start + len(data)
+                ),
+                (self.position, None),
+            )
+            if data is None:
+                data = self.read_range(self.position, end)
+            chunk = data[self.position - start : end - start]
+            view[read : read + len(chunk)] = chunk
+            read += len(chunk)
+            self.position += len(chunk)
+        return read
+
+
+def read_npz_file(
+    file_path: Union[Path, S3Path],
+    names: Optional[Iterable[str]] = None,
+    directory_bytes: int = NPZ_DIRECTORY_BYTES,
+) -> dict[str, np.ndarray]:
+    """
+    Read the arrays in an npz file, keyed by name, only reading those wanted.
+
+    The end of the file, holding its zip directory, is read first, then each
+    wanted array in a read of its own, so the others aren't downloaded. Files no
+    bigger than `directory_bytes` are read whole in the first read.
+
+    :param names: if given, only the arrays with these names are read
+    """
+    tail, size = read_file_range(file_path, -directory_bytes)
+    if len(tail) == size:
+        return load_npz_buffer(tail, names)
+
+    wanted = set(names) if names is not None else None
+    reader = _RangeReader(file_path, size)
+    reader.add_range(size - len(tail), tail)
+    arrays = {}
+    with zipfile.ZipFile(reader) as archive:
+        infos = archive.infolist()
+        # Each member runs up to the next, the last up to the zip directory
+        offsets = sorted(info.header_offset for info in infos) + [size]
+        for info in infos:
+            name = info.filename.removesuffix(".npy")
+            if wanted is not None and name not in wanted:
+                continue
+            end = offsets[bisect.bisect_right(offsets, info.header_offset)]
+            buffer = reader.read_range(info.header_offset, end)
+            arrays[name] = _load_npz_member(archive, info, buffer, info.header_offset)
+    return arrays
+
+
+def get_embedding_path(
+    embedding_dir_as_path: Union[Path, S3Path], document_id: str, model_slug: str
+) -> Union[Path, S3Path]:
+    """Get the path to the embeddings .npy file for a document and model."""
+    return embedding_dir_as_path / f"{document_id}__{model_slug}.npy"
+
+
+def get_embedding_container_path(
+    embedding_dir_as_path: Union[Path, S3Path], document_id: str
+) -> Union[Path, S3Path]:
+    """
+    Get the path to the container of every model's embeddings for a document.
+
+    The container is an npz file, as written by np.savez, holding an array of
+    embeddings for each model named by the model's slug.
+    """
+    return embedding_dir_as_path / f"{document_id}.npz"
+
+
+def write_embedding_container(
+    container_path: Union[Path, S3Path], embeddings: dict[str, np.ndarray]
+) -> None:
+    """Write the embeddings of each model for a document to a single container."""
+    buffer = BytesIO()
+    np.savez(buffer, **embeddings)
+    container_path.write_bytes(buffer.getvalue())
+
+
+def resolve_embedding_layout(
+    embedding_dir_as_path: Union[Path, S3Path], document_id: str, layout: str
+) -> str:
+    """
+    The layout to read a run's embeddings with first, either "container" or "npy".
+
+    The "auto" layout is decided by whether the first document of the run has
+    an embeddings container, so later documents aren't each looked for. Any
+    laid out otherwise are still read, see `read_embeddings`.
+
+    :param document_id: the first document of the run
+    :param layout: one of `EMBEDDING_LAYOUTS`
+    """
+    if layout != "auto":
+        return layout
+    if get_embedding_container_path(embedding_dir_as_path, document_id).exists():
+        layout = "container"
+    else:
+        layout = "npy"
+    _LOGGER.info(
+        f"Reading embeddings with the {layout} layout, found for {document_id}"
+    )
+    return layout
+
+
+def read_embeddings(
+    embedding_dir_as_path: Union[Path, S3Path],
+    document_id: str,
+    model_slugs: Sequence[str],
+    executor: Optional[Executor] = None,
+    layout: str = "container",
+) -> dict[str, np.ndarray]:
+    """
+    Read a document's embeddings for each model.
+
+    With the container layout they're read from the document's container when it
+    exists, reading only these models' arrays from it, falling back to each
+    model's npy file for models it doesn't hold. With the npy layout each
+    model's npy file is read, only looking for a container if one is missing.
+
+    :param executor: if given, npy files are read concurrently on it
+    :param layout: either "container" or "npy", see `resolve_embedding_layout`
+    """
+    if layout == "npy":
         try:
-            BlockType(_filter)
-        except NameError:
-            _LOGGER.warning(
-                "Blocks to filter should be of a known block type, "
-                f"removing {_filter} from the list."
+            return _read_npy_files(
+                embedding_dir_as_path, document_id, model_slugs, executor
+            )
+        except FileNotFoundError:
+            # The layout may have been resolved from a document laid out otherwise
+            embeddings = _read_container(
+                embedding_dir_as_path, document_id, model_slugs
             )
-            remove_block_types.remove(_filter)
+            if not embeddings:
+                raise
+    else:
+        embeddings = _read_container(embedding_dir_as_path, document_id, model_slugs)
+
+    missing_slugs = [slug for slug in model_slugs if slug not in embeddings]
+    embeddings.update(
+        _read_npy_files(embedding_dir_as_path, document_id, missing_slugs, executor)
+    )
+    return {model_slug: embeddings[model_slug] for model_slug in model_slugs}
+
+
+def _read_container(
+    embedding_dir_as_path: Union[Path, S3Path],
+    document_id: str,
+    model_slugs: Sequence[str],
+) -> dict[str, np.ndarray]:
+    """The models' arrays held by a document's container, if it has one."""
+    start = time.perf_counter()
+    try:
+        embeddings = read_npz_file(
+            get_embedding_container_path(embedding_dir_as_path, document_id),
+            model_slugs,
+        )
+    except FileNotFoundError:
+        return {}
+    metrics.observe("load_npz", time.perf_counter() - start)
+    return embeddings
+
+
+def _read_npy_files(
+    embedding_dir_as_path: Union[Path, S3Path],
+    document_id: str,
+    model_slugs: Sequence[str],
+    executor: Optional[Executor] = None,
+) -> dict[str, np.ndarray]:
+    npy_paths = [
+        get_embedding_path(embedding_dir_as_path, document_id, model_slug)
+        for model_slug in model_slugs
+    ]
+    if executor is not None:
+        return dict(zip(model_slugs, executor.map(_read_npy, npy_paths)))
+    return {
+        model_slug: _read_npy(npy_path)
+        for model_slug, npy_path in zip(model_slugs, npy_paths)
+    }
 
-    return replace_text_blocks(
-        block=input,
-        new_text_blocks=filter_blocks(
-            indexer_input=input, remove_block_types=remove_block_types
-        ),
+
+def _read_npy(file_path: Union[Path, S3Path]) -> np.ndarray:
+    with metrics.time("load_npy"):
+        return read_npy_file(file_path)
+
+
+def _read_parser_output_json(path: Union[S3Path, Path]) -> str:
+    with metrics.time("read"):
+        return path.read_text()
+
+
+def _record_document_inputs(inputs: DocumentInputs) -> DocumentInputs:
+    metrics.increment("bytes_read", inputs.nbytes)
+    return inputs
+
+
+def read_document_inputs(
+    path: Union[S3Path, Path],
+    embedding_dir_as_path: Union[Path, S3Path],
+    model_slugs: Sequence[str],
+    layout: str = "container",
+) -> DocumentInputs:
+    """
+    Read the parser output and embeddings for a document.
+
+    :param layout: how embeddings are laid out, see `read_embeddings`
+    """
+    parser_output_json = _read_parser_output_json(path)
+    embeddings = read_embeddings(
+        embedding_dir_as_path, path.stem, model_slugs, layout=layout
+    )
+    return _record_document_inputs(
+        DocumentInputs(
+            path=path, parser_output_json=parser_output_json, embeddings=embeddings
+        )
     )
 
 
-def read_npy_file(file_path: Path) -> Any:
-    """Read an npy file."""
-    return np.load(BytesIO(file_path.read_bytes()))
+def prefetch_document_inputs(
+    paths: Iterable[Union[S3Path, Path]],
+    embedding_dir_as_path: Union[Path, S3Path],
+    model_slugs: Sequence[str],
+    depth: int,
+    max_bytes: int,
+    layout: str = "auto",
+) -> Generator[DocumentInputs, None, None]:
+    """
+    Read document inputs ahead of them being consumed.
+
+    The JSON and embeddings, from a container or each model's file, for the
+    next `depth` documents are read concurrently on a thread pool, so reads
+    from S3 overlap each other and the work done on the documents already read.
+    Reading ahead pauses while the documents that have been read but not
+    consumed hold `max_bytes` or more.
+
+    :param paths: paths to the parser output JSON for each document
+    :param embedding_dir_as_path: directory containing embeddings containers or
+        .npy files
+    :param model_slugs: the models to read embeddings for
+    :param depth: the maximum number of documents to read ahead, 0 reads
+        each document only when it is needed
+    :param max_bytes: the buffered byte budget for documents read ahead
+    :param layout: how embeddings are laid out, one of `EMBEDDING_LAYOUTS`,
+        resolved once from the first document to decide which is read first
+    :yield Generator[DocumentInputs, None, None]: the inputs for each document,
+        in the same order as the paths.
+    """
+    remaining = iter(paths)
+    first_path = next(remaining, None)
+    if first_path is None:
+        return
+    layout = resolve_embedding_layout(embedding_dir_as_path, first_path.stem, layout)
+    remaining = itertools.chain([first_path], remaining)
+
+    if depth < 1:
+        for path in remaining:
+            yield read_document_inputs(path, embedding_dir_as_path, model_slugs, layout)
+        return
+
+    def _buffered_bytes(pending) -> int:
+        total = 0
+        for _, text_future, embeddings_future in pending:
+            if text_future.done() and not text_future.exception():
+                total += len(text_future.result())
+            if embeddings_future.done() and not embeddings_future.exception():
+                total += sum(
+                    embedding.nbytes
+                    for embedding in embeddings_future.result().values()
+                )
+        return total
+
+    exhausted = False
+    # Each document reads its JSON, and its embeddings on a task that reads any
+    # per model files on tasks of its own, so every task read ahead has a worker
+    with ThreadPoolExecutor(max_workers=depth * (len(model_slugs) + 2)) as executor:
+        pending: deque[Tuple[Any, Future, Future]] = deque()
+        while True:
+            while (
+                not exhausted
+                and len(pending) < depth
+                and (not pending or _buffered_bytes(pending) < max_bytes)
+            ):
+                path = next(remaining, None)
+                if path is None:
+                    exhausted = True
+                    break
+                pending.append(
+                    (
+                        path,
+                        executor.submit(_read_parser_output_json, path),
+                        executor.submit(
+                            read_embeddings,
+                            embedding_dir_as_path,
+                            path.stem,
+                            model_slugs,
+                            executor,
+                            layout,
+                        ),
+                    )
+                )
+
+            if not pending:
+                return
+
+            path, text_future, embeddings_future = pending.popleft()
+            yield _record_document_inputs(
+                DocumentInputs(
+                    path=path,
+                    parser_output_json=text_future.result(),
+                    embeddings=embeddings_future.result(),
+                )
+            )
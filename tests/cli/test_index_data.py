@@ -1,20 +1,35 @@
 from pathlib import Path
+import shutil
+from unittest.mock import patch
 
+from click.testing import CliRunner
 import pytest
 from vespa.application import Vespa
 
+from benchmarks.fake_vespa import FakeVespa
+from cli.index_data import run_as_cli
+from src import config
 from src.index.vespa_ import (
     _NAMESPACE,
     DOCUMENT_PASSAGE_SCHEMA,
     FAMILY_DOCUMENT_SCHEMA,
     SEARCH_WEIGHTS_SCHEMA,
     get_document_generator,
+    populate_vespa,
 )
+from src.manifest import read_checkpoint
+from src.metrics import metrics
+from tests.conftest import write_fixture_embeddings
 
 
 @pytest.fixture()
-def test_input_dir() -> Path:
-    return (Path(__file__).parent / "test_data" / "index_data_input").resolve()
+def test_input_dir(tmp_path) -> Path:
+    for path in (Path(__file__).parent / "test_data" / "index_data_input").glob(
+        "*.json"
+    ):
+        shutil.copy(path, tmp_path / path.name)
+    write_fixture_embeddings(tmp_path)
+    return tmp_path
 
 
 @pytest.mark.usefixtures("cleanup_test_vespa_before", "cleanup_test_vespa_after")
@@ -65,3 +80,88 @@ def test_vespa_document_generator(
     assert search_weights_ref is not None
     assert last_family_ref is not None
     assert last_passage_ref is not None
+
+
+@pytest.mark.parametrize(
+    "args,want_checkpoint,want_resume",
+    [
+        ([], None, False),
+        (["--checkpoint", "elsewhere.json"], "elsewhere.json", False),
+        (["--checkpoint", "elsewhere.json", "--resume"], "elsewhere.json", True),
+    ],
+)
+def test_run_as_cli__checkpoint(
+    test_input_dir: Path, monkeypatch, args, want_checkpoint, want_resume
+):
+    monkeypatch.chdir(test_input_dir)
+    with patch("cli.index_data.populate_vespa") as populate_vespa:
+        result = CliRunner().invoke(
+            run_as_cli, [str(test_input_dir), "--index-type", "vespa"] + args
+        )
+
+    assert result.exit_code == 0, result.output
+    kwargs = populate_vespa.call_args.kwargs
+    if want_checkpoint is None:
+        assert kwargs["checkpoint_path"] is None
+    else:
+        assert kwargs["checkpoint_path"].resolve() == test_input_dir / want_checkpoint
+    assert kwargs["resume"] is want_resume
+
+
+def test_run_as_cli__resume_needs_checkpoint(test_input_dir: Path):
+    with patch("cli.index_data.populate_vespa") as populate_vespa:
+        result = CliRunner().invoke(
+            run_as_cli, [str(test_input_dir), "--index-type", "vespa", "--resume"]
+        )
+
+    assert result.exit_code == 2
+    populate_vespa.assert_not_called()
+
+
+def test_run_as_cli__resumes_interrupted_run(test_input_dir: Path, tmp_path_factory):
+    # The fixtures' import IDs all differ from their document IDs
+    paths = [
+        test_input_dir / f"{document_id}.json"
+        for document_id in ["test_html", "test_pdf", "test_no_content_type"]
+    ]
+    checkpoint_path = tmp_path_factory.mktemp("checkpoint") / "checkpoint.json"
+
+    def _interrupted(paths):
+        yield from paths[:2]
+        raise KeyboardInterrupt
+
+    with FakeVespa() as fake_vespa, patch.multiple(
+        config,
+        VESPA_INSTANCE_URL=fake_vespa.url,
+        DEVELOPMENT_MODE=True,
+        VESPA_DOCUMENT_BATCH_SIZE=1,
+        PREFETCH_DEPTH=0,
+        VESPA_QUERY_LOOKAHEAD=0,
+    ):
+        with pytest.raises(KeyboardInterrupt):
+            populate_vespa(
+                paths=_interrupted(paths),
+                embedding_dir_as_path=test_input_dir,
+                checkpoint_path=checkpoint_path,
+            )
+    assert read_checkpoint(checkpoint_path).completed_document_ids == [paths[0].stem]
+
+    with FakeVespa() as fake_vespa, patch.multiple(
+        config,
+        VESPA_INSTANCE_URL=fake_vespa.url,
+        DEVELOPMENT_MODE=True,
+    ):
+        result = CliRunner().invoke(
+            run_as_cli,
+            [str(test_input_dir), "--index-type", "vespa"]
+            + ["--checkpoint", str(checkpoint_path), "--resume"],
+        )
+
+    assert result.exit_code == 0, result.output
+    assert metrics.report()["counters"]["documents_prepared"] == 2
+    assert {
+        document_id.rsplit(".", 1)[0]
+        for schema, document_id in fake_vespa.documents
+        if schema == DOCUMENT_PASSAGE_SCHEMA
+    } == {"test_pdf"}
+    assert not checkpoint_path.exists()
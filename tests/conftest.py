@@ -1,11 +1,14 @@
+import hashlib
 import json
 import pytest as pytest
 import os
+import shutil
 from cloudpathlib import S3Path
 
 from pathlib import Path
 from datetime import datetime
 
+import numpy as np
 from vespa.application import Vespa
 from tenacity import RetryError
 
@@ -17,6 +20,7 @@ from cpr_data_access.parser_models import (
     BlockType,
     PDFPageMetadata,
 )
+from src.index.embedding_models import DEFAULT_EMBEDDING_MODELS
 from src.index.vespa_ import _SCHEMAS_TO_PROCESS, _NAMESPACE
 from src.config import VESPA_INSTANCE_URL
 
@@ -80,6 +84,43 @@ def get_parser_output(document_id: int, family_id: int) -> ParserOutput:
     )
 
 
+def _text_embedding(text: str, dimension: int) -> np.ndarray:
+    seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "big")
+    return np.random.default_rng(seed).standard_normal(dimension, dtype=np.float32)
+
+
+def write_fixture_embeddings(embedding_dir: Path) -> None:
+    """
+    Write embeddings from every default model for each parser output in a directory.
+
+    The first row embeds the description, and the rest each text block. Each
+    is derived from its text, so identical text blocks have identical embeddings.
+    """
+    for path in embedding_dir.glob("*.json"):
+        parser_output = json.loads(path.read_text())
+        text_blocks = (
+            parser_output.get("pdf_data") or parser_output.get("html_data") or {}
+        ).get("text_blocks", [])
+        texts = [parser_output["document_description"]] + [
+            " ".join(text_block["text"]) for text_block in text_blocks
+        ]
+        for model in DEFAULT_EMBEDDING_MODELS:
+            np.save(
+                embedding_dir / f"{path.stem}__{model.slug}.npy",
+                np.stack([_text_embedding(text, model.dimension) for text in texts]),
+            )
+
+
+@pytest.fixture(scope="session")
+def s3_files_dir(tmp_path_factory) -> Path:
+    """The s3_files parser outputs, with embeddings from every default model."""
+    embedding_dir = tmp_path_factory.mktemp("s3_files")
+    for path in (FIXTURE_DIR / "s3_files").glob("*.json"):
+        shutil.copy(path, embedding_dir / path.name)
+    write_fixture_embeddings(embedding_dir)
+    return embedding_dir
+
+
 @pytest.fixture
 def s3_bucket_and_region() -> dict:
     return {
@@ -0,0 +1,54 @@
+import numpy as np
+
+from src.index.deduplication import find_duplicate_passages, normalize_text
+
+
+def test_normalize_text():
+    assert normalize_text("  Annual  REPORT\n2023 ") == "annual report 2023"
+
+
+def test_find_duplicate_passages__exact():
+    texts = ["Annual Report", "Some text", "annual  report", "Other text"]
+
+    assert find_duplicate_passages(texts).tolist() == [False, False, True, False]
+    assert find_duplicate_passages([]).tolist() == []
+
+
+def test_find_duplicate_passages__near():
+    rng = np.random.default_rng(0)
+    header, body, other = rng.normal(size=(3, 384)).astype(np.float32)
+    embeddings = np.stack(
+        [
+            header,
+            body,
+            header + 0.01 * rng.normal(size=384).astype(np.float32),
+            other,
+            np.zeros(384, dtype=np.float32),
+        ]
+    )
+    texts = ["Report - page 1", "Body", "Report - page 2", "Other", ""]
+
+    assert find_duplicate_passages(texts, embeddings).tolist() == [
+        False,
+        False,
+        True,
+        False,
+        False,
+    ]
+    assert find_duplicate_passages(texts, embeddings, threshold=1.1).tolist() == [
+        False
+    ] * len(texts)
+
+
+def test_find_duplicate_passages__near_only_matches_kept_passages():
+    # The third passage is close to the second, which is a duplicate of the first,
+    # but not close to the first
+    base = np.zeros(8, dtype=np.float32)
+    base[0] = 1.0
+    step = np.zeros(8, dtype=np.float32)
+    step[1] = 0.15
+    embeddings = np.stack([base, base + step, base + 2 * step])
+
+    duplicates = find_duplicate_passages(["a", "b", "c"], embeddings, threshold=0.985)
+
+    assert duplicates.tolist() == [False, True, False]
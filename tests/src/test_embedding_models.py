@@ -0,0 +1,112 @@
+import json
+
+import pytest
+
+from src.config import ConfigError, _parse_model_cell_types
+from src.index.embedding_models import (
+    DEFAULT_EMBEDDING_MODELS,
+    EmbeddingModel,
+    get_embedding_models,
+    read_model_registry,
+)
+
+E5_SMALL = {"slug": "e5-small", "field": "text_embedding_e5_small", "dimension": 384}
+
+
+def test_read_model_registry__defaults():
+    assert list(read_model_registry().values()) == list(DEFAULT_EMBEDDING_MODELS)
+
+
+def test_read_model_registry__adds_and_replaces(tmp_path):
+    registry = json.dumps(
+        [
+            E5_SMALL,
+            {
+                "slug": "baai-bge-small-en-v1-5",
+                "field": "text_embedding_bge_small",
+                "dimension": 384,
+                "cell_type": "bfloat16",
+            },
+        ]
+    )
+    registry_path = tmp_path / "models.json"
+    registry_path.write_text(registry)
+
+    for models in [
+        read_model_registry(registry),
+        read_model_registry(str(registry_path)),
+    ]:
+        assert list(models) == [model.slug for model in DEFAULT_EMBEDDING_MODELS] + [
+            "e5-small"
+        ]
+        assert models["e5-small"] == EmbeddingModel(
+            "e5-small", "text_embedding_e5_small", 384, "float"
+        )
+        assert models["baai-bge-small-en-v1-5"].cell_type == "bfloat16"
+
+
+@pytest.mark.parametrize(
+    "registry",
+    ["[{", '[{"slug": "e5-small", "dimension": 384}]', '[{"slug": "e5-small"}]'],
+)
+def test_read_model_registry__invalid(registry):
+    with pytest.raises(ConfigError):
+        read_model_registry(registry)
+
+
+def test_get_embedding_models__selected():
+    models = get_embedding_models(
+        registry=json.dumps([E5_SMALL]),
+        selected=["e5-small", "baai-bge-base-en-v1-5"],
+        cell_types={"e5-small": "int8"},
+    )
+
+    # Models keep the registry's order, not the selection's
+    assert list(models) == ["baai-bge-base-en-v1-5", "e5-small"]
+    assert models["e5-small"].cell_type == "int8"
+    assert models["baai-bge-base-en-v1-5"].cell_type == "float"
+
+
+def test_get_embedding_models__all_by_default():
+    models = get_embedding_models(registry="", selected=[], cell_types={})
+    assert list(models.values()) == list(DEFAULT_EMBEDDING_MODELS)
+
+
+@pytest.mark.parametrize(
+    "selected,cell_types",
+    [
+        (["e5-small"], {}),
+        ([], {"e5-small": "int8"}),
+        ([], {"baai-bge-base-en-v1-5": "int4"}),
+        # Cell types of models that aren't selected are checked too
+        (["baai-bge-small-en-v1-5"], {"baai-bge-base-en-v1-5": "int4"}),
+    ],
+)
+def test_get_embedding_models__invalid(selected, cell_types):
+    with pytest.raises(ConfigError):
+        get_embedding_models(registry="", selected=selected, cell_types=cell_types)
+
+
+def test_get_embedding_models__duplicate_fields():
+    registry = json.dumps([{**E5_SMALL, "field": "text_embedding_bge_small"}])
+
+    with pytest.raises(ConfigError):
+        get_embedding_models(registry=registry, selected=[], cell_types={})
+    get_embedding_models(
+        registry=registry, selected=["e5-small", "baai-bge-base-en-v1-5"], cell_types={}
+    )
+
+
+def test_parse_model_cell_types():
+    assert _parse_model_cell_types(
+        "CELL_TYPES", " model-a=bfloat16, model-b = INT8 ,"
+    ) == {"model-a": "bfloat16", "model-b": "int8"}
+    assert _parse_model_cell_types("CELL_TYPES", "") == {}
+
+
+@pytest.mark.parametrize(
+    "value", ["model-a", "model-a=", "=int8", "model-a=int8,model-a=float"]
+)
+def test_parse_model_cell_types__invalid(value):
+    with pytest.raises(ConfigError, match="CELL_TYPES"):
+        _parse_model_cell_types("CELL_TYPES", value)
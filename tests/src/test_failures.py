@@ -0,0 +1,52 @@
+import json
+
+import pytest
+from vespa.io import VespaResponse
+
+from src.index.failures import FeedFailures, is_retryable, retry_backoff
+
+
+def test_is_retryable():
+    assert is_retryable(429)
+    assert is_retryable(503)
+    assert is_retryable(599)
+    assert not is_retryable(400)
+    assert not is_retryable(412)
+
+
+@pytest.mark.parametrize("attempt", [1, 2, 5, 20])
+def test_retry_backoff(attempt):
+    for _ in range(100):
+        assert (
+            0
+            <= retry_backoff(attempt, base=1, maximum=10)
+            <= min(10, 2 ** (attempt - 1))
+        )
+
+
+def test_feed_failures__write_dead_letter(tmp_path):
+    failures = FeedFailures()
+    assert not failures
+
+    response = VespaResponse(
+        json={"message": "bad field"},
+        status_code=400,
+        url="n/a",
+        operation_type="feed",
+    )
+    failures.add("document_passage", "doc.1.0", response, attempts=1)
+    assert len(failures) == 1
+
+    dead_letter_path = tmp_path / "dead_letter.jsonl"
+    failures.write_dead_letter(dead_letter_path)
+    lines = dead_letter_path.read_text().splitlines()
+    assert [json.loads(line) for line in lines] == [
+        {
+            "schema": "document_passage",
+            "id": "doc.1.0",
+            "operation_type": "feed",
+            "status_code": 400,
+            "attempts": 1,
+            "message": '{"message": "bad field"}',
+        }
+    ]
@@ -0,0 +1,39 @@
+import pytest
+
+from src.index.feed_files import FeedFileWriter, read_feed_file
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_feed_file_writer(tmp_path, compress):
+    with FeedFileWriter(
+        tmp_path / "feed", "doc_search", operations_per_file=3, compress=compress
+    ) as writer:
+        for document in range(3):
+            writer.start_document()
+            writer.put("family_document", f"doc.{document}", {"n": document})
+            writer.put("document_passage", f"doc.{document}.0", {"n": document})
+        writer.remove("document_passage", "doc.2.1")
+
+    # Files are only split between documents, so the first runs over
+    assert [path.name for path in writer.paths] == [
+        f"feed-00000.jsonl{'.gz' if compress else ''}",
+        f"feed-00001.jsonl{'.gz' if compress else ''}",
+    ]
+    assert writer.operation_counts == {"put": 6, "remove": 1}
+    assert read_feed_file(writer.paths[0]) == [
+        {"put": "id:doc_search:family_document::doc.0", "fields": {"n": 0}},
+        {"put": "id:doc_search:document_passage::doc.0.0", "fields": {"n": 0}},
+        {"put": "id:doc_search:family_document::doc.1", "fields": {"n": 1}},
+        {"put": "id:doc_search:document_passage::doc.1.0", "fields": {"n": 1}},
+    ]
+    assert read_feed_file(writer.paths[1]) == [
+        {"put": "id:doc_search:family_document::doc.2", "fields": {"n": 2}},
+        {"put": "id:doc_search:document_passage::doc.2.0", "fields": {"n": 2}},
+        {"remove": "id:doc_search:document_passage::doc.2.1"},
+    ]
+
+
+def test_feed_file_writer__no_operations(tmp_path):
+    with FeedFileWriter(tmp_path, "doc_search", operations_per_file=10) as writer:
+        writer.start_document()
+    assert writer.paths == []
@@ -0,0 +1,59 @@
+from src.index.flow_control import AdaptiveFlowController
+
+
+def get_controller(**kwargs) -> AdaptiveFlowController:
+    settings = dict(initial=4, minimum=1, maximum=8, target_latency=1.0, cooldown=0)
+    settings.update(kwargs)
+    return AdaptiveFlowController(**settings)
+
+
+def test_limit_is_clamped():
+    assert get_controller(initial=100).limit == 8
+    assert get_controller(initial=0).limit == 1
+
+
+def test_additive_increase():
+    controller = get_controller()
+    for _ in range(4):
+        controller.record(latency=0.1, status_code=200)
+    assert controller.limit == 5
+
+    for _ in range(100):
+        controller.record(latency=0.1, status_code=200)
+    assert controller.limit == 8
+
+
+def test_multiplicative_decrease():
+    controller = get_controller(initial=8)
+
+    controller.record(latency=0.1, status_code=429)
+    assert controller.limit == 4
+
+    controller.record(latency=5.0, status_code=200)
+    assert controller.limit == 2
+
+    for _ in range(10):
+        controller.record(latency=0.1, status_code=503)
+    assert controller.limit == 1
+
+
+def test_decrease_cooldown():
+    controller = get_controller(initial=8, cooldown=60)
+    for _ in range(10):
+        controller.record(latency=0.1, status_code=429)
+    assert controller.limit == 4
+
+
+def test_pause():
+    controller = get_controller(cooldown=1, max_pause=3)
+    assert controller.pause() == 0
+
+    controller.record(latency=0.1, status_code=429)
+    assert controller.pause() == 1
+    controller.record(latency=0.1, status_code=429)
+    assert controller.pause() == 2
+    controller.record(latency=0.1, status_code=429)
+    assert controller.pause() == 3
+
+    controller.record(latency=0.1, status_code=200)
+    assert controller.pause() == 0
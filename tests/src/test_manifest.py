@@ -0,0 +1,146 @@
+import os
+from unittest.mock import MagicMock
+
+from cloudpathlib import S3Path
+import pytest
+
+from src.manifest import (
+    IndexCheckpoint,
+    IndexManifest,
+    PassageState,
+    get_document_fingerprint,
+    list_file_fingerprints,
+    read_checkpoint,
+    read_manifest,
+    read_passage_state,
+    shard_file_name,
+    write_checkpoint,
+    write_manifest,
+    write_passage_state,
+)
+
+MODEL_SLUGS = ["model-a", "model-b"]
+
+
+@pytest.fixture
+def input_dir(tmp_path):
+    for doc_id in ["doc.1", "doc.2"]:
+        (tmp_path / f"{doc_id}.json").write_text(f'{{"document_id": "{doc_id}"}}')
+        for model_slug in MODEL_SLUGS:
+            (tmp_path / f"{doc_id}__{model_slug}.npy").write_bytes(b"embeddings")
+    return tmp_path
+
+
+def test_list_file_fingerprints(input_dir):
+    got = list_file_fingerprints(input_dir)
+    assert set(got) == {path.name for path in input_dir.iterdir()}
+
+
+def test_list_file_fingerprints__documents(input_dir):
+    (input_dir / "doc.10.json").write_text('{"document_id": "doc.10"}')
+    (input_dir / "doc.1.npz").write_bytes(b"container")
+
+    got = list_file_fingerprints(input_dir, {"doc.1"})
+
+    assert set(got) == {
+        "doc.1.json",
+        "doc.1.npz",
+        "doc.1__model-a.npy",
+        "doc.1__model-b.npy",
+    }
+    assert got == {
+        name: fingerprint
+        for name, fingerprint in list_file_fingerprints(input_dir).items()
+        if name in got
+    }
+
+
+def test_list_file_fingerprints__s3_lists_each_document():
+    indexer_input_path = MagicMock(spec=S3Path, bucket="bucket", key="input")
+    indexer_input_path.client = MagicMock()
+    paginator = indexer_input_path.client.client.get_paginator.return_value
+    paginator.paginate.side_effect = lambda Bucket, Prefix, Delimiter: [
+        {
+            "Contents": [
+                {"Key": key, "ETag": '"etag"', "Size": 1}
+                for key in ["input/doc.1.json", "input/doc.10.json", "input/doc.2.json"]
+                if key.startswith(Prefix)
+            ]
+        }
+    ]
+
+    got = list_file_fingerprints(indexer_input_path, {"doc.1", "doc.3"})
+
+    assert got == {"doc.1.json": "etag:1"}
+    assert sorted(
+        call.kwargs["Prefix"] for call in paginator.paginate.call_args_list
+    ) == ["input/doc.1", "input/doc.3"]
+
+
+def test_get_document_fingerprint(input_dir):
+    before = list_file_fingerprints(input_dir)
+    doc_1 = get_document_fingerprint("doc.1", before, MODEL_SLUGS)
+    doc_2 = get_document_fingerprint("doc.2", before, MODEL_SLUGS)
+    assert doc_1 is not None
+    assert doc_2 is not None
+
+    embedding_path = input_dir / "doc.1__model-b.npy"
+    embedding_path.write_bytes(b"changed embeddings")
+    stat = embedding_path.stat()
+    os.utime(embedding_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+
+    after = list_file_fingerprints(input_dir)
+    assert get_document_fingerprint("doc.1", after, MODEL_SLUGS) != doc_1
+    assert get_document_fingerprint("doc.2", after, MODEL_SLUGS) == doc_2
+
+
+def test_get_document_fingerprint__missing_file(input_dir):
+    (input_dir / "doc.1__model-a.npy").unlink()
+    fingerprints = list_file_fingerprints(input_dir)
+    assert get_document_fingerprint("doc.1", fingerprints, MODEL_SLUGS) is None
+
+
+def test_get_document_fingerprint__container(input_dir):
+    (input_dir / "doc.1.npz").write_bytes(b"container")
+    before = list_file_fingerprints(input_dir)
+    doc_1 = get_document_fingerprint("doc.1", before, MODEL_SLUGS)
+
+    # Per model files are ignored for documents with a container
+    (input_dir / "doc.1__model-a.npy").unlink()
+    after = list_file_fingerprints(input_dir)
+    assert get_document_fingerprint("doc.1", after, MODEL_SLUGS) == doc_1
+
+
+def test_read_write_manifest(tmp_path):
+    manifest_path = tmp_path / "manifest.json"
+    assert read_manifest(manifest_path) == IndexManifest()
+
+    manifest = IndexManifest(documents={"doc.1": "abc"})
+    write_manifest(manifest_path, manifest)
+    assert read_manifest(manifest_path) == manifest
+
+
+def test_read_write_passage_state(tmp_path):
+    passage_state_path = tmp_path / "passage_state.json"
+    assert read_passage_state(passage_state_path) == PassageState()
+
+    passage_state = PassageState(documents={"family.1": {"doc.1.0": "abc"}})
+    write_passage_state(passage_state_path, passage_state)
+    assert read_passage_state(passage_state_path) == passage_state
+
+
+def test_read_write_checkpoint(tmp_path):
+    checkpoint_path = tmp_path / "checkpoint.json"
+    assert read_checkpoint(checkpoint_path) == IndexCheckpoint()
+
+    checkpoint = IndexCheckpoint(position=1, completed_document_ids=["doc.1"])
+    write_checkpoint(checkpoint_path, checkpoint)
+    assert read_checkpoint(checkpoint_path) == checkpoint
+
+
+def test_shard_file_name():
+    assert shard_file_name(".indexer_manifest.json", 0, 1) == ".indexer_manifest.json"
+    assert (
+        shard_file_name(".indexer_manifest.json", 2, 4)
+        == ".indexer_manifest.shard-2-of-4.json"
+    )
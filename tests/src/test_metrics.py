@@ -0,0 +1,134 @@
+import json
+
+import pytest
+
+from src.metrics import LATENCY_BUCKETS, Histogram, PipelineMetrics
+
+
+def test_counters_and_stages():
+    metrics = PipelineMetrics()
+    metrics.increment("feed_operations", schema="a", outcome="succeeded")
+    metrics.increment("feed_operations", 2, schema="b", outcome="succeeded")
+    metrics.increment("feed_operations", schema="b", outcome="failed")
+    metrics.observe("feed", 0.2, schema="a")
+    metrics.observe("feed", 0.4, schema="a")
+    with metrics.time("read"):
+        pass
+
+    assert metrics.counter("feed_operations") == 4
+    assert metrics.counter("feed_operations", outcome="succeeded") == 3
+    assert metrics.counter("feed_operations", schema="b") == 3
+
+    report = metrics.report(duration=1)
+    assert report["counters"]["feed_operations{outcome=failed,schema=b}"] == 1
+    assert report["stages"]["feed{schema=a}"]["count"] == 2
+    assert report["stages"]["feed{schema=a}"]["mean_seconds"] == pytest.approx(0.3)
+    assert report["stages"]["read"]["count"] == 1
+
+
+def test_report_throughput():
+    metrics = PipelineMetrics()
+    metrics.increment("documents_fed", 10)
+    metrics.increment("passages_fed", 1000)
+    metrics.increment("bytes_read", 5000)
+
+    report = metrics.report(duration=10)
+    assert report["documents_per_second"] == 1
+    assert report["passages_per_second"] == 100
+    assert report["bytes_per_second"] == 500
+
+
+def test_report_throughput__exported():
+    metrics = PipelineMetrics()
+    metrics.increment("documents_exported", 10)
+    metrics.increment("passages_exported", 1000)
+
+    report = metrics.report(duration=10)
+    assert report["documents_per_second"] == 1
+    assert report["passages_per_second"] == 100
+
+
+def test_reset():
+    metrics = PipelineMetrics()
+    metrics.increment("documents_fed")
+    metrics.observe("read", 0.1)
+    metrics.reset()
+    assert metrics.report()["counters"] == {}
+    assert metrics.report()["stages"] == {}
+
+
+def test_to_prometheus():
+    metrics = PipelineMetrics()
+    metrics.increment("documents_fed", 3)
+    metrics.observe("feed", 0.002, schema="family_document")
+    metrics.observe("feed", 100, schema="family_document")
+
+    lines = metrics.to_prometheus(duration=3).splitlines()
+    assert "indexer_documents_fed_total 3" in lines
+    assert (
+        'indexer_stage_seconds_bucket{stage="feed",schema="family_document",'
+        'le="0.001"} 0'
+    ) in lines
+    assert (
+        'indexer_stage_seconds_bucket{stage="feed",schema="family_document",'
+        f'le="{LATENCY_BUCKETS[-1]}"}} 1'
+    ) in lines
+    assert (
+        'indexer_stage_seconds_bucket{stage="feed",schema="family_document",'
+        'le="+Inf"} 2'
+    ) in lines
+    assert 'indexer_stage_seconds_count{stage="feed",schema="family_document"} 2' in (
+        lines
+    )
+    assert "indexer_documents_per_second 1.0" in lines
+
+
+def test_run_labels():
+    metrics = PipelineMetrics()
+    metrics.set_run_labels(shard="1")
+    metrics.reset()
+    metrics.increment("documents_fed", 3)
+    metrics.observe("feed", 0.002, schema="family_document")
+
+    assert metrics.report(duration=3)["labels"] == {"shard": "1"}
+    lines = metrics.to_prometheus(duration=3).splitlines()
+    assert 'indexer_documents_fed_total{shard="1"} 3' in lines
+    assert (
+        'indexer_stage_seconds_count{shard="1",stage="feed",'
+        'schema="family_document"} 1'
+    ) in lines
+    assert 'indexer_documents_per_second{shard="1"} 1.0' in lines
+
+
+def test_write_metrics(tmp_path):
+    metrics = PipelineMetrics()
+    metrics.increment("passages_fed", 2)
+
+    metrics.write_json(tmp_path / "metrics.json", duration=1)
+    assert (
+        json.loads((tmp_path / "metrics.json").read_text())["passages_per_second"] == 2
+    )
+
+    metrics.write_prometheus(tmp_path / "indexer.prom", duration=1)
+    assert "indexer_passages_fed_total 2" in (tmp_path / "indexer.prom").read_text()
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "indexer.prom",
+        "metrics.json",
+    ]
+
+
+def test_histogram_quantile():
+    histogram = Histogram()
+    assert histogram.quantile(0.5) == 0
+    for _ in range(90):
+        histogram.observe(0.003)
+    for _ in range(10):
+        histogram.observe(0.7)
+
+    assert histogram.quantile(0.5) == 0.005
+    assert histogram.quantile(0.9) == 0.005
+    assert histogram.quantile(0.95) == 0.7
+    assert histogram.quantile(1.0) == 0.7
+
+    histogram.observe(100)
+    assert histogram.quantile(1.0) == 100
@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+
+from src.index.quantization import (
+    dequantize,
+    quantization_error,
+    quantization_report,
+    quantize,
+    record_quantization_errors,
+)
+from src.metrics import PipelineMetrics
+
+
+def test_quantize__float_unchanged():
+    embeddings = np.random.rand(3, 4).astype(np.float32)
+    assert quantize(embeddings, "float", 127.0) is embeddings
+
+
+def test_quantize__bfloat16_rounds_to_nearest_even():
+    embeddings = np.array(
+        [[1.0, -2.5, 1 + 2**-8, 1 + 3 * 2**-8, 1 + 2**-8 + 2**-20]],
+        dtype=np.float32,
+    )
+    cells = quantize(embeddings, "bfloat16", 127.0)
+
+    assert cells.dtype == np.uint16
+    assert cells.tolist() == [[0x3F80, 0xC020, 0x3F80, 0x3F82, 0x3F81]]
+    assert dequantize(cells, "bfloat16", 127.0).tolist() == [
+        [1.0, -2.5, 1.0, 1 + 2**-6, 1 + 2**-7]
+    ]
+
+
+def test_quantize__int8_scales_and_clips():
+    embeddings = np.array([[0.5, -0.5, 0.004, 1.5, -2.0]], dtype=np.float32)
+    cells = quantize(embeddings, "int8", 127.0)
+
+    assert cells.dtype == np.int8
+    assert cells.tolist() == [[64, -64, 1, 127, -128]]
+    np.testing.assert_allclose(
+        dequantize(cells, "int8", 127.0), cells.astype(np.float32) / 127
+    )
+
+
+def test_quantize__unknown_cell_type():
+    with pytest.raises(ValueError):
+        quantize(np.zeros((1, 2), dtype=np.float32), "int4", 127.0)
+
+
+def test_quantization_error():
+    embeddings = np.array([[1.0, 0.0], [0.0, 0.0], [3.0, 4.0]], dtype=np.float32)
+    dequantized = np.array([[1.0, 1.0], [0.0, 0.0], [3.0, 4.0]], dtype=np.float32)
+
+    error = quantization_error(embeddings, dequantized)
+
+    assert error.vectors == 3
+    assert error.cosine_similarity_sum == pytest.approx(1 / np.sqrt(2) + 2)
+    assert error.relative_error_sum == pytest.approx(1.0)
+
+
+def test_quantization_report():
+    embeddings = np.random.default_rng(0).normal(size=(20, 384)).astype(np.float32)
+    metrics = PipelineMetrics()
+    for cell_type, model_slug in [("bfloat16", "a"), ("int8", "b")]:
+        dequantized = dequantize(
+            quantize(embeddings / 4, cell_type, 127.0), cell_type, 127.0
+        )
+        record_quantization_errors(
+            metrics, {model_slug: quantization_error(embeddings / 4, dequantized)}
+        )
+        record_quantization_errors(
+            metrics, {model_slug: quantization_error(embeddings / 4, dequantized)}
+        )
+
+    report = quantization_report(metrics, {"a": "bfloat16", "b": "int8", "c": "int8"})
+
+    assert set(report) == {"a", "b"}
+    assert report["a"]["cell_type"] == "bfloat16"
+    assert report["a"]["vectors"] == 40
+    assert report["a"]["mean_cosine_similarity"] > 0.9999
+    assert report["a"]["mean_relative_error"] < 0.01
+    assert report["b"]["mean_cosine_similarity"] > 0.99
+    assert report["b"]["mean_relative_error"] > report["a"]["mean_relative_error"]
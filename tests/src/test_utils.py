@@ -1,6 +1,10 @@
 import datetime
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
 from pathlib import Path
 
+import numpy as np
+
 from cloudpathlib import S3Path
 import pytest
 from pydantic import AnyHttpUrl
@@ -14,11 +18,26 @@ from cpr_data_access.parser_models import (
     HTMLTextBlock,
 )
 
+from src.metrics import metrics
 from src.utils import (
     build_indexer_input_path,
+    build_text_block_windows,
+    compile_block_types,
     filter_on_block_type,
+    get_document_shard,
+    get_embedding_container_path,
+    get_embedding_path,
     get_index_paths,
+    iter_index_paths,
+    load_npy_buffer,
+    load_npz_buffer,
     parse_files_to_index,
+    prefetch_document_inputs,
+    read_embeddings,
+    read_file_range,
+    read_npy_file,
+    read_npz_file,
+    write_embedding_container,
 )
 from tests.conftest import FIXTURE_DIR
 
@@ -64,6 +83,82 @@ def test_get_index_paths(files, limit, count):
         assert type(f) == type(path)
 
 
+def test_get_index_paths__files_to_index_without_listing(
+    tmp_path, monkeypatch, caplog
+):
+    for doc_id in ["doc.1", "doc.2", "doc.3"]:
+        (tmp_path / f"{doc_id}.json").write_text("{}")
+
+    def _no_listing(self):
+        raise AssertionError("Directory listed")
+
+    monkeypatch.setattr(Path, "iterdir", _no_listing)
+    got = get_index_paths(tmp_path, '["doc.3", "doc.1", "doc.4"]')
+
+    assert got == [tmp_path / "doc.3.json", tmp_path / "doc.1.json"]
+    assert "doc.4" in caplog.text
+
+
+def test_iter_index_paths__lists_lazily(tmp_path, monkeypatch):
+    for doc_id in ["doc.1", "doc.2", "doc.3"]:
+        (tmp_path / f"{doc_id}.json").write_text("{}")
+    (tmp_path / ".indexer_manifest.json").write_text("{}")
+    (tmp_path / "doc.1__baai-bge-small-en-v1-5.npy").write_bytes(b"")
+
+    listed = []
+    iterdir = Path.iterdir
+
+    def _iterdir(self):
+        for path in iterdir(self):
+            listed.append(path)
+            yield path
+
+    monkeypatch.setattr(Path, "iterdir", _iterdir)
+    paths = iter_index_paths(tmp_path, limit=1)
+    assert listed == []
+
+    got = list(paths)
+    assert len(got) == 1
+    assert got[0].suffix == ".json" and not got[0].name.startswith(".")
+    assert len(listed) < 5
+    assert sorted(get_index_paths(tmp_path)) == [
+        tmp_path / f"{doc_id}.json" for doc_id in ["doc.1", "doc.2", "doc.3"]
+    ]
+
+
+def test_get_document_shard():
+    # Stable across processes and releases, unlike hash()
+    assert get_document_shard("CCLW.executive.10014.4470", 4) == get_document_shard(
+        "CCLW.executive.10014.4470", 4
+    )
+    assert get_document_shard("CCLW.executive.10014.4470", 1) == 0
+    shards = [get_document_shard(f"CCLW.executive.{i}.0", 4) for i in range(1000)]
+    assert set(shards) == {0, 1, 2, 3}
+    assert all(200 < shards.count(shard) < 300 for shard in range(4))
+
+
+@pytest.mark.parametrize("shard_count", [2, 3])
+def test_get_index_paths__shards(shard_count):
+    path = FIXTURE_DIR / "s3_files"
+    shards = [
+        get_index_paths(path, shard_index=shard_index, shard_count=shard_count)
+        for shard_index in range(shard_count)
+    ]
+    all_paths = [p for shard in shards for p in shard]
+    assert sorted(all_paths) == sorted(get_index_paths(path))
+    for shard_index, shard in enumerate(shards):
+        for p in shard:
+            assert get_document_shard(p.stem, shard_count) == shard_index
+
+
+@pytest.mark.parametrize("shard_index, shard_count", [(2, 2), (-1, 2), (0, 0)])
+def test_get_index_paths__invalid_shard(shard_index, shard_count):
+    with pytest.raises(ValueError):
+        get_index_paths(
+            FIXTURE_DIR / "s3_files", shard_index=shard_index, shard_count=shard_count
+        )
+
+
 def get_pdf_text_block(text_block_type: str) -> PDFTextBlock:
     """Returns a PDFTextBlock object with the given type."""
     return PDFTextBlock(
@@ -180,8 +275,9 @@ def test_indexer_input_array() -> list[ParserOutput]:
 def test_filter_on_block_type(test_indexer_input_array):
     """Tests that the filter_on_block_type function removes the correct text blocks."""
 
-    filtered_input = filter_on_block_type(
-        input=test_indexer_input_array[0], remove_block_types=["Text", "Figure"]
+    filtered_input, removed_blocks = filter_on_block_type(
+        input=test_indexer_input_array[0],
+        remove_block_types=compile_block_types(["Text", "Figure"]),
     )
     assert filtered_input.html_data is not None
 
@@ -195,10 +291,12 @@ def test_filter_on_block_type(test_indexer_input_array):
 
     assert filtered_input.html_data.text_blocks[2].type == "Google Text Block"
     assert filtered_input.html_data.text_blocks[2].text == ["test_text"]
+    assert removed_blocks == {"Text": 3, "Figure": 1}
 
     # Assert that we can filter on ParserOutputs that don't have valid text
-    filtered_input = filter_on_block_type(
-        input=test_indexer_input_array[1], remove_block_types=["Text", "Figure"]
+    filtered_input, _ = filter_on_block_type(
+        input=test_indexer_input_array[1],
+        remove_block_types=compile_block_types(["Text", "Figure"]),
     )
     assert filtered_input.html_data is not None
     assert len(filtered_input.html_data.text_blocks) == 2
@@ -210,6 +308,13 @@ def test_filter_on_block_type(test_indexer_input_array):
     assert filtered_input.html_data.text_blocks[1].text == ["test_text"]
 
 
+def test_compile_block_types(caplog):
+    block_types = compile_block_types(["Table", " Figure", "Unknown", ""])
+
+    assert block_types == frozenset({BlockType.TABLE, BlockType.FIGURE})
+    assert "Unknown" in caplog.text
+
+
 def test_has_valid_text_override(test_indexer_input_array):
     """
     Test that the get_text_blocks method provides the right response.
@@ -226,3 +331,279 @@ def test_has_valid_text_override(test_indexer_input_array):
         len(test_indexer_input_array[1].get_text_blocks(including_invalid_html=True))
         == 3
     )
+
+
+@pytest.mark.parametrize(
+    "depth, max_bytes",
+    [
+        (0, 0),
+        (2, 1),
+        (3, 1_000_000),
+        (10, 1_000_000),
+    ],
+)
+@pytest.mark.parametrize("layout", ["auto", "container", "npy"])
+@pytest.mark.parametrize("first_container", [True, False])
+def test_prefetch_document_inputs(tmp_path, depth, max_bytes, layout, first_container):
+    model_slugs = ["model-a", "model-b"]
+    for i in range(5):
+        (tmp_path / f"doc.{i}.json").write_text(f'{{"document_id": "doc.{i}"}}')
+        embeddings = {
+            model_slug: np.full((3, 4), i, dtype=np.float32)
+            for model_slug in model_slugs
+        }
+        # Some documents have an embeddings container, the rest a file per model
+        if i % 2 != first_container:
+            write_embedding_container(tmp_path / f"doc.{i}.npz", embeddings)
+            continue
+        for model_slug, embedding in embeddings.items():
+            np.save(tmp_path / f"doc.{i}__{model_slug}.npy", embedding)
+    paths = sorted(tmp_path.glob("*.json"))
+
+    # Documents laid out otherwise than the first are read too
+    got = list(
+        prefetch_document_inputs(
+            paths, tmp_path, model_slugs, depth, max_bytes, layout=layout
+        )
+    )
+
+    assert [inputs.path for inputs in got] == paths
+    for i, inputs in enumerate(got):
+        assert inputs.parser_output_json == paths[i].read_text()
+        assert set(inputs.embeddings) == set(model_slugs)
+        for embedding in inputs.embeddings.values():
+            assert embedding.shape == (3, 4)
+            assert (embedding == i).all()
+
+
+@pytest.mark.parametrize("depth", [0, 2])
+def test_prefetch_document_inputs__records_read_metrics(tmp_path, depth):
+    model_slugs = ["model-a", "model-b"]
+    for i in range(4):
+        (tmp_path / f"doc.{i}.json").write_text(f'{{"document_id": "doc.{i}"}}')
+        embeddings = {
+            model_slug: np.full((3, 4), i, dtype=np.float32)
+            for model_slug in model_slugs
+        }
+        if i % 2:
+            write_embedding_container(tmp_path / f"doc.{i}.npz", embeddings)
+            continue
+        for model_slug, embedding in embeddings.items():
+            np.save(tmp_path / f"doc.{i}__{model_slug}.npy", embedding)
+    paths = sorted(tmp_path.glob("*.json"))
+    metrics.reset()
+
+    got = list(
+        prefetch_document_inputs(
+            paths, tmp_path, model_slugs, depth, 1_000_000, layout="container"
+        )
+    )
+
+    assert metrics.counter("bytes_read") == sum(inputs.nbytes for inputs in got)
+    assert metrics.counter("bytes_read") > 0
+    stages = metrics.report()["stages"]
+    assert stages["read"]["count"] == 4
+    # Only documents with an embeddings container time loading one
+    assert stages["load_npz"]["count"] == 2
+    assert stages["load_npy"]["count"] == 4
+
+
+@pytest.mark.parametrize("container", [True, False])
+def test_prefetch_document_inputs__resolves_layout_once(
+    tmp_path, monkeypatch, container
+):
+    for i in range(3):
+        (tmp_path / f"doc.{i}.json").write_text(f'{{"document_id": "doc.{i}"}}')
+        embeddings = {"model-a": np.full((3, 4), i, dtype=np.float32)}
+        if container:
+            write_embedding_container(tmp_path / f"doc.{i}.npz", embeddings)
+        else:
+            np.save(tmp_path / f"doc.{i}__model-a.npy", embeddings["model-a"])
+    paths = sorted(tmp_path.glob("*.json"))
+    looked_for = []
+
+    def _get_embedding_container_path(embedding_dir_as_path, document_id):
+        looked_for.append(document_id)
+        return get_embedding_container_path(embedding_dir_as_path, document_id)
+
+    monkeypatch.setattr(
+        "src.utils.get_embedding_container_path", _get_embedding_container_path
+    )
+
+    got = list(prefetch_document_inputs(paths, tmp_path, ["model-a"], 2, 1_000_000))
+
+    assert [int(inputs.embeddings["model-a"][0, 0]) for inputs in got] == [0, 1, 2]
+    # Only containers that exist are read after the first document is checked
+    assert sorted(looked_for) == (
+        ["doc.0", "doc.0", "doc.1", "doc.2"] if container else ["doc.0"]
+    )
+
+
+@pytest.mark.parametrize(
+    "array",
+    [
+        np.arange(12, dtype=np.float32).reshape(3, 4),
+        np.asfortranarray(np.arange(12, dtype=np.float64).reshape(3, 4)),
+        np.zeros((0, 768), dtype=np.float32),
+    ],
+)
+def test_load_npy_buffer(array):
+    buffer = BytesIO()
+    np.save(buffer, array)
+
+    got = load_npy_buffer(buffer.getvalue())
+
+    assert got.dtype == array.dtype
+    assert got.shape == array.shape
+    assert (got == array).all()
+    assert not got.flags.writeable
+
+
+def test_read_npy_file__local_is_memory_mapped(tmp_path):
+    array = np.arange(12, dtype=np.float32).reshape(3, 4)
+    np.save(tmp_path / "embeddings.npy", array)
+
+    got = read_npy_file(tmp_path / "embeddings.npy")
+
+    assert isinstance(got, np.memmap)
+    assert (got == array).all()
+
+
+@pytest.mark.parametrize("savez", [np.savez, np.savez_compressed])
+def test_load_npz_buffer(savez):
+    arrays = {
+        "model-a": np.arange(12, dtype=np.float32).reshape(3, 4),
+        "model-b": np.asfortranarray(np.arange(6, dtype=np.float64).reshape(2, 3)),
+    }
+    buffer = BytesIO()
+    savez(buffer, **arrays)
+
+    got = load_npz_buffer(buffer.getvalue())
+    assert set(got) == set(arrays)
+    for name, array in arrays.items():
+        np.testing.assert_array_equal(got[name], array)
+        assert got[name].dtype == array.dtype
+
+
+@pytest.mark.parametrize("savez", [np.savez, np.savez_compressed])
+@pytest.mark.parametrize("directory_bytes", [1024, 10_000_000])
+def test_read_npz_file__reads_only_named_arrays(
+    tmp_path, monkeypatch, savez, directory_bytes
+):
+    rng = np.random.default_rng(0)
+    arrays = {
+        f"model-{name}": rng.random((100, 64), dtype=np.float32) for name in "abcd"
+    }
+    savez(tmp_path / "doc.1.npz", **arrays)
+    size = (tmp_path / "doc.1.npz").stat().st_size
+    reads = []
+
+    def _read_file_range(file_path, start, end=None):
+        data, file_size = read_file_range(file_path, start, end)
+        reads.append(len(data))
+        return data, file_size
+
+    monkeypatch.setattr("src.utils.read_file_range", _read_file_range)
+
+    got = read_npz_file(
+        tmp_path / "doc.1.npz", ["model-b", "model-d"], directory_bytes
+    )
+
+    assert list(got) == ["model-b", "model-d"]
+    for name, array in got.items():
+        np.testing.assert_array_equal(array, arrays[name])
+    if directory_bytes < size:
+        # The directory, then each array named
+        assert len(reads) == 3
+        assert sum(reads) < size * 3 / 4
+    else:
+        assert reads == [size]
+
+    got = read_npz_file(tmp_path / "doc.1.npz", directory_bytes=directory_bytes)
+    assert list(got) == list(arrays)
+    for name, array in got.items():
+        np.testing.assert_array_equal(array, arrays[name])
+
+
+def test_read_embeddings__container(tmp_path):
+    embeddings = {
+        "model-a": np.ones((3, 4), dtype=np.float32),
+        "model-b": np.zeros((3, 2), dtype=np.float32),
+    }
+    write_embedding_container(
+        get_embedding_container_path(tmp_path, "doc.1"), embeddings
+    )
+
+    got = read_embeddings(tmp_path, "doc.1", ["model-b", "model-a"])
+    assert list(got) == ["model-b", "model-a"]
+    for model_slug, array in embeddings.items():
+        np.testing.assert_array_equal(got[model_slug], array)
+        # A view onto the container's bytes
+        assert not got[model_slug].flags.writeable
+
+
+def test_read_embeddings__falls_back_to_model_files(tmp_path):
+    write_embedding_container(
+        get_embedding_container_path(tmp_path, "doc.1"),
+        {"model-a": np.ones((3, 4), dtype=np.float32)},
+    )
+    np.save(get_embedding_path(tmp_path, "doc.1", "model-b"), np.zeros((3, 2)))
+    np.save(get_embedding_path(tmp_path, "doc.2", "model-a"), np.ones((1, 4)))
+
+    got = read_embeddings(tmp_path, "doc.1", ["model-a", "model-b"])
+    np.testing.assert_array_equal(got["model-b"], np.zeros((3, 2)))
+
+    with ThreadPoolExecutor() as executor:
+        got = read_embeddings(tmp_path, "doc.2", ["model-a"], executor)
+    np.testing.assert_array_equal(got["model-a"], np.ones((1, 4)))
+
+    with pytest.raises(FileNotFoundError):
+        read_embeddings(tmp_path, "doc.3", ["model-a"])
+
+
+def test_read_embeddings__npy_layout_falls_back_to_container(tmp_path):
+    write_embedding_container(
+        get_embedding_container_path(tmp_path, "doc.1"),
+        {"model-a": np.ones((3, 4), dtype=np.float32)},
+    )
+    np.save(get_embedding_path(tmp_path, "doc.1", "model-b"), np.zeros((3, 2)))
+
+    got = read_embeddings(tmp_path, "doc.1", ["model-a", "model-b"], layout="npy")
+    np.testing.assert_array_equal(got["model-a"], np.ones((3, 4)))
+    np.testing.assert_array_equal(got["model-b"], np.zeros((3, 2)))
+
+    with pytest.raises(FileNotFoundError):
+        read_embeddings(tmp_path, "doc.2", ["model-a"], layout="npy")
+
+
+def test_build_text_block_windows():
+    texts = ["a", "bb", "ccc", "dddd"]
+
+    assert build_text_block_windows(texts) == [
+        "a\nbb",
+        "a\nbb\nccc",
+        "bb\nccc\ndddd",
+        "ccc\ndddd",
+    ]
+    assert build_text_block_windows(texts, neighbours=0) == texts
+    assert build_text_block_windows(texts, neighbours=2)[1] == "a\nbb\nccc\ndddd"
+    assert build_text_block_windows(["only"]) == ["only"]
+    assert build_text_block_windows([]) == []
+
+
+def test_build_text_block_windows__max_chars():
+    texts = ["a", "bb", "ccc", "dddd"]
+
+    # Neighbours that don't fit are left out, and a block always has its own text
+    assert build_text_block_windows(texts, neighbours=3, max_chars=6) == [
+        "a\nbb",
+        "a\nbb",
+        "bb\nccc",
+        "dddd",
+    ]
+    assert build_text_block_windows(texts, neighbours=3, max_chars=1) == [
+        "a",
+        "bb",
+        "ccc",
+        "dddd",
+    ]
@@ -1,24 +1,72 @@
+from contextlib import ExitStack
+import threading
+import time
+from unittest.mock import MagicMock, patch
+
 from cpr_data_access.parser_models import ParserOutput
 import numpy as np
 import pytest
+from vespa.application import Vespa
+from vespa.io import VespaResponse
 
+from benchmarks.fake_vespa import FakeVespa, FakeVespaSettings
+from src import config
+from src.index.failures import FeedFailures
+from src.index.feed_files import read_feed_file
+from src.index.flow_control import AdaptiveFlowController
 from src.index.vespa_ import (
     build_vespa_family_document,
     build_vespa_document_passage,
+    encode_embedding,
+    encode_embeddings,
+    build_vespa_document_passage_fields,
+    validate_embeddings,
     get_existing_passage_ids,
     remove_ids,
     determine_stray_ids,
+    export_vespa_feed,
     get_document_generator,
+    prepare_documents,
+    feed_documents,
+    feed_session,
+    populate_vespa,
+    iterate_in_background,
+    CheckpointRecorder,
+    get_failed_document_ids,
+    VespaFeeder,
+    AsyncVespaFeeder,
+    passage_digest,
+    filter_unchanged_paths,
+    prefetch_existing_passage_ids,
+    PreparedDocument,
     VespaDocumentPassage,
     VespaFamilyDocument,
+    VespaHexTensor,
+    VespaIndexError,
     VespaSearchWeights,
     SEARCH_WEIGHTS_SCHEMA,
     FAMILY_DOCUMENT_SCHEMA,
     DOCUMENT_PASSAGE_SCHEMA,
+    _NAMESPACE,
     _SCHEMAS_TO_PROCESS,
+    _batch_ingest_all,
+    _stream_ingest,
+)
+from src.index.embedding_models import DEFAULT_EMBEDDING_MODELS, get_embedding_models
+from src.manifest import (
+    IndexCheckpoint,
+    IndexManifest,
+    PER_DOCUMENT_LISTING_MAX,
+    PassageState,
+    list_file_fingerprints,
+    read_checkpoint,
 )
+from src.metrics import metrics
+from src.utils import read_document_inputs
 
-from tests.conftest import get_parser_output, FIXTURE_DIR
+from tests.conftest import get_parser_output
+
+MODEL_SLUGS = [model.slug for model in DEFAULT_EMBEDDING_MODELS]
 
 
 def test_build_vespa_family_document():
@@ -39,14 +87,196 @@ def test_build_vespa_document_passage():
         search_weights_ref="id:doc_search:weight::default",
         text_block=text_block,
         text_block_window="window",
-        embedding_bge_small=np.array([-0.11900115, 0.17448892]),
-        embedding_bge_base=np.array([-0.11900115, 0.17448892]),
-        embedding_distilbert_dot_v5=np.array([-0.11900115, 0.17448892]),
-        embedding_distilbert_tas_b=np.array([-0.11900115, 0.17448892]),
+        embeddings={
+            model_slug: np.array([-0.11900115, 0.17448892])
+            for model_slug in MODEL_SLUGS
+        },
     )
     VespaDocumentPassage.model_validate(model)
 
 
+def test_build_vespa_document_passage__selected_models():
+    parser_output = get_parser_output(1, 1)
+    text_block = parser_output.pdf_data.text_blocks[0]
+    embeddings = {
+        model_slug: np.array([-0.11900115, 0.17448892]) for model_slug in MODEL_SLUGS
+    }
+    models = get_embedding_models(
+        registry='[{"slug": "e5-small", "field": "text_embedding_e5", "dimension": 2}]',
+        selected=["baai-bge-small-en-v1-5", "e5-small"],
+        cell_types={},
+    )
+    embeddings["e5-small"] = np.array([0.5, 0.25])
+
+    model = build_vespa_document_passage(
+        family_document_id="doc.1.1",
+        search_weights_ref="id:doc_search:weight::default",
+        text_block=text_block,
+        text_block_window="window",
+        embeddings=embeddings,
+        models=models,
+    )
+    fields = build_vespa_document_passage_fields(
+        family_document_id="doc.1.1",
+        search_weights_ref="id:doc_search:weight::default",
+        text_block=text_block,
+        text_block_window="window",
+        embeddings={
+            model_slug: encode_embedding(embeddings[model_slug])
+            for model_slug in models
+        },
+        models=models,
+    )
+
+    assert fields == model.model_dump()
+    assert [field for field in fields if "embedding" in field] == [
+        "text_embedding_bge_small",
+        "text_embedding_e5",
+    ]
+    assert fields["text_embedding_e5"] == [0.5, 0.25]
+
+
+def test_encode_embedding():
+    embedding = np.array([1 / 9, 2 / 9, -0.5], dtype=np.float32)
+
+    assert encode_embedding(embedding) == embedding.tolist()
+
+    with patch.object(config, "VESPA_EMBEDDING_ENCODING", new="hex"):
+        encoded = encode_embedding(embedding)
+    assert encoded == {"values": "3DE38E393E638E39BF000000"}
+    assert (
+        np.frombuffer(bytes.fromhex(encoded["values"]), dtype=">f4") == embedding
+    ).all()
+    VespaHexTensor.model_validate(encoded)
+
+
+@pytest.mark.parametrize("encoding", ["list", "hex"])
+def test_encode_embeddings(encoding):
+    embeddings = np.random.rand(5, 8).astype(np.float32)
+    with patch.object(config, "VESPA_EMBEDDING_ENCODING", new=encoding):
+        assert encode_embeddings(embeddings) == [
+            encode_embedding(embedding) for embedding in embeddings
+        ]
+
+
+def test_build_vespa_document_passage__hex_embeddings():
+    parser_output = get_parser_output(1, 1)
+    text_block = parser_output.pdf_data.text_blocks[0]
+    embedding = np.array([-0.11900115, 0.17448892], dtype=np.float32)
+    with patch.object(config, "VESPA_EMBEDDING_ENCODING", new="hex"):
+        model = build_vespa_document_passage(
+            family_document_id="doc.1.1",
+            search_weights_ref="id:doc_search:weight::default",
+            text_block=text_block,
+            text_block_window="window",
+            embeddings={model_slug: embedding for model_slug in MODEL_SLUGS},
+        )
+    fields = model.model_dump()
+    assert fields["text_embedding_bge_small"] == {"values": "BDF3B6E03E32AD39"}
+    assert fields["text_embedding_distilbert_dot_v5"] == {"values": "BDF3B6E03E32AD39"}
+
+
+@pytest.mark.parametrize("encoding", ["list", "hex"])
+def test_build_vespa_document_passage_fields__matches_model(encoding):
+    parser_output = get_parser_output(1, 1)
+    text_block = parser_output.pdf_data.text_blocks[0]
+    embeddings = np.random.rand(4, 4).astype(np.float32)
+    with patch.object(config, "VESPA_EMBEDDING_ENCODING", new=encoding):
+        encoded = encode_embeddings(embeddings)
+        model = build_vespa_document_passage(
+            family_document_id="doc.1.1",
+            search_weights_ref="id:doc_search:weight::default",
+            text_block=text_block,
+            text_block_window="window",
+            embeddings=dict(zip(MODEL_SLUGS, embeddings)),
+        )
+    fields = build_vespa_document_passage_fields(
+        family_document_id="doc.1.1",
+        search_weights_ref="id:doc_search:weight::default",
+        text_block=text_block,
+        text_block_window="window",
+        embeddings=dict(zip(MODEL_SLUGS, encoded)),
+    )
+    assert fields == model.model_dump()
+    VespaDocumentPassage.model_validate(fields)
+
+
+def test_encode_embedding__quantized():
+    embedding = np.array([1 / 9, 2 / 9, -0.5], dtype=np.float32)
+
+    assert encode_embedding(embedding, "int8") == [14, 28, -64]
+    assert encode_embedding(embedding, "bfloat16") == [0.111328125, 0.22265625, -0.5]
+
+    with patch.object(config, "VESPA_EMBEDDING_ENCODING", new="hex"):
+        assert encode_embedding(embedding, "bfloat16") == {"values": "3DE43E64BF00"}
+        assert encode_embedding(embedding, "int8") == {"values": "0E1CC0"}
+
+
+@pytest.mark.parametrize("encoding", ["list", "hex"])
+def test_build_vespa_document_passage_fields__matches_model_quantized(encoding):
+    parser_output = get_parser_output(1, 1)
+    text_block = parser_output.pdf_data.text_blocks[0]
+    embeddings = dict(zip(MODEL_SLUGS, np.random.rand(4, 4).astype(np.float32)))
+    models = get_embedding_models(
+        registry="",
+        selected=[],
+        cell_types={
+            "baai-bge-small-en-v1-5": "bfloat16",
+            "msmarco-distilbert-dot-v5": "int8",
+        },
+    )
+    with patch.object(config, "VESPA_EMBEDDING_ENCODING", new=encoding):
+        model = build_vespa_document_passage(
+            family_document_id="doc.1.1",
+            search_weights_ref="id:doc_search:weight::default",
+            text_block=text_block,
+            text_block_window="window",
+            embeddings=embeddings,
+            models=models,
+        )
+        fields = build_vespa_document_passage_fields(
+            family_document_id="doc.1.1",
+            search_weights_ref="id:doc_search:weight::default",
+            text_block=text_block,
+            text_block_window="window",
+            embeddings={
+                model_slug: encode_embedding(
+                    embeddings[model_slug], models[model_slug].cell_type
+                )
+                for model_slug in models
+            },
+            models=models,
+        )
+    assert fields == model.model_dump()
+    if encoding == "list":
+        assert all(
+            isinstance(value, int)
+            for value in fields["text_embedding_distilbert_dot_v5"]
+        )
+
+
+@pytest.mark.parametrize(
+    "embeddings",
+    [
+        np.zeros((3, 384), dtype=np.float32),
+        np.zeros((3, 768, 1), dtype=np.float32),
+        np.zeros((3, 768), dtype=np.int64),
+    ],
+)
+def test_validate_embeddings__invalid(embeddings):
+    embeddings_by_model_slug = {
+        model_slug: np.zeros((3, 768), dtype=np.float32) for model_slug in MODEL_SLUGS
+    }
+    embeddings_by_model_slug["baai-bge-small-en-v1-5"] = np.zeros(
+        (3, 384), dtype=np.float32
+    )
+    validate_embeddings("doc.1", embeddings_by_model_slug)
+
+    embeddings_by_model_slug["msmarco-distilbert-dot-v5"] = embeddings
+    with pytest.raises(VespaIndexError):
+        validate_embeddings("doc.1", embeddings_by_model_slug)
+
+
 @pytest.mark.usefixtures("cleanup_test_vespa_before", "cleanup_test_vespa_after")
 def test_get_existing_passage_ids__new_doc(test_vespa):
     new_id = "CCLW.executive.10014.111"
@@ -82,6 +312,31 @@ def test_get_existing_passage_ids__existing_doc(test_vespa):
         assert i not in end
 
 
+@pytest.mark.parametrize("lookahead", [0, 2])
+@pytest.mark.usefixtures(
+    "cleanup_test_vespa_before", "preload_fixtures", "cleanup_test_vespa_after"
+)
+def test_prefetch_existing_passage_ids(test_vespa, lookahead):
+    prepared_documents = [
+        PreparedDocument(
+            family_document_id=family_doc_id, family_document={}, passages=[]
+        )
+        for family_doc_id in [
+            "CCLW.executive.10014.4470",
+            "CCLW.executive.10014.111",
+            "CCLW.document.i00000004.n0000",
+        ]
+    ]
+
+    got = list(prefetch_existing_passage_ids(test_vespa, prepared_documents, lookahead))
+
+    assert [prepared for prepared, _ in got] == prepared_documents
+    for prepared, existing_ids in got:
+        assert sorted(existing_ids) == sorted(
+            get_existing_passage_ids(test_vespa, prepared.family_document_id)
+        )
+
+
 def test_determine_stray_ids():
 
     existing_doc_passage_ids = ["C.1.1", "C.1.2", "C.1.3", "C.1.4", "C.1.5"]
@@ -95,9 +350,9 @@ def test_determine_stray_ids():
 
 
 @pytest.mark.usefixtures("cleanup_test_vespa_before", "cleanup_test_vespa_after")
-def test_get_document_generator(test_vespa):
+def test_get_document_generator(test_vespa, s3_files_dir):
     """Assert that the vespa document generator works as expected."""
-    embedding_dir_as_path = FIXTURE_DIR / "s3_files"
+    embedding_dir_as_path = s3_files_dir
     paths = [
         embedding_dir_as_path / "CCLW.executive.10002.4495.json",
         embedding_dir_as_path / "CCLW.executive.10014.4470.json",
@@ -172,3 +427,754 @@ def test_get_document_generator(test_vespa):
         assert family_schema == FAMILY_DOCUMENT_SCHEMA
         assert family_id in ids
         assert len(family_id.split(".")) == 4
+
+
+def _exported_document_generator(vespa, paths, embedding_dir_as_path, **kwargs):
+    yield SEARCH_WEIGHTS_SCHEMA, "default_weights", {"name_weight": 2.5}
+    for path in paths:
+        yield FAMILY_DOCUMENT_SCHEMA, path.stem, {"document_title": path.stem}
+        yield DOCUMENT_PASSAGE_SCHEMA, f"{path.stem}.0", {"text_block": "text"}
+        kwargs["remove_stray_ids"]([f"{path.stem}.1"])
+
+
+def test_export_vespa_feed(tmp_path):
+    paths = [tmp_path / "doc.1.json", tmp_path / "doc.2.json"]
+
+    with patch.object(config, "VESPA_EXPORT_OPERATIONS_PER_FILE", 1), patch(
+        "src.index.vespa_.get_document_generator", _exported_document_generator
+    ), patch("src.index.vespa_._get_vespa_instance") as get_vespa_instance:
+        feed_paths = export_vespa_feed(
+            paths, tmp_path, tmp_path / "feed", compress=True
+        )
+
+    get_vespa_instance.assert_called_once()
+    # Files are split between family documents, so each document's operations
+    # are fed in order from one file
+    assert [path.name for path in feed_paths] == [
+        "feed-00000.jsonl.gz",
+        "feed-00001.jsonl.gz",
+        "feed-00002.jsonl.gz",
+    ]
+    assert [read_feed_file(path) for path in feed_paths] == [
+        [
+            {
+                "put": f"id:{_NAMESPACE}:search_weights::default_weights",
+                "fields": {"name_weight": 2.5},
+            }
+        ],
+        [
+            {
+                "put": f"id:{_NAMESPACE}:family_document::doc.1",
+                "fields": {"document_title": "doc.1"},
+            },
+            {
+                "put": f"id:{_NAMESPACE}:document_passage::doc.1.0",
+                "fields": {"text_block": "text"},
+            },
+            {"remove": f"id:{_NAMESPACE}:document_passage::doc.1.1"},
+        ],
+        [
+            {
+                "put": f"id:{_NAMESPACE}:family_document::doc.2",
+                "fields": {"document_title": "doc.2"},
+            },
+            {
+                "put": f"id:{_NAMESPACE}:document_passage::doc.2.0",
+                "fields": {"text_block": "text"},
+            },
+            {"remove": f"id:{_NAMESPACE}:document_passage::doc.2.1"},
+        ],
+    ]
+
+
+def test_export_vespa_feed__offline(tmp_path):
+    with patch(
+        "src.index.vespa_.get_document_generator",
+        side_effect=_exported_document_generator,
+    ) as get_document_generator, patch(
+        "src.index.vespa_._get_vespa_instance"
+    ) as get_vespa_instance:
+        feed_paths = export_vespa_feed([], tmp_path, tmp_path / "feed", offline=True)
+
+    get_vespa_instance.assert_not_called()
+    assert get_document_generator.call_args.kwargs["vespa"] is None
+    assert [path.name for path in feed_paths] == ["feed-00000.jsonl"]
+
+
+def test_export_vespa_feed__counts_exported_documents(tmp_path):
+    paths = [tmp_path / "doc.1.json", tmp_path / "doc.2.json"]
+
+    with patch("src.index.vespa_.get_document_generator", _exported_document_generator):
+        export_vespa_feed(paths, tmp_path, tmp_path / "feed", offline=True)
+
+    assert metrics.counter("documents_exported") == 2
+    assert metrics.counter("passages_exported") == 2
+    assert metrics.counter("documents_fed") == 0
+    assert metrics.report()["documents_per_second"] > 0
+
+
+def test_get_document_generator__removes_stray_passages(s3_files_dir):
+    embedding_dir_as_path = s3_files_dir
+    path = embedding_dir_as_path / "CCLW.executive.10002.4495.json"
+    removed = []
+
+    with patch(
+        "src.index.vespa_.get_existing_passage_ids",
+        return_value=[f"{path.stem}.100000"],
+    ):
+        list(
+            get_document_generator(
+                MagicMock(),
+                [path],
+                embedding_dir_as_path,
+                remove_stray_ids=removed.extend,
+            )
+        )
+
+    assert removed == [f"{path.stem}.100000"]
+
+
+def _without_timings(prepared: list[PreparedDocument]) -> list[PreparedDocument]:
+    return [document._replace(stage_seconds=None) for document in prepared]
+
+
+def test_prepare_documents__parallel_matches_serial(s3_files_dir):
+    embedding_dir_as_path = s3_files_dir
+    paths = sorted(embedding_dir_as_path.glob("*.json"))
+    search_weights_ref = "id:doc_search:search_weights::default_weights"
+
+    document_inputs = [
+        read_document_inputs(path, embedding_dir_as_path, MODEL_SLUGS) for path in paths
+    ]
+
+    serial = list(prepare_documents(document_inputs, search_weights_ref))
+    with patch.object(config, "PREPARATION_WORKERS", new=2):
+        parallel = list(prepare_documents(document_inputs, search_weights_ref))
+
+    assert len(serial) == len(paths)
+    assert [d.family_document_id for d in parallel] == [
+        d.family_document_id for d in serial
+    ]
+    assert all(
+        set(d.stage_seconds)
+        == {
+            "validate_json",
+            "filter_blocks",
+            "flip_coords",
+            "build_windows",
+            "build_passages",
+        }
+        for d in parallel + serial
+    )
+    assert _without_timings(parallel) == _without_timings(serial)
+
+
+def test_prepare_documents__workers_use_current_config(s3_files_dir):
+    paths = sorted(s3_files_dir.glob("*.json"))
+    search_weights_ref = "id:doc_search:search_weights::default_weights"
+    document_inputs = [
+        read_document_inputs(path, s3_files_dir, MODEL_SLUGS) for path in paths
+    ]
+
+    with patch.object(config, "PASSAGE_DEDUPLICATION", new="exact"):
+        serial = list(prepare_documents(document_inputs, search_weights_ref))
+        with patch.object(config, "PREPARATION_WORKERS", new=2):
+            parallel = list(prepare_documents(document_inputs, search_weights_ref))
+
+    assert sum(document.suppressed_passages for document in serial) > 0
+    assert _without_timings(parallel) == _without_timings(serial)
+
+
+def test_prepare_documents__fast_matches_strict(s3_files_dir):
+    embedding_dir_as_path = s3_files_dir
+    paths = sorted(embedding_dir_as_path.glob("*.json"))
+    search_weights_ref = "id:doc_search:search_weights::default_weights"
+    document_inputs = [
+        read_document_inputs(path, embedding_dir_as_path, MODEL_SLUGS) for path in paths
+    ]
+
+    with patch.object(config, "PASSAGE_BUILDER_MODE", new="strict"):
+        strict = list(prepare_documents(document_inputs, search_weights_ref))
+    with patch.object(config, "PASSAGE_BUILDER_MODE", new="fast"):
+        fast = list(prepare_documents(document_inputs, search_weights_ref))
+
+    assert _without_timings(fast) == _without_timings(strict)
+
+
+@pytest.mark.parametrize("builder_mode", ["strict", "fast"])
+def test_prepare_documents__validates_embeddings(s3_files_dir, builder_mode):
+    path = sorted(s3_files_dir.glob("*.json"))[-1]
+    inputs = read_document_inputs(path, s3_files_dir, MODEL_SLUGS)
+    embeddings = dict(inputs.embeddings)
+    embeddings["baai-bge-small-en-v1-5"] = embeddings["baai-bge-small-en-v1-5"][:, :8]
+
+    with patch.object(config, "PASSAGE_BUILDER_MODE", new=builder_mode):
+        with pytest.raises(VespaIndexError):
+            list(
+                prepare_documents(
+                    [inputs._replace(embeddings=embeddings)],
+                    "id:doc_search:search_weights::default_weights",
+                )
+            )
+
+
+def test_prepare_documents__deduplication(s3_files_dir):
+    embedding_dir_as_path = s3_files_dir
+    paths = sorted(embedding_dir_as_path.glob("*.json"))
+    search_weights_ref = "id:doc_search:search_weights::default_weights"
+    document_inputs = [
+        read_document_inputs(path, embedding_dir_as_path, MODEL_SLUGS) for path in paths
+    ]
+
+    prepared = list(prepare_documents(document_inputs, search_weights_ref))
+    with patch.object(config, "PASSAGE_DEDUPLICATION", new="exact"):
+        exact = list(prepare_documents(document_inputs, search_weights_ref))
+    with patch.object(config, "PASSAGE_DEDUPLICATION", new="near"):
+        near = list(prepare_documents(document_inputs, search_weights_ref))
+
+    for document, exact_document, near_document in zip(prepared, exact, near):
+        passages = dict(document.passages)
+        exact_passages = dict(exact_document.passages)
+        near_passages = dict(near_document.passages)
+        # Passages kept have the same IDs and fields as without deduplication
+        assert set(near_passages) <= set(exact_passages) <= set(passages)
+        assert all(passages[id] == fields for id, fields in exact_passages.items())
+        assert (
+            len(exact_passages) + exact_document.suppressed_passages
+            == len(passages)
+            == len(near_passages) + near_document.suppressed_passages
+        )
+        texts = [fields["text_block"] for fields in exact_passages.values()]
+        assert len(set(texts)) == len(texts)
+
+
+def test_filter_unchanged_paths(tmp_path):
+    for doc_id in ["doc.1", "doc.2", "doc.3"]:
+        (tmp_path / f"{doc_id}.json").write_text(f'{{"document_id": "{doc_id}"}}')
+        if doc_id == "doc.3":
+            continue
+        for model_slug in MODEL_SLUGS:
+            (tmp_path / f"{doc_id}__{model_slug}.npy").write_bytes(b"embeddings")
+    paths = sorted(tmp_path.glob("*.json"))
+
+    fingerprints = {}
+    paths_to_index = list(
+        filter_unchanged_paths(paths, tmp_path, IndexManifest(), fingerprints)
+    )
+    assert paths_to_index == paths
+    assert set(fingerprints) == {"doc.1", "doc.2"}
+
+    manifest = IndexManifest(documents={"doc.1": fingerprints["doc.1"]})
+    paths_to_index = list(filter_unchanged_paths(paths, tmp_path, manifest, {}))
+    assert [path.stem for path in paths_to_index] == ["doc.2", "doc.3"]
+
+
+@pytest.mark.parametrize("document_count", [3, 250])
+def test_filter_unchanged_paths__lazy(tmp_path, document_count):
+    for i in range(document_count):
+        (tmp_path / f"doc.{i}.json").write_text(f'{{"document_id": "doc.{i}"}}')
+        for model_slug in MODEL_SLUGS:
+            (tmp_path / f"doc.{i}__{model_slug}.npy").write_bytes(b"embeddings")
+    listed = []
+
+    def _listing():
+        for i in range(document_count):
+            listed.append(i)
+            yield tmp_path / f"doc.{i}.json"
+
+    with patch(
+        "src.index.vespa_.list_file_fingerprints", wraps=list_file_fingerprints
+    ) as listing:
+        paths_to_index = filter_unchanged_paths(
+            _listing(), tmp_path, IndexManifest(), {}
+        )
+        assert next(paths_to_index).stem == "doc.0"
+        # Paths are listed only as far as needed to choose how to fingerprint
+        assert len(listed) == min(document_count, PER_DOCUMENT_LISTING_MAX + 1)
+        assert len(list(paths_to_index)) == document_count - 1
+
+    # Few documents are fingerprinted by themselves, more from one listing
+    assert listing.call_count == 1
+    assert listing.call_args.args[1:] == (
+        ({f"doc.{i}" for i in range(document_count)},)
+        if document_count <= PER_DOCUMENT_LISTING_MAX
+        else ()
+    )
+
+
+def test_passage_digest():
+    fields = {"text_block": "text", "text_embedding_bge_small": [0.1, 0.2]}
+    reordered = dict(reversed(list(fields.items())))
+
+    assert passage_digest(fields) == passage_digest(reordered)
+    assert passage_digest(fields) != passage_digest({**fields, "text_block": "new"})
+
+
+@pytest.mark.usefixtures("cleanup_test_vespa_before", "cleanup_test_vespa_after")
+def test_get_document_generator__passage_state(test_vespa, s3_files_dir):
+    embedding_dir_as_path = s3_files_dir
+    paths = [embedding_dir_as_path / "CCLW.executive.10014.4470.json"]
+    passage_state = PassageState()
+
+    first_run = list(
+        get_document_generator(
+            test_vespa, paths, embedding_dir_as_path, passage_state=passage_state
+        )
+    )
+    family_doc_id = "CCLW.executive.10014.4470"
+    first_passage_ids = [
+        doc_id for schema, doc_id, _ in first_run if schema == DOCUMENT_PASSAGE_SCHEMA
+    ]
+    assert sorted(passage_state.documents[family_doc_id]) == sorted(first_passage_ids)
+
+    # Nothing was fed, so passages are generated again despite matching digests
+    second_run = list(
+        get_document_generator(
+            test_vespa, paths, embedding_dir_as_path, passage_state=passage_state
+        )
+    )
+    assert second_run == first_run
+
+
+def test_feed_documents__respects_in_flight_limit():
+    lock = threading.Lock()
+    in_flight = 0
+    max_in_flight = 0
+
+    def feed_data_point(schema, data_id, fields, namespace):
+        nonlocal in_flight, max_in_flight
+        with lock:
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+        time.sleep(0.01)
+        with lock:
+            in_flight -= 1
+        status_code = 500 if data_id == "doc.bad" else 200
+        return VespaResponse(
+            json={}, status_code=status_code, url="", operation_type="feed"
+        )
+
+    session = MagicMock()
+    session.feed_data_point.side_effect = feed_data_point
+    controller = AdaptiveFlowController(
+        initial=3, minimum=1, maximum=3, target_latency=60
+    )
+    documents = [{"id": f"doc.{i}", "fields": {}} for i in range(30)]
+
+    feed_documents(session, DOCUMENT_PASSAGE_SCHEMA, documents, controller)
+    assert session.feed_data_point.call_count == len(documents)
+    assert max_in_flight <= 3
+
+    with pytest.raises(VespaIndexError):
+        feed_documents(
+            session,
+            DOCUMENT_PASSAGE_SCHEMA,
+            [{"id": "doc.bad", "fields": {}}] + documents,
+            controller,
+        )
+
+
+def test_vespa_feeder__referenced_documents_written_first():
+    lock = threading.Lock()
+    events = []
+
+    def feed_data_point(schema, data_id, fields, namespace):
+        with lock:
+            events.append(("start", data_id))
+        time.sleep(0.02 if schema != DOCUMENT_PASSAGE_SCHEMA else 0.005)
+        with lock:
+            events.append(("end", data_id))
+        return VespaResponse(json={}, status_code=200, url="", operation_type="feed")
+
+    session = MagicMock()
+    session.feed_data_point.side_effect = feed_data_point
+    controller = AdaptiveFlowController(
+        initial=8, minimum=1, maximum=8, target_latency=60
+    )
+    operations = [(SEARCH_WEIGHTS_SCHEMA, "default_weights")]
+    for family in ["family.1", "family.2", "family.3"]:
+        operations.append((FAMILY_DOCUMENT_SCHEMA, family))
+        operations.extend((DOCUMENT_PASSAGE_SCHEMA, f"{family}.{i}") for i in range(10))
+
+    with VespaFeeder(session, controller) as feeder:
+        for schema, doc_id in operations:
+            feeder.submit(schema, {"id": doc_id, "fields": {}})
+
+    assert session.feed_data_point.call_count == len(operations)
+    ended = {doc_id: i for i, (event, doc_id) in enumerate(events) if event == "end"}
+    for i, (event, doc_id) in enumerate(events):
+        if event == "start" and doc_id.count(".") == 2:
+            family = doc_id.rsplit(".", 1)[0]
+            assert ended["default_weights"] < i
+            assert ended[family] < i
+
+
+def test_iterate_in_background():
+    assert list(iterate_in_background(range(100), max_queued=3)) == list(range(100))
+
+    def failing():
+        yield 1
+        raise ValueError("generation failed")
+
+    with pytest.raises(ValueError):
+        list(iterate_in_background(failing(), max_queued=3))
+
+
+@pytest.mark.parametrize("feed_client", ["sync", "async"])
+def test_stream_ingest__stopped_with_stray_deletes_pending(feed_client):
+    stop = threading.Event()
+    family_document = {"family_name": "name"}
+
+    def _operations(feeder):
+        yield FAMILY_DOCUMENT_SCHEMA, "doc.0", family_document
+        stop.set()
+        # Generation runs ahead of the feeder, which stops consuming
+        time.sleep(0.2)
+        remove_ids(feeder, ["doc.1.5"])
+        yield FAMILY_DOCUMENT_SCHEMA, "doc.1", family_document
+
+    with FakeVespa() as fake_vespa, ExitStack() as stack:
+        vespa = Vespa(url=fake_vespa.url)
+        controller = AdaptiveFlowController.from_config()
+        if feed_client == "async":
+            feeder = stack.enter_context(AsyncVespaFeeder(vespa, controller))
+        else:
+            session = stack.enter_context(feed_session(vespa, controller.maximum))
+            feeder = stack.enter_context(VespaFeeder(session, controller))
+        _stream_ingest(vespa, _operations(feeder), controller, stop=stop, feeder=feeder)
+        stack.close()
+
+        # The delete is fed before the feeder closes, rather than failing to be
+        # submitted to it after
+        assert fake_vespa.stats()["requests"]["delete"] == 1
+
+
+def _checkpoint_operations(document_ids: list[str], passages_per_document: int):
+    yield SEARCH_WEIGHTS_SCHEMA, "default_weights", {"weight": 1}
+    for document_id in document_ids:
+        yield FAMILY_DOCUMENT_SCHEMA, document_id, {"id": document_id}
+        for i in range(passages_per_document):
+            yield DOCUMENT_PASSAGE_SCHEMA, f"{document_id}.{i}", {"id": i}
+
+
+def test_checkpoint_recorder(tmp_path):
+    paths = [tmp_path / f"doc.{i}.json" for i in range(4)]
+    checkpoint_path = tmp_path / "checkpoint.json"
+    recorder = CheckpointRecorder(
+        checkpoint_path,
+        paths,
+        IndexCheckpoint(position=0, completed_document_ids=["doc.1"]),
+    )
+
+    recorder.observe(FAMILY_DOCUMENT_SCHEMA, "doc.0")
+    recorder.observe(DOCUMENT_PASSAGE_SCHEMA, "doc.0.0")
+    recorder.acknowledged()
+    # doc.0 may still have operations to come
+    assert read_checkpoint(checkpoint_path).completed_document_ids == ["doc.1"]
+
+    recorder.observe(FAMILY_DOCUMENT_SCHEMA, "doc.2")
+    assert recorder.pending == 1
+    recorder.acknowledged()
+    assert read_checkpoint(checkpoint_path) == IndexCheckpoint(
+        position=2, completed_document_ids=["doc.0", "doc.1"]
+    )
+
+    recorder.acknowledged(finished=True)
+    assert read_checkpoint(checkpoint_path) == IndexCheckpoint(
+        position=3, completed_document_ids=["doc.0", "doc.1", "doc.2"]
+    )
+
+
+def test_checkpoint_recorder__tracks_listed_paths(tmp_path):
+    checkpoint_path = tmp_path / "checkpoint.json"
+    recorder = CheckpointRecorder(checkpoint_path)
+    paths = recorder.track(tmp_path / f"doc.{i}.json" for i in range(3))
+
+    next(paths)
+    recorder.observe(FAMILY_DOCUMENT_SCHEMA, "doc.0")
+    recorder.acknowledged(finished=True)
+    # Only the paths listed so far count towards the position
+    assert read_checkpoint(checkpoint_path).position == 1
+
+    list(paths)
+    recorder.acknowledged()
+    assert read_checkpoint(checkpoint_path).position == 1
+
+
+def test_batch_ingest_all__checkpoints_acknowledged_batches(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "VESPA_DOCUMENT_BATCH_SIZE", 5)
+    document_ids = [f"doc.{i}" for i in range(4)]
+    recorder = CheckpointRecorder(
+        tmp_path / "checkpoint.json",
+        [tmp_path / f"{document_id}.json" for document_id in document_ids],
+    )
+    controller = AdaptiveFlowController(
+        initial=1, minimum=1, maximum=1, target_latency=1
+    )
+
+    completed_at_each_batch = []
+
+    def _record_batch(*args):
+        completed_at_each_batch.append(recorder.checkpoint.completed_document_ids)
+
+    with patch("src.index.vespa_._batch_ingest", side_effect=_record_batch):
+        _batch_ingest_all(
+            MagicMock(),
+            _checkpoint_operations(document_ids, passages_per_document=3),
+            controller,
+            checkpoint=recorder,
+        )
+
+    assert completed_at_each_batch == [[], ["doc.0"], ["doc.0", "doc.1", "doc.2"]]
+    assert recorder.checkpoint.completed_document_ids == document_ids
+    assert recorder.checkpoint.position == len(document_ids)
+
+
+def test_batch_ingest_all__stops_before_next_batch(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "VESPA_DOCUMENT_BATCH_SIZE", 5)
+    document_ids = [f"doc.{i}" for i in range(4)]
+    recorder = CheckpointRecorder(
+        tmp_path / "checkpoint.json",
+        [tmp_path / f"{document_id}.json" for document_id in document_ids],
+    )
+    controller = AdaptiveFlowController(
+        initial=1, minimum=1, maximum=1, target_latency=1
+    )
+    stop = threading.Event()
+
+    with patch(
+        "src.index.vespa_._batch_ingest", side_effect=lambda *args: stop.set()
+    ) as batch_ingest:
+        _batch_ingest_all(
+            MagicMock(),
+            _checkpoint_operations(document_ids, passages_per_document=3),
+            controller,
+            checkpoint=recorder,
+            stop=stop,
+        )
+
+    assert batch_ingest.call_count == 1
+    assert read_checkpoint(tmp_path / "checkpoint.json") == IndexCheckpoint(
+        position=1, completed_document_ids=["doc.0"]
+    )
+
+
+def _response(status_code: int) -> VespaResponse:
+    return VespaResponse(
+        json={}, status_code=status_code, url="n/a", operation_type="feed"
+    )
+
+
+def test_vespa_feeder__retries_only_failed_operations(monkeypatch):
+    monkeypatch.setattr(config, "VESPA_FEED_MAX_ATTEMPTS", 3)
+    monkeypatch.setattr(config, "VESPA_FEED_RETRY_BACKOFF", 0)
+    responses = {
+        "doc.1.0": [_response(503), _response(200)],
+        "doc.1.1": [_response(400)],
+        "doc.1.2": [_response(429), _response(429), _response(429)],
+        "doc.1.3": [_response(200)],
+    }
+    calls = {document_id: 0 for document_id in responses}
+
+    def _feed_data_point(schema, data_id, fields, namespace):
+        calls[data_id] += 1
+        return responses[data_id][calls[data_id] - 1]
+
+    session = MagicMock()
+    session.feed_data_point.side_effect = _feed_data_point
+    controller = AdaptiveFlowController(
+        initial=4, minimum=1, maximum=4, target_latency=10, cooldown=0
+    )
+    failures = FeedFailures()
+
+    feed_documents(
+        session,
+        DOCUMENT_PASSAGE_SCHEMA,
+        [{"id": document_id, "fields": {}} for document_id in responses],
+        controller,
+        failures=failures,
+    )
+
+    assert calls == {"doc.1.0": 2, "doc.1.1": 1, "doc.1.2": 3, "doc.1.3": 1}
+    assert sorted((f.id, f.status_code, f.attempts) for f in failures.failures) == [
+        ("doc.1.1", 400, 1),
+        ("doc.1.2", 429, 3),
+    ]
+
+
+def test_feed_session__only_feeder_retries(monkeypatch):
+    monkeypatch.setattr(config, "VESPA_FEED_MAX_ATTEMPTS", 2)
+    monkeypatch.setattr(config, "VESPA_FEED_RETRY_BACKOFF", 0)
+    settings = FakeVespaSettings(throttle_rate=1, throttle_status_codes=(429,))
+    controller = AdaptiveFlowController.from_config()
+    failures = FeedFailures()
+
+    with FakeVespa(settings) as fake_vespa:
+        with feed_session(Vespa(url=fake_vespa.url), controller.maximum) as session:
+            feed_documents(
+                session,
+                FAMILY_DOCUMENT_SCHEMA,
+                [{"id": "doc.1", "fields": {}}],
+                controller,
+                failures=failures,
+            )
+
+    # Each of the feeder's attempts is a single request
+    assert fake_vespa.stats()["responses"] == {"put:429": 2}
+    assert [(f.id, f.status_code, f.attempts) for f in failures.failures] == [
+        ("doc.1", 429, 2)
+    ]
+
+
+@pytest.mark.parametrize("checkpoint_name", [None, "checkpoint.json"])
+def test_populate_vespa__resume_without_checkpoint(tmp_path, checkpoint_name):
+    with pytest.raises(VespaIndexError):
+        populate_vespa(
+            paths=[],
+            embedding_dir_as_path=tmp_path,
+            checkpoint_path=tmp_path / checkpoint_name if checkpoint_name else None,
+            resume=True,
+        )
+
+
+def test_async_feeder__feed_delete_and_query():
+    family_document_ref = f"id:{_NAMESPACE}:family_document::doc.1"
+    with FakeVespa() as fake_vespa:
+        with AsyncVespaFeeder(
+            Vespa(url=fake_vespa.url), AdaptiveFlowController.from_config()
+        ) as feeder:
+            feeder.submit(FAMILY_DOCUMENT_SCHEMA, {"id": "doc.1", "fields": {}})
+            for i in range(3):
+                feeder.submit(
+                    DOCUMENT_PASSAGE_SCHEMA,
+                    {
+                        "id": f"doc.1.{i}",
+                        "fields": {"family_document_ref": family_document_ref},
+                    },
+                )
+            feeder.flush()
+            remove_ids(feeder, ["doc.1.0"])
+            feeder.flush()
+
+            assert sorted(get_existing_passage_ids(feeder, "doc.1")) == [
+                "doc.1.1",
+                "doc.1.2",
+            ]
+        assert fake_vespa.stats()["responses"] == {
+            "delete:200": 1,
+            "put:200": 4,
+            "search:200": 1,
+        }
+
+
+def test_async_feeder__records_failures():
+    failures = FeedFailures()
+    settings = FakeVespaSettings(failure_rate=1, failure_status=400)
+    with FakeVespa(settings) as fake_vespa:
+        with AsyncVespaFeeder(
+            Vespa(url=fake_vespa.url),
+            AdaptiveFlowController.from_config(),
+            failures=failures,
+        ) as feeder:
+            feeder.submit(FAMILY_DOCUMENT_SCHEMA, {"id": "doc.1", "fields": {}})
+
+    assert [(f.id, f.status_code, f.attempts) for f in failures.failures] == [
+        ("doc.1", 400, 1)
+    ]
+
+
+def test_async_feeder__only_feeder_retries(monkeypatch):
+    monkeypatch.setattr(config, "VESPA_FEED_MAX_ATTEMPTS", 2)
+    monkeypatch.setattr(config, "VESPA_FEED_RETRY_BACKOFF", 0)
+    monkeypatch.setattr(config, "VESPA_REQUEST_TIMEOUT", 0.1)
+    failures = FeedFailures()
+    settings = FakeVespaSettings(latency=0.5)
+    with FakeVespa(settings) as fake_vespa:
+        with AsyncVespaFeeder(
+            Vespa(url=fake_vespa.url),
+            AdaptiveFlowController.from_config(),
+            failures=failures,
+        ) as feeder:
+            feeder.submit(FAMILY_DOCUMENT_SCHEMA, {"id": "doc.1", "fields": {}})
+
+        # Each of the feeder's attempts is a single request, which times out
+        assert fake_vespa.stats()["requests"] == {"put": 2}
+    assert [(f.id, f.status_code, f.attempts) for f in failures.failures] == [
+        ("doc.1", 599, 2)
+    ]
+
+
+def test_get_failed_document_ids():
+    failures = FeedFailures()
+    failures.add(FAMILY_DOCUMENT_SCHEMA, "doc.1", _response(400), attempts=1)
+    failures.add(DOCUMENT_PASSAGE_SCHEMA, "doc.2.10", _response(400), attempts=1)
+    failures.add(SEARCH_WEIGHTS_SCHEMA, "default_weights", _response(400), 1)
+    assert get_failed_document_ids(failures) == {"doc.1", "doc.2"}
+
+
+def test_checkpoint_recorder__skips_failed_documents(tmp_path):
+    failures = FeedFailures()
+    recorder = CheckpointRecorder(
+        tmp_path / "checkpoint.json",
+        [tmp_path / f"doc.{i}.json" for i in range(3)],
+        failures=failures,
+    )
+    for document_id in ["doc.0", "doc.1", "doc.2"]:
+        recorder.observe(FAMILY_DOCUMENT_SCHEMA, document_id)
+    failures.add(DOCUMENT_PASSAGE_SCHEMA, "doc.1.4", _response(400), attempts=1)
+    recorder.acknowledged(finished=True)
+
+    assert read_checkpoint(tmp_path / "checkpoint.json") == IndexCheckpoint(
+        position=1, completed_document_ids=["doc.0", "doc.2"]
+    )
+
+
+def test_checkpoint_recorder__records_document_ids(tmp_path):
+    failures = FeedFailures()
+    recorder = CheckpointRecorder(
+        tmp_path / "checkpoint.json",
+        [tmp_path / f"doc.{i}.json" for i in range(3)],
+        failures=failures,
+    )
+    for i in range(3):
+        recorder.observe(
+            FAMILY_DOCUMENT_SCHEMA, f"family.{i}", {"document_import_id": f"doc.{i}"}
+        )
+    failures.add(FAMILY_DOCUMENT_SCHEMA, "family.1", _response(400), attempts=1)
+    recorder.acknowledged(finished=True)
+
+    assert read_checkpoint(tmp_path / "checkpoint.json") == IndexCheckpoint(
+        position=1, completed_document_ids=["doc.0", "doc.2"]
+    )
+
+
+def test_remove_ids__failed_delete_fails_document(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "VESPA_FEED_MAX_ATTEMPTS", 2)
+    monkeypatch.setattr(config, "VESPA_FEED_RETRY_BACKOFF", 0)
+    session = MagicMock()
+    session.delete_data.return_value = _response(500)
+    controller = AdaptiveFlowController(
+        initial=4, minimum=1, maximum=4, target_latency=10, cooldown=0
+    )
+    failures = FeedFailures()
+    recorder = CheckpointRecorder(
+        tmp_path / "checkpoint.json",
+        [tmp_path / f"doc.{i}.json" for i in range(2)],
+        failures=failures,
+    )
+
+    with VespaFeeder(session, controller, failures=failures) as feeder:
+        for document_id in ["doc.0", "doc.1"]:
+            recorder.observe(FAMILY_DOCUMENT_SCHEMA, document_id)
+        remove_ids(feeder, ["doc.1.3"])
+        feeder.flush()
+        recorder.acknowledged(finished=True)
+
+    assert session.delete_data.call_count == 2
+    assert [(f.id, f.status_code, f.attempts) for f in failures.failures] == [
+        ("doc.1.3", 500, 2)
+    ]
+    assert get_failed_document_ids(failures) == {"doc.1"}
+    assert read_checkpoint(tmp_path / "checkpoint.json") == IndexCheckpoint(
+        position=1, completed_document_ids=["doc.0"]
+    )
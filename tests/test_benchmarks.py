@@ -0,0 +1,202 @@
+import json
+from unittest.mock import patch
+
+from cpr_data_access.parser_models import ParserOutput
+import numpy as np
+import pytest
+from vespa.application import Vespa
+
+from benchmarks.corpus import generate_corpus
+from benchmarks.fake_vespa import FakeVespa, FakeVespaSettings
+from benchmarks.feed import parse_config_overrides
+from benchmarks.run import BENCHMARKS, Corpus, read_previous_run, run_benchmark
+from src import config
+from src.index.embedding_models import DEFAULT_EMBEDDING_MODELS
+from src.index.vespa_ import (
+    _NAMESPACE,
+    DOCUMENT_PASSAGE_SCHEMA,
+    FAMILY_DOCUMENT_SCHEMA,
+    _feed_operation,
+    get_existing_passage_ids,
+    populate_vespa,
+)
+from src.utils import get_embedding_path
+
+
+@pytest.fixture
+def corpus(tmp_path) -> Corpus:
+    paths = generate_corpus(
+        tmp_path, document_count=4, text_blocks_per_document=(5, 10), html_fraction=0.5
+    )
+    return Corpus(directory=tmp_path, paths=paths)
+
+
+def test_generate_corpus(corpus):
+    assert len(corpus.paths) == 4
+    for path in corpus.paths:
+        parser_output = ParserOutput.model_validate_json(path.read_text())
+        text_block_count = len(parser_output.get_text_blocks())
+        assert 5 <= text_block_count <= 10
+
+        for model in DEFAULT_EMBEDDING_MODELS:
+            embeddings = np.load(
+                get_embedding_path(corpus.directory, path.stem, model.slug)
+            )
+            assert embeddings.shape == (text_block_count + 1, model.dimension)
+
+
+def test_generate_corpus__is_reproducible(tmp_path):
+    first = generate_corpus(tmp_path / "first", document_count=2, seed=1)
+    second = generate_corpus(tmp_path / "second", document_count=2, seed=1)
+    assert [path.read_text() for path in first] == [path.read_text() for path in second]
+
+
+def test_generate_corpus__embedding_container(tmp_path):
+    paths = generate_corpus(tmp_path, document_count=2, embedding_container=True)
+    assert not list(tmp_path.glob("*.npy"))
+
+    result = run_benchmark("read_embeddings", Corpus(tmp_path, paths), repeat=1)
+    assert result.items == 2
+
+
+@pytest.mark.parametrize("name", list(BENCHMARKS))
+def test_run_benchmark(corpus, name):
+    result = run_benchmark(name, corpus, repeat=1)
+    assert result.items > 0
+    assert result.seconds > 0
+
+
+def test_run_benchmark__sets_up_each_repeat(corpus):
+    parsed = []
+
+    def _bench_parse(corpus: Corpus):
+        parser_output = ParserOutput.model_validate_json(corpus.paths[0].read_text())
+        parsed.append(parser_output)
+
+        def _run():
+            # Changes its input, as filtering blocks does
+            assert parser_output.pdf_data or parser_output.html_data
+            parser_output.pdf_data = parser_output.html_data = None
+            return 1, "documents"
+
+        return _run
+
+    with patch.dict(BENCHMARKS, {"parse": _bench_parse}):
+        run_benchmark("parse", corpus, repeat=3)
+
+    assert len(parsed) == 3
+
+
+def test_read_previous_run(tmp_path, capsys):
+    corpus_settings = {"documents": 4, "seed": 0}
+    run_config = {"PASSAGE_BUILDER_MODE": "fast", "EMBEDDING_MODELS": ("a", "b")}
+    runs = [
+        {"corpus": corpus_settings, "repeat": 3, "config": run_config},
+        {"corpus": {**corpus_settings, "seed": 1}, "repeat": 3, "config": run_config},
+        {"corpus": corpus_settings, "repeat": 1, "config": run_config},
+    ]
+    results_path = tmp_path / "results.jsonl"
+    results_path.write_text(
+        "".join(
+            json.dumps({**run, "revision": str(i)}) + "\n" for i, run in enumerate(runs)
+        )
+    )
+
+    previous = read_previous_run(results_path, corpus_settings, 3, run_config)
+    assert previous is not None and previous["revision"] == "0"
+    assert "differs in: repeat" in capsys.readouterr().err
+
+    other_config = {**run_config, "PASSAGE_BUILDER_MODE": "strict"}
+    assert read_previous_run(results_path, corpus_settings, 1, other_config) is None
+    assert "differs in: PASSAGE_BUILDER_MODE" in capsys.readouterr().err
+
+    assert read_previous_run(results_path, corpus_settings, 1, run_config) == {
+        **runs[2],
+        "config": {"PASSAGE_BUILDER_MODE": "fast", "EMBEDDING_MODELS": ["a", "b"]},
+        "revision": "2",
+    }
+    assert not capsys.readouterr().err
+
+
+def test_fake_vespa__feed_and_lookup_passages():
+    family_document_ref = f"id:{_NAMESPACE}:family_document::doc.1"
+    with FakeVespa() as fake_vespa:
+        vespa = Vespa(url=fake_vespa.url)
+        with vespa.syncio() as session:
+            for i in range(3):
+                response = _feed_operation(
+                    session,
+                    DOCUMENT_PASSAGE_SCHEMA,
+                    {
+                        "id": f"doc.1.{i}",
+                        "fields": {"family_document_ref": family_document_ref},
+                    },
+                    "feed",
+                )
+                assert response.is_successful()
+            _feed_operation(
+                session, DOCUMENT_PASSAGE_SCHEMA, {"id": "doc.1.0"}, "delete"
+            )
+
+        assert sorted(get_existing_passage_ids(vespa, "doc.1")) == [
+            "doc.1.1",
+            "doc.1.2",
+        ]
+        assert fake_vespa.stats()["responses"] == {
+            "delete:200": 1,
+            "put:200": 3,
+            "search:200": 1,
+        }
+
+
+@pytest.mark.parametrize(
+    "settings,status_code",
+    [
+        (FakeVespaSettings(failure_rate=1, failure_status=400), 400),
+        (FakeVespaSettings(failure_rate=1, failure_status=500), 500),
+    ],
+)
+def test_fake_vespa__injected_failures(settings, status_code):
+    with FakeVespa(settings) as fake_vespa:
+        with Vespa(url=fake_vespa.url).syncio() as session:
+            response = _feed_operation(
+                session, FAMILY_DOCUMENT_SCHEMA, {"id": "doc.1", "fields": {}}, "feed"
+            )
+    assert response.status_code == status_code
+    assert not fake_vespa.documents
+
+
+def test_parse_config_overrides():
+    assert parse_config_overrides(
+        (
+            "VESPA_CONNECTIONS=5",
+            "VESPA_FEED_MODE=stream",
+            "DEVELOPMENT_MODE=true",
+            "VESPA_EMBEDDING_CELL_TYPES=baai-bge-small-en-v1-5=bfloat16",
+        )
+    ) == {
+        "VESPA_CONNECTIONS": 5,
+        "VESPA_FEED_MODE": "stream",
+        "DEVELOPMENT_MODE": True,
+        "VESPA_EMBEDDING_CELL_TYPES": {"baai-bge-small-en-v1-5": "bfloat16"},
+    }
+
+
+@pytest.mark.parametrize("feed_client", ["sync", "async"])
+@pytest.mark.parametrize("feed_mode", ["batch", "stream"])
+def test_populate_vespa__fake_vespa(corpus, feed_mode, feed_client):
+    with FakeVespa() as fake_vespa, patch.multiple(
+        config,
+        VESPA_INSTANCE_URL=fake_vespa.url,
+        DEVELOPMENT_MODE=True,
+        VESPA_FEED_MODE=feed_mode,
+        VESPA_FEED_CLIENT=feed_client,
+    ):
+        populate_vespa(paths=corpus.paths, embedding_dir_as_path=corpus.directory)
+
+    family_document_ids = {
+        document_id
+        for schema, document_id in fake_vespa.documents
+        if schema == FAMILY_DOCUMENT_SCHEMA
+    }
+    assert family_document_ids == {path.stem for path in corpus.paths}